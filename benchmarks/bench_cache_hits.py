@@ -0,0 +1,70 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+""" Benchmark of the throughput of the HIPS service on cache hits.
+
+    Compares serving the stored bytes of a cached tile, as done by
+    HIPSServer.handle(), with decoding and re-encoding it, as done
+    previously.
+
+    Usage: python benchmarks/bench_cache_hits.py [--requests N] [--ext png]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bench_hips_tile import make_server
+from mapproxy.cache.tile import Tile
+from mapproxy.image import img_to_buf
+from mapproxy_hips.service.hips import _image_opts
+
+
+class _Request(object):
+    def __init__(self, path):
+        self.path = path
+
+
+def _start_response(status, headers):
+    pass
+
+
+def serve(server, path):
+    resp = server.handle(_Request(path))
+    return b''.join(resp({}, _start_response))
+
+
+def serve_reencoded(server, layer_name, norder, npix, ext):
+    cache = server._get_tile_cache(layer_name, norder, ext)
+    tile = Tile([norder, npix, 0])
+    cache.load_tile(tile)
+    return img_to_buf(tile.source_image(), _image_opts(ext)).read()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--ext', default='png', choices=('png', 'jpg'))
+    args = parser.parse_args()
+
+    norder, npix = 3, 100
+    server = make_server('bilinear')
+    server._get_hips_tile_content('bench', norder, npix, args.ext, True)
+    path = '/hips/bench/Norder%d/Dir0/Npix%d.%s' % (norder, npix, args.ext)
+
+    for name, func in (('decode + re-encode', lambda: serve_reencoded(server, 'bench', norder, npix, args.ext)),
+                       ('raw bytes', lambda: serve(server, path))):
+        func()
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            func()
+        elapsed = time.perf_counter() - start
+        print('%-20s %8.1f requests/s' % (name, args.requests / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+""" Benchmark of HIPSSource.get_map().
+
+    The HIPS tiles are synthetic, so that no download nor decoding is
+    measured. For each request, the total latency and the time spent in
+    the rendering kernel are reported, the later per million of pixels, as
+    well as the peak resident memory of the process so far.
+
+    Usage: python benchmarks/bench_get_map.py [--sizes 256,1024,4096] [--method bilinear]
+                                              [--requests web_mercator,...]
+                                              [--approx-transform-max-error 0.125]
+"""
+
+import argparse
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mapproxy.client.http import HTTPClient
+from mapproxy.layer import MapQuery
+from mapproxy.srs import SRS
+import mapproxy_hips.source.hips as source_hips
+
+# (name, bbox, srs) of the requests
+REQUESTS = [
+    ('single_base_pixel', (10, 10, 12, 12), 'EPSG:4326'),
+    ('cross_base_pixels', (-60, -30, 60, 60), 'EPSG:4326'),
+    ('whole_world', (-180, -90, 180, 90), 'EPSG:4326'),
+    ('web_mercator', (-2e6, -2e6, 2e6, 2e6), 'EPSG:3857'),
+]
+
+
+class _SyntheticHIPSSource(source_hips.HIPSSource):
+    def __init__(self, resampling_method, hips_shift=9, hips_order_max=8):
+        source_hips.HIPSSource.__init__(self, HTTPClient(), 'http://localhost', resampling_method)
+        self.hips_shift = hips_shift
+        self.hips_tile_format = 'jpeg'
+        self.hips_order_max = hips_order_max
+        tile_size = 1 << hips_shift
+        self.tile = np.random.default_rng(0).integers(0, 256, (tile_size, tile_size, 3), dtype=np.uint8)
+
+    def load_hips_tiles(self, hips_tile_order, hips_tiles):
+        return [self.tile] * len(hips_tiles)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='256,1024,4096', help='comma separated list of image sizes')
+    parser.add_argument('--requests', default=','.join(x[0] for x in REQUESTS),
+                        help='comma separated list of requests')
+    parser.add_argument('--method', default='bilinear', choices=('nearest_neighbour', 'bilinear', 'bicubic'))
+    parser.add_argument('--approx-transform-max-error', type=float, default=0,
+                        help='approx_transform_max_error option of the source')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    source_hips.warmup_kernels()
+    source = _SyntheticHIPSSource(args.method)
+    source.approx_transform_max_error = args.approx_transform_max_error
+
+    # Time the rendering kernel separately from the rest of get_map()
+    render_timings = []
+    run_in_strips = source_hips.run_in_strips
+
+    def timed_run_in_strips(*args):
+        start = time.perf_counter()
+        run_in_strips(*args)
+        render_timings.append(time.perf_counter() - start)
+
+    source_hips.run_in_strips = timed_run_in_strips
+
+    for size in [int(x) for x in args.sizes.split(',')]:
+        for name, bbox, srs in REQUESTS:
+            if name not in args.requests.split(','):
+                continue
+            query = MapQuery(bbox, (size, size), SRS(srs))
+            timings = []
+            del render_timings[:]
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                source.get_map(query)
+                timings.append(time.perf_counter() - start)
+            render = min(render_timings)
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            print('%5dx%-5d %-18s total: %7.3f s   render: %7.3f s (%.3f s/Mpixel)   peak RSS: %5d MB' %
+                  (size, size, name, min(timings), render, render / (size * size / 1e6), peak_rss))
+
+
+if __name__ == '__main__':
+    main()
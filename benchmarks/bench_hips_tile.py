@@ -0,0 +1,79 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+""" Benchmark of HIPSServer._generate_hips_tile() per-tile latency.
+
+    The WMS source is replaced by a synthetic image, so that only the
+    HEALPix geometry and resampling costs are measured.
+
+    Usage: python benchmarks/bench_hips_tile.py [--tiles N] [--norder K]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mapproxy_hips.service.hips import HIPSServer, warmup_kernels
+
+
+class _FakeLayer(object):
+    def __init__(self, name):
+        self.name = name
+        self.title = name
+        self.md = {}
+
+
+class _FakeRootLayer(object):
+    def __init__(self, layers):
+        self.layers = layers
+
+    def child_layers(self):
+        return self.layers
+
+
+def make_server(resampling_method, layer_name='bench', **kwargs):
+    tmp_dir = tempfile.mkdtemp()
+    root_layer = _FakeRootLayer({layer_name: _FakeLayer(layer_name)})
+    server = HIPSServer(tmp_dir, tmp_dir, 60, False, root_layer, {}, resampling_method, **kwargs)
+
+    rng = np.random.default_rng(0)
+
+    def _get_source_image(layer_name, srs, bbox, width, height):
+        return rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+
+    server._get_source_image = _get_source_image
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tiles', type=int, default=5, help='number of tiles per resampling method')
+    parser.add_argument('--norder', type=int, default=3)
+    parser.add_argument('--warmup', action='store_true', help='call warmup_kernels() first')
+    args = parser.parse_args()
+
+    if args.warmup:
+        start = time.perf_counter()
+        warmup_kernels()
+        print('warm-up: %.3f s' % (time.perf_counter() - start))
+
+    for method in ('nearest_neighbour', 'bilinear', 'bicubic'):
+        server = make_server(method)
+        timings = []
+        for npix in range(args.tiles):
+            start = time.perf_counter()
+            server._generate_hips_tile('bench', args.norder, 100 + npix, server.hips_shift)
+            timings.append(time.perf_counter() - start)
+        print('%-18s first tile: %7.3f s   next tiles: %7.3f s/tile' %
+              (method, timings[0], sum(timings[1:]) / max(1, len(timings) - 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+""" Benchmark of the scaling of the render_threads option.
+
+    Measures the latency of the rendering of a single HIPS tile by the
+    HIPS service, and of a single GetMap request by the HIPS source kernel,
+    for an increasing number of threads, and checks that the results are
+    identical to the serial ones.
+
+    Usage: python benchmarks/bench_render_threads.py [--threads 1,2,4,8] [--method bicubic]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bench_hips_tile import make_server
+from mapproxy_hips.service.hips import warmup_kernels as warmup_service_kernels
+from mapproxy_hips.source.hips import _create_map_image, warmup_kernels as warmup_source_kernels
+from mapproxy_hips.util.mosaic import build_mosaic
+from mapproxy_hips.util.parallel import run_in_strips
+from mapproxy_hips.util.resampling import resampling_mode
+
+
+def bench_service(method, threads, repeat):
+    ref = None
+    print('HIPS service, 512x512 %s tile' % method)
+    for num_threads in threads:
+        server = make_server(method, render_threads=num_threads)
+        # Populate the geometry cache
+        server._generate_hips_tile('bench', 3, 100, server.hips_shift)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            tile = server._generate_hips_tile('bench', 3, 100, server.hips_shift)
+            timings.append(time.perf_counter() - start)
+        if ref is None:
+            ref = tile
+        print('  %2d threads: %7.3f s/tile   identical to serial: %s' %
+              (num_threads, min(timings), np.array_equal(tile, ref)))
+
+
+def bench_source(method, threads, repeat, size=2048, hips_shift=9):
+    print('HIPS source, %dx%d %s GetMap' % (size, size, method))
+    rng = np.random.default_rng(0)
+    tile_size = 1 << hips_shift
+    tile = rng.integers(0, 256, (tile_size, tile_size, 4), dtype=np.uint8)
+    mosaic = build_mosaic(0, [0], [tile], hips_shift, 3)
+    pixels = rng.integers(0, tile_size * tile_size, size * size, dtype=np.int64)
+    dx_ar = rng.uniform(0, 1, size * size)
+    dy_ar = rng.uniform(0, 1, size * size)
+    resampling = resampling_mode(method)
+
+    ref = None
+    for num_threads in threads:
+        result_ar = np.zeros((size, size, 4), dtype=np.uint8)
+
+        def render_strip(start, end):
+            _create_map_image(end - start, size, hips_shift,
+                              pixels[start * size:end * size],
+                              dx_ar[start * size:end * size],
+                              dy_ar[start * size:end * size],
+                              mosaic.mosaics, mosaic.slot_layout, mosaic.slot_of_face, mosaic.tile_origin,
+                              mosaic.tile_present, mosaic.hips_shift, mosaic.halo,
+                              result_ar[start:end], resampling, 0.75)
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run_in_strips(render_strip, size, num_threads)
+            timings.append(time.perf_counter() - start)
+        if ref is None:
+            ref = result_ar
+        print('  %2d threads: %7.3f s/map    identical to serial: %s' %
+              (num_threads, min(timings), np.array_equal(result_ar, ref)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', default='1,2,4,8', help='comma separated list of thread counts')
+    parser.add_argument('--method', default='bicubic', choices=('nearest_neighbour', 'bilinear', 'bicubic'))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    threads = [int(x) for x in args.threads.split(',')]
+
+    warmup_service_kernels()
+    warmup_source_kernels()
+    bench_service(args.method, threads, args.repeat)
+    bench_source(args.method, threads, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
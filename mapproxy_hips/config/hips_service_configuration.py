@@ -2,6 +2,9 @@
 # Copyright (C) 2021-2022 Spatialys
 # Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
 
+from mapproxy.util.ext.dictspec.spec import number
+
+
 def hips_service_creator(serviceConfiguration, conf):
     from mapproxy_hips.service.hips import HIPSServer
     root_layer = serviceConfiguration.context.wms_root_layer.wms_layer()
@@ -13,14 +16,83 @@ def hips_service_creator(serviceConfiguration, conf):
     lock_dir = serviceConfiguration.context.globals.get_path('cache.lock_dir', conf)
     timeout = serviceConfiguration.context.globals.get_value('http.client_timeout', conf)
     populate_cache = conf.get('populate_cache', True)
-    return HIPSServer(cache_dir, lock_dir, timeout, populate_cache,
-                      root_layer, tile_layers, resampling_method)
+    geometry_cache = _geometry_cache(serviceConfiguration, conf.get('geometry_cache', {}))
+    render_threads = conf.get('render_threads', 1)
+    if render_threads < 1:
+        raise ValueError(f'invalid render_threads = {render_threads}')
+    empty_tile_status = conf.get('empty_tile_status', 200)
+    if empty_tile_status not in (200, 204, 404):
+        raise ValueError(f'invalid empty_tile_status = {empty_tile_status}')
+    hot_tile_cache_conf = conf.get('hot_tile_cache', {})
+    server = HIPSServer(cache_dir, lock_dir, timeout, populate_cache,
+                        root_layer, tile_layers, resampling_method,
+                        geometry_cache=geometry_cache,
+                        render_threads=render_threads,
+                        pyramid=conf.get('pyramid', False),
+                        empty_tile_status=empty_tile_status,
+                        hot_tile_cache=_hot_tile_cache(hot_tile_cache_conf),
+                        tile_cache_backend=_tile_cache_backend(conf.get('tile_cache', {})),
+                        generate_on_head=conf.get('generate_on_head', False))
+    server.prewarm_hot_tile_cache(hot_tile_cache_conf.get('prewarm_max_order', 3))
+    return server
+
+
+def _geometry_cache(serviceConfiguration, conf):
+    from mapproxy_hips.util.geometry import HIPSTileGeometryCache
+    directory = conf.get('directory')
+    if directory:
+        directory = serviceConfiguration.context.globals.abspath(directory)
+    dtype = conf.get('dtype', 'float64')
+    if dtype not in ('float32', 'float64'):
+        raise ValueError(f'unsupported geometry_cache.dtype = {dtype}')
+    max_size_mb = conf.get('max_size_mb', 0)
+    if max_size_mb < 0:
+        raise ValueError(f'invalid geometry_cache.max_size_mb = {max_size_mb}')
+    return HIPSTileGeometryCache(max_entries=conf.get('max_entries', 16),
+                                 directory=directory,
+                                 dtype=dtype,
+                                 max_size_mb=max_size_mb)
+
+
+def _tile_cache_backend(conf):
+    from mapproxy_hips.util.tile_cache import HIPSTileCacheBackend
+    return HIPSTileCacheBackend(conf.get('type', 'file'), conf.get('wal', False))
+
+
+def _hot_tile_cache(conf):
+    max_size_mb = conf.get('max_size_mb', 0)
+    if max_size_mb <= 0:
+        return None
+    from mapproxy_hips.util.lru import LRUCache
+    ttl = conf.get('ttl')
+    if ttl is not None and ttl <= 0:
+        raise ValueError(f'invalid hot_tile_cache.ttl = {ttl}')
+    return LRUCache(int(max_size_mb * 1024 * 1024), ttl=ttl)
 
 
 def hips_service_yaml_spec():
     spec = {
         'resampling_method': str(),
-        'populate_cache': bool()
+        'populate_cache': bool(),
+        'render_threads': int(),
+        'pyramid': bool(),
+        'empty_tile_status': int(),
+        'generate_on_head': bool(),
+        'geometry_cache': {
+            'max_entries': int(),
+            'directory': str(),
+            'dtype': str(),
+            'max_size_mb': number(),
+        },
+        'tile_cache': {
+            'type': str(),
+            'wal': bool(),
+        },
+        'hot_tile_cache': {
+            'max_size_mb': number(),
+            'ttl': number(),
+            'prewarm_max_order': int(),
+        },
     }
     return spec
 
@@ -34,6 +106,72 @@ def hips_service_json_schema():
             },
             "populate_cache": {
                 "type": "boolean"
+            },
+            "render_threads": {
+                "type": "integer",
+                "minimum": 1
+            },
+            "pyramid": {
+                "type": "boolean"
+            },
+            "empty_tile_status": {
+                "type": "integer",
+                "enum": [200, 204, 404]
+            },
+            "generate_on_head": {
+                "type": "boolean"
+            },
+            "geometry_cache": {
+                "type": "object",
+                "properties": {
+                    "max_entries": {
+                        "type": "integer",
+                        "minimum": 0
+                    },
+                    "directory": {
+                        "type": "string"
+                    },
+                    "dtype": {
+                        "type": "string",
+                        "enum": ["float32", "float64"]
+                    },
+                    "max_size_mb": {
+                        "type": "number",
+                        "minimum": 0
+                    }
+                },
+                "additionalProperties": False
+            },
+            "tile_cache": {
+                "type": "object",
+                "properties": {
+                    "type": {
+                        "type": "string",
+                        "enum": ["file", "mbtiles"]
+                    },
+                    "wal": {
+                        "type": "boolean"
+                    }
+                },
+                "additionalProperties": False
+            },
+            "hot_tile_cache": {
+                "type": "object",
+                "properties": {
+                    "max_size_mb": {
+                        "type": "number",
+                        "minimum": 0
+                    },
+                    "ttl": {
+                        "type": "number",
+                        "exclusiveMinimum": 0
+                    },
+                    "prewarm_max_order": {
+                        "type": "integer",
+                        "minimum": -1
+                    }
+                },
+                "additionalProperties": False
             }
         },
         "additionalProperties": False
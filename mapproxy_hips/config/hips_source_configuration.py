@@ -6,7 +6,7 @@ import os
 
 from mapproxy.config.configuration.source import SourceConfiguration
 from mapproxy.config.spec import image_opts
-from mapproxy.util.ext.dictspec.spec import required
+from mapproxy.util.ext.dictspec.spec import number, one_of, required
 from mapproxy.util.py import memoize
 
 import logging
@@ -46,15 +46,53 @@ class HIPSSourceConfiguration(SourceConfiguration):
         if resampling_method not in ('nearest_neighbour', 'bilinear', 'bicubic'):
             raise ValueError(f'unsupported resampling_method = {resampling_method}')
 
-        source = HIPSSource(http_client, url, resampling_method, coverage=coverage, image_opts=image_opts)
+        render_threads = self.conf.get('render_threads', 1)
+        if render_threads < 1:
+            raise ValueError(f'invalid render_threads = {render_threads}')
 
+        concurrent_requests = self.conf.get('concurrent_requests', 4)
+        if concurrent_requests < 1:
+            raise ValueError(f'invalid concurrent_requests = {concurrent_requests}')
+
+        approx_transform_max_error = self.conf.get('approx_transform_max_error', 0)
+        if approx_transform_max_error < 0:
+            raise ValueError(f'invalid approx_transform_max_error = {approx_transform_max_error}')
+
+        passthrough_cache_ttl = self.conf.get('passthrough_cache_ttl', 0)
+        if passthrough_cache_ttl < 0:
+            raise ValueError(f'invalid passthrough_cache_ttl = {passthrough_cache_ttl}')
         cache_hips_tiles = self.conf.get('cache_hips_tiles', True)
+        # Like HIPS tiles, passthrough files are only stored on disk if caching is enabled
+        passthrough_dir = os.path.join(self.cache_dir(), self.conf['name'], 'passthrough') if cache_hips_tiles else None
+        from mapproxy_hips.util.http_cache import HTTPResourceCache
+        http_cache = HTTPResourceCache(http_client, passthrough_dir, ttl=passthrough_cache_ttl)
+
+        source = HIPSSource(http_client, url, resampling_method, coverage=coverage, image_opts=image_opts,
+                            render_threads=render_threads, http_cache=http_cache,
+                            concurrent_requests=concurrent_requests,
+                            approx_transform_max_error=approx_transform_max_error,
+                            decoded_tile_cache=_decoded_tile_cache(self.conf.get('decoded_tile_cache', {})))
+
+        raw_tile_store = self.conf.get('raw_tile_store', False)
+        if raw_tile_store:
+            source.raw_tile_store_dir = os.path.join(self.cache_dir(), self.conf['name'], 'raw_tiles')
+            # Either true, or the configuration of the store
+            if isinstance(raw_tile_store, dict):
+                max_size_mb = raw_tile_store.get('max_size_mb', 0)
+                if max_size_mb < 0:
+                    raise ValueError(f'invalid raw_tile_store.max_size_mb = {max_size_mb}')
+                source.raw_tile_store_max_size_mb = max_size_mb
+
         if cache_hips_tiles:
             from mapproxy.cache.base import TileLocker
-            from mapproxy.cache.file import FileCache
+            from mapproxy_hips.util.tile_cache import HIPSTileCacheBackend
+
+            # Either true, or the configuration of the cache backend
+            backend_conf = cache_hips_tiles if isinstance(cache_hips_tiles, dict) else {}
+            backend = HIPSTileCacheBackend(backend_conf.get('type', 'file'), backend_conf.get('wal', False))
 
             cache_dir = os.path.join(self.cache_dir(), self.conf['name'], 'hips_tiles')
-            cache = FileCache(cache_dir, 'jpg' if source.hips_tile_format == 'jpeg' else 'png')
+            cache = backend.create_cache(cache_dir, 'jpg' if source.hips_tile_format == 'jpeg' else 'png')
 
             lock_timeout = self.context.globals.get_value('http.client_timeout', {})
             lock_cache_id = cache.lock_cache_id
@@ -62,16 +100,39 @@ class HIPSSourceConfiguration(SourceConfiguration):
 
             source.locker = locker
             source.cache = cache
+            source.tile_cache_backend = backend
 
         return source
 
 
+def _decoded_tile_cache(conf):
+    max_size_mb = conf.get('max_size_mb', 0)
+    if max_size_mb <= 0:
+        return None
+    from mapproxy_hips.util.lru import LRUCache
+    return LRUCache(int(max_size_mb * 1024 * 1024), sizeof=lambda ar: ar.nbytes)
+
+
 def hips_source_yaml_spec():
     """ Chunk to add to mapproxy.config.spec.mapproxy_yaml_spec under the ["sources"]["hips"]
         node to validate HIPS sources in a mapproxy.yml file """
     spec = {
         required('url'): str(),
         'resampling_method': str(),
+        'render_threads': int(),
+        'concurrent_requests': int(),
+        'decoded_tile_cache': {
+            'max_size_mb': number(),
+        },
+        'passthrough_cache_ttl': number(),
+        'approx_transform_max_error': number(),
+        'cache_hips_tiles': one_of(bool(), {
+            'type': str(),
+            'wal': bool(),
+        }),
+        'raw_tile_store': one_of(bool(), {
+            'max_size_mb': number(),
+        }),
         'image': image_opts,
     }
     return spec
@@ -47,6 +47,25 @@ def register_opentelemetry():
     return otel_handler
 
 
+def warmup_kernels():
+    """ Compile (or load from the on-disk numba cache) the rendering kernels,
+        so that this cost is paid at worker start rather than by the first
+        HIPS request. Can be disabled by setting the MAPPROXY_HIPS_WARMUP
+        environment variable to NO.
+    """
+    if os.environ.get('MAPPROXY_HIPS_WARMUP', 'YES').upper() in ('NO', 'OFF', 'FALSE', '0'):
+        return
+
+    import time
+    from mapproxy_hips.service import hips as hips_service
+    from mapproxy_hips.source import hips as hips_source
+
+    start = time.time()
+    hips_service.warmup_kernels()
+    hips_source.warmup_kernels()
+    log.info('kernel warm-up: %.02f s', time.time() - start)
+
+
 def plugin_entrypoint():
     """ Entry point of the plugin, called by mapproxy """
 
@@ -94,3 +113,5 @@ def plugin_entrypoint():
 
     register_extra_demo_server_handler(extra_demo_server_handler)
     register_extra_demo_substitution_handler(extra_demo_substitution_handler)
+
+    warmup_kernels()
@@ -15,9 +15,19 @@ def hipsseed_command(args=None):
         help="MapProxy configuration.")
     parser.add_option("-l", "--layer", dest="layer", help="Layer")
     parser.add_option("-o", "--norder", dest="norder", type=int, default=3, help="Order")
+    parser.add_option("--min-order", dest="min_order", type=int,
+                      help="Minimum order (default: maximum order, or 0 with --pyramid)")
+    parser.add_option("--max-order", dest="max_order", type=int,
+                      help="Maximum order (default: value of --norder)")
+    parser.add_option("--bbox", dest="bbox",
+                      help="min_lon,min_lat,max_lon,max_lat extent to seed (default: layer extent)")
     parser.add_option("-c", "--concurrency", type="int",
                       dest="concurrency", default=10,
                       help="number of parallel processes")
+    parser.add_option("--pyramid", action="store_true", dest="pyramid", default=False,
+                      help="generate orders below the maximum one from the tiles of the order above")
+    parser.add_option("--no-prune", action="store_false", dest="prune", default=True,
+                      help="do not skip the descendants of fully transparent tiles")
 
     from mapproxy.script.util import setup_logging
     import logging
@@ -31,6 +41,22 @@ def hipsseed_command(args=None):
         parser.print_help()
         sys.exit(1)
 
+    max_order = options.max_order if options.max_order is not None else options.norder
+    min_order = options.min_order
+    if min_order is not None and min_order > max_order:
+        print('ERROR: --min-order should be lower or equal to --max-order', file=sys.stderr)
+        sys.exit(1)
+
+    bbox = None
+    if options.bbox:
+        try:
+            bbox = [float(x) for x in options.bbox.split(',')]
+        except ValueError:
+            bbox = []
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            print('ERROR: --bbox should be min_lon,min_lat,max_lon,max_lat', file=sys.stderr)
+            sys.exit(1)
+
     try:
         proxy_configuration = load_configuration(options.mapproxy_conf)
     except IOError as e:
@@ -46,5 +72,9 @@ def hipsseed_command(args=None):
             if isinstance(service, HIPSServer):
                 service.seed(options.mapproxy_conf,
                              options.layer,
-                             options.norder,
-                             options.concurrency)
+                             max_order,
+                             options.concurrency,
+                             pyramid=options.pyramid,
+                             min_order=min_order,
+                             bbox=bbox,
+                             prune=options.prune)
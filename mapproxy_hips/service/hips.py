@@ -3,11 +3,12 @@
 # Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
 
 
+from concurrent.futures import Future
 from functools import lru_cache
+from io import BytesIO, UnsupportedOperation
 from PIL import Image
 
 from mapproxy.cache.base import TileLocker
-from mapproxy.cache.file import FileCache
 from mapproxy.cache.tile import Tile
 from mapproxy.layer import MapQuery
 from mapproxy.request.wms import WMSMapRequest, WMSMapRequestParams
@@ -15,16 +16,27 @@ from mapproxy.response import Response
 from mapproxy.service.base import Server
 from mapproxy.service.wms import LayerRenderer
 from mapproxy.srs import SRS
+from mapproxy.util.times import parse_httpdate
 from mapproxy.image import ImageSource, img_to_buf
 from mapproxy.image.merge import LayerMerger
 from mapproxy.image.opts import ImageOptions
-from mapproxy_hips.util.hips import hp_subpixel_to_axis_coord, hp_boundaries_lonlat, healpix_resolution_degree
-from mapproxy_hips.util.resampling import bilinear_resample, bicubic_resample, has_numba
-import healpy as hp
+from mapproxy_hips.util.hips import hp_pix2ang_array, hp_subpixel_to_axis_coord_array, hips_tile_from_children, hp_tiles_in_bbox
+from mapproxy_hips.util.empty_tiles import EmptyTileIndex
+from mapproxy_hips.util.geometry import HIPSTileGeometryCache
+from mapproxy_hips.util.parallel import run_in_strips
+from mapproxy_hips.util.tile_cache import HIPSTileCacheBackend
+from mapproxy_hips.util.resampling import bilinear_resample, bicubic_resample, has_numba, \
+                                          resample_channels, resampling_buffers, \
+                                          resampling_mode, RESAMPLING_NEAREST
 import numpy as np
+import contextlib
+import datetime
+import hashlib
 import math
 import logging
 import os
+import tempfile
+import threading
 
 log_hips = logging.getLogger('mapproxy.hips')
 
@@ -32,7 +44,7 @@ if has_numba:
     from numba import jit
 else:
     class jit(object):
-        def __init__(self, nopython = True, nogil = True):
+        def __init__(self, nopython = True, nogil = True, cache = False):
             pass
 
         def __call__(self, f):
@@ -42,7 +54,107 @@ else:
 @lru_cache()
 def subpixel_to_axis_coord_array(hips_shift, tile_size):
     """ Return the array of (x,y) pixel coordinates for HIPS pixels 0...tile_size^2-1 at order hips_shift """
-    return np.array([hp_subpixel_to_axis_coord(hips_shift, i) for i in range (tile_size*tile_size)])
+    x, y = hp_subpixel_to_axis_coord_array(hips_shift, np.arange(tile_size * tile_size, dtype=np.int64))
+    return np.ascontiguousarray(np.stack((x, y), axis=1))
+
+@jit(nopython=True, nogil=True, cache=True)
+def _create_hips_tile_image(source_image, hips_tile_ar, coord_array, lon, lat,
+                            wrap_long_to_m180_180,
+                            src_image_left, src_image_top,
+                            src_image_xres, src_image_yres,
+                            resampling,
+                            src_to_tgt_scaling_x, src_to_tgt_scaling_y):
+    """ Fill hips_tile_ar by resampling source_image, a geographic image whose
+        top-left corner is (src_image_left, src_image_top) and resolution
+        (src_image_xres, src_image_yres), at the (lon, lat) positions of
+        the HealPIX pixels of the tile.
+
+        resampling is one of the RESAMPLING_xxx constants of
+        mapproxy_hips.util.resampling.
+    """
+    src_height = source_image.shape[0]
+    src_width = source_image.shape[1]
+    num_channels = hips_tile_ar.shape[2]
+    resampled = np.empty(num_channels, dtype=np.float64)
+    tab_weightX, acc = resampling_buffers(resampling, src_to_tgt_scaling_x, num_channels, resampled)
+    for i in range(coord_array.shape[0]):
+        x = coord_array[i, 0]
+        y = coord_array[i, 1]
+        # The axis of the image are swapped compared to the HealPIX ones
+        y, x = x, y
+        lon_i = lon[i]
+        if wrap_long_to_m180_180:
+            lon_i = lon_i if lon_i <= 180 else lon_i - 360
+
+        src_x_float = (lon_i - src_image_left) / src_image_xres
+        src_y_float = (lat[i] - src_image_top) / -src_image_yres
+        if resampling == RESAMPLING_NEAREST:
+            src_x = int(src_x_float)
+            src_y = int(src_y_float)
+            if src_x >= 0 and src_x < src_width and \
+               src_y >= 0 and src_y < src_height:
+                hips_tile_ar[y, x] = source_image[src_y, src_x]
+        else:
+            # -0.5 to go from center-of-pixel to array indices,
+            # as pix2ang computed coordinates of center of pixel
+            src_x_float -= 0.5
+            src_y_float -= 0.5
+            if src_x_float >= 0 and src_x_float < src_width and \
+               src_y_float >= 0 and src_y_float < src_height:
+                resample_channels(resampling, source_image, src_x_float, src_y_float,
+                                  src_to_tgt_scaling_x, src_to_tgt_scaling_y,
+                                  tab_weightX, acc, resampled)
+                for k in range(num_channels):
+                    hips_tile_ar[y,x,k] = max(0,min(255,int(resampled[k] + 0.5)))
+
+
+def warmup_kernels(tile_size=4):
+    """ Compile (or load from the on-disk numba cache) the tile generation
+        kernel for each resampling method, so that the first HIPS tile request
+        served by a worker does not pay the compilation cost.
+    """
+    source_image = np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
+    hips_tile_ar = np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
+    coord_array = subpixel_to_axis_coord_array(int(math.log2(tile_size)), tile_size)
+    lonlat = np.zeros(tile_size * tile_size, dtype=np.float64)
+    for resampling_method in ('nearest_neighbour', 'bilinear', 'bicubic'):
+        _create_hips_tile_image(source_image, hips_tile_ar, coord_array, lonlat, lonlat,
+                                True, 0.0, 0.0, 1.0, 1.0,
+                                resampling_mode(resampling_method), 1.0, 1.0)
+    hp_pix2ang_array(0, np.zeros(1, dtype=np.int64))
+
+
+class _HIPSTileContent(object):
+    """ Encoded content of a HIPS tile.
+
+        - bufs: dictionary mapping file extensions (png, jpg) to bytes
+        - is_empty: whether the tile is known to be fully transparent
+    """
+
+    def __init__(self, bufs, is_empty=False):
+        self.bufs = bufs
+        self.is_empty = is_empty
+
+
+def _image_opts(ext):
+    """ Return the ImageOptions for a tile file extension (png or jpg) """
+    return ImageOptions(format = 'png' if ext == 'png' else 'jpeg')
+
+
+# Number of tiles seeded, and stored, at once by a seeding process
+SEED_CHUNK_SIZE = 64
+
+# Number of lookups between two logs of the statistics of the hot tile cache
+HOT_TILE_CACHE_STATS_INTERVAL = 10000
+
+
+@lru_cache()
+def _empty_tile_buffer(ext, tile_size):
+    """ Return the encoded content of a fully transparent tile, shared by
+        all empty tiles """
+    img = Image.fromarray(np.zeros((tile_size, tile_size, 4), dtype=np.uint8), mode='RGBA')
+    return img_to_buf(img, _image_opts(ext)).read()
+
 
 @lru_cache()
 def get_hipsserver(mapproxy_conf):
@@ -67,56 +179,9 @@ def _allsky_task(arg):
 
 def _seed_task(arg):
     """ Worker function for multiprocessing generation of tiles """
-    mapproxy_conf, layer_name, norder, shift, npix = arg
+    mapproxy_conf, layer_name, norder, npix_list, pyramid = arg
     service = get_hipsserver(mapproxy_conf)
-
-    cache_dir = os.path.join(service.cache_dir, layer_name, str(norder))
-
-    tile_formats = service._get_hips_tile_format(layer_name)
-    has_png = 'png' in tile_formats
-    has_jpeg = 'jpeg' in tile_formats
-
-    # Check if the requested tile is already cached
-    is_cached_png = False
-    is_cached_jpg = False
-
-    if has_png:
-        cache_png = FileCache(cache_dir, 'png')
-        locker_png = TileLocker(service.lock_dir, service.lock_timeout, cache_png.lock_cache_id)
-        tile_png = Tile([norder, npix, 0])
-        with locker_png.lock(tile_png):
-            if cache_png.is_cached(tile_png):
-                is_cached_png = True
-        img_opts_png = ImageOptions(format = 'png')
-
-    if has_jpeg:
-        cache_jpg = FileCache(cache_dir, 'jpg')
-        locker_jpg = TileLocker(service.lock_dir, service.lock_timeout, cache_jpg.lock_cache_id)
-        tile_jpg = Tile([norder, npix, 0])
-        with locker_jpg.lock(tile_jpg):
-            if cache_jpg.is_cached(tile_jpg):
-                is_cached_jpg = True
-        img_opts_jpg = ImageOptions(format = 'jpeg')
-
-    if (not has_png or is_cached_png) and (not has_jpeg or is_cached_jpg):
-        return
-
-    # print(f'Generating {npix}')
-    hips_tile_ar = service._generate_hips_tile(layer_name, norder, npix, shift)
-    num_channels = hips_tile_ar.shape[2]
-    img = Image.fromarray(hips_tile_ar, mode= 'RGBA' if num_channels == 4 else 'RGB')
-
-    if has_png:
-        with locker_png.lock(tile_png):
-            result_buf = img_to_buf(img, img_opts_png)
-            tile_png.source = ImageSource(result_buf)
-            cache_png.store_tile(tile_png)
-
-    if has_jpeg:
-        with locker_jpg.lock(tile_jpg):
-            result_buf = img_to_buf(img, img_opts_jpg)
-            tile_jpg.source = ImageSource(result_buf)
-            cache_jpg.store_tile(tile_jpg)
+    return service._seed_hips_tiles(layer_name, norder, npix_list, pyramid)
 
 
 class HIPSServer(Server):
@@ -125,7 +190,9 @@ class HIPSServer(Server):
     """
     names = ('hips',)
 
-    def __init__(self, cache_dir, lock_dir, lock_timeout, populate_cache, wms_root_layer, tile_layers, resampling_method):
+    def __init__(self, cache_dir, lock_dir, lock_timeout, populate_cache, wms_root_layer, tile_layers, resampling_method,
+                 geometry_cache=None, render_threads=1, pyramid=False, empty_tile_status=200,
+                 hot_tile_cache=None, tile_cache_backend=None, generate_on_head=False):
         Server.__init__(self)
         self.cache_dir = cache_dir
         self.lock_dir = lock_dir
@@ -144,6 +211,32 @@ class HIPSServer(Server):
             self.resample_func = bicubic_resample
         else:
             assert False, self.resampling_method
+        self.resampling = resampling_mode(self.resampling_method)
+        self.geometry_cache = geometry_cache if geometry_cache else HIPSTileGeometryCache()
+        # Number of threads used to render a single tile
+        self.render_threads = render_threads
+        # Whether to build tiles from their cached children
+        self.pyramid = pyramid
+        # HTTP status of responses to requests of empty tiles: 200 to return
+        # an empty image, 204 or 404
+        self.empty_tile_status = empty_tile_status
+        # Whether HEAD requests of tiles that are not cached generate them,
+        # rather than being answered without validators
+        self.generate_on_head = generate_on_head
+        self._empty_tile_indexes = {}
+        # Optional LRUCache of the encoded content of tiles and Allsky files,
+        # indexed by (layer_name, norder, npix or 'Allsky', ext)
+        self.hot_tile_cache = hot_tile_cache
+        # (text, timestamp) of the /properties file of layers, built once
+        self._properties = {}
+        self.tile_cache_backend = tile_cache_backend if tile_cache_backend else HIPSTileCacheBackend()
+        # Cache and generation TileLocker objects, indexed by
+        # (layer_name, norder, ext) and (layer_name, norder)
+        self._tile_caches = {}
+        self._generation_lockers = {}
+        # Futures of the tiles being generated, indexed by (layer_name, norder, npix)
+        self._tiles_in_flight = {}
+        self._tiles_in_flight_lock = threading.Lock()
 
 
     def _get_hips_md(self, layer_name):
@@ -184,16 +277,30 @@ class HIPSServer(Server):
         return None
 
 
-    def handleProperties(self, layer_name):
+    def handleProperties(self, layer_name, req=None):
         """ Handle a request for the /properties file """
 
         hips_source = self._get_hips_source(layer_name)
         if hips_source and self._get_hips_md(layer_name).get('passthrough_properties', True):
-            return hips_source.load_properties()
+            return self._passthrough_response(req, layer_name, hips_source.load_properties(), 'text/plain')
+
+        properties = self._properties.get(layer_name)
+        if properties is None:
+            properties = self._properties.setdefault(layer_name, self._build_properties(layer_name))
+        s, timestamp = properties
+
+        resp = Response(s, content_type='text/plain', status=200)
+        return self._make_cacheable(req, layer_name, resp, timestamp, [s])
+
 
-        import datetime
+    def _build_properties(self, layer_name):
+        """ Return the (text, timestamp) of the /properties file of a layer,
+            where timestamp is the one of hips_release_date, if it can be parsed """
 
         hips_md = self._get_hips_md(layer_name)
+        release_date = hips_md.get('hips_release_date')
+        if release_date is None:
+            release_date = self._get_default_release_date(layer_name)
 
         # Required properties
         properties = {
@@ -201,7 +308,7 @@ class HIPSServer(Server):
             'obs_title': hips_md.get('obs_title', self.layers[layer_name].title),
             'dataproduct_type': 'image',
             'hips_version': '1.4',
-            'hips_release_date': hips_md.get('hips_release_date', datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')),
+            'hips_release_date': release_date,
             'hips_status': hips_md.get('hips_status', 'public master clonableOnce'),
             'hips_tile_format' : self._get_hips_tile_format(layer_name),
             'hips_order': hips_md.get('hips_order', '5'),
@@ -212,7 +319,7 @@ class HIPSServer(Server):
 
         # Add other keys from metadata
         for key in hips_md:
-            if key not in properties and key != 'passthrough':
+            if key not in properties and key not in ('passthrough', 'cache_max_age'):
                 properties[key] = hips_md[key]
 
         # Format response as key=value pair lines
@@ -220,7 +327,50 @@ class HIPSServer(Server):
         for key in properties:
             s += key + '=' + str(properties[key]) + '\n'
 
-        return Response(s, content_type='text/plain', status=200)
+        timestamp = None
+        for date_format in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%MZ'):
+            try:
+                timestamp = int(datetime.datetime.strptime(str(release_date), date_format)
+                                .replace(tzinfo=datetime.timezone.utc).timestamp())
+                break
+            except ValueError:
+                pass
+
+        return s, timestamp
+
+
+    def _get_default_release_date(self, layer_name):
+        """ Return the hips_release_date of a layer without one in its metadata.
+
+            It is the date at which it has been first requested, persisted in
+            the hips_release_date file of the layer cache directory, so that
+            it is the same for all processes and restarts.
+        """
+
+        filename = os.path.join(self.cache_dir, layer_name, 'hips_release_date')
+        try:
+            with open(filename, 'rt') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            pass
+
+        release_date = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+            with os.fdopen(fd, 'wt') as f:
+                f.write(release_date + '\n')
+            try:
+                # Unlike rename, fails if another process created the file first
+                os.link(tmp_filename, filename)
+            except FileExistsError:
+                with open(filename, 'rt') as f:
+                    release_date = f.read().strip()
+            finally:
+                os.unlink(tmp_filename)
+        except OSError as e:
+            log_hips.warning('cannot store hips_release_date in %s: %s', filename, e)
+        return release_date
 
 
     def handleAllSky(self, req, layer_name, norder_arg, allskyFilename):
@@ -228,19 +378,36 @@ class HIPSServer(Server):
 
         hips_source = self._get_hips_source(layer_name)
         if hips_source:
-            return hips_source.load_allsky(req, norder_arg[len("Norder"):])
+            resource, content_type = hips_source.load_allsky(norder_arg[len("Norder"):])
+            return self._passthrough_response(req, layer_name, resource, content_type)
 
         cache_dir = os.path.join(self.cache_dir, layer_name, norder_arg)
         cache_filename = os.path.join(cache_dir, allskyFilename)
         ext = allskyFilename.split('.')[1]
-        if os.path.exists(cache_filename):
-            img_opts = ImageOptions(format = 'png' if ext == 'png' else 'jpeg')
-            content_type = img_opts.format.mime_type
+        img_opts = ImageOptions(format = 'png' if ext == 'png' else 'jpeg')
+        content_type = img_opts.format.mime_type
 
+        try:
+            stat = os.stat(cache_filename)
+        except FileNotFoundError:
+            stat = None
+
+        if stat is not None:
+            hot_key = (layer_name, norder_arg[len('Norder'):], 'Allsky', ext)
             if req.environ['REQUEST_METHOD'] == 'HEAD':
-                return Response(None, status=200, content_type=content_type)
-            resp = Response(open(cache_filename, 'rb'), content_type=content_type)
-            return resp
+                body = None
+            elif self.hot_tile_cache is not None:
+                buf = self._get_hot_tile(hot_key)
+                if buf is None:
+                    with open(cache_filename, 'rb') as f:
+                        buf = f.read()
+                    self.hot_tile_cache.put(hot_key, buf)
+                body = BytesIO(buf)
+            else:
+                body = open(cache_filename, 'rb')
+            resp = Response(body, status=200, content_type=content_type)
+            return self._make_cacheable(req, layer_name, resp, int(stat.st_mtime),
+                                        [layer_name, norder_arg, allskyFilename, stat.st_mtime_ns, stat.st_size])
 
         return Response('Allsky requests should be pre-generated with mapproxy-util hips-allsky', content_type='text/plain', status=404)
 
@@ -277,7 +444,7 @@ class HIPSServer(Server):
             return layer_check_response
 
         if len(path_components) == 4 and path_components[3] == 'properties':
-            return self.handleProperties(layer_name)
+            return self.handleProperties(layer_name, req)
 
         norder_arg = path_components[3]
         if not norder_arg.startswith('Norder'):
@@ -322,38 +489,478 @@ class HIPSServer(Server):
         if dir_num != (npix // 10000) * 10000:
             return Response(f'Bath path for /hips. Inconsistent Dir and Npix', content_type='text/plain', status=404)
 
-        img_opts = ImageOptions(format = 'png' if ext == 'png' else 'jpeg')
+        hot_key = (layer_name, norder, npix, ext)
+        buf = None
+        if self.hot_tile_cache is not None:
+            buf = self._get_hot_tile(hot_key)
+
+        if buf is None and self._get_empty_tile_index(layer_name).is_empty(norder, npix):
+            return self._empty_tile_response(req, layer_name, ext)
+
+        # Cache hits are streamed from the stored file, through
+        # wsgi.file_wrapper when available, without decoding it
+        tile_file = None
+        if buf is None:
+            tile_file = self._open_cached_tile(layer_name, norder, npix, ext)
+            if tile_file is not None and self.hot_tile_cache is not None:
+                with tile_file:
+                    buf = tile_file.read()
+                tile_file = None
+                self.hot_tile_cache.put(hot_key, buf)
+
+        if buf is None and tile_file is None:
+            if req.environ['REQUEST_METHOD'] == 'HEAD' and not self.generate_on_head:
+                # Answered without generating the tile. Whether it is empty,
+                # and its validators and size, are not known yet.
+                return Response(None, content_type=_image_opts(ext).format.mime_type)
+            content = self._get_hips_tile_content(layer_name, norder, npix, ext, self.populate_cache, self.pyramid)
+            if content.is_empty:
+                return self._empty_tile_response(req, layer_name, ext)
+            buf = content.bufs[ext]
+            if self.hot_tile_cache is not None:
+                self.hot_tile_cache.put(hot_key, buf)
+
+        return self._tile_response(req, layer_name, norder, npix, ext, tile_file, buf)
+
+
+    def _tile_response(self, req, layer_name, norder, npix, ext, tile_file, buf):
+        """ Return the Response of a tile, whose content is either the tile_file
+            file object or the buf bytes, with cache validators.
+
+            The ETag is derived from the modification time and size of the
+            cached file when there is one, so that it does not require reading
+            it, and from the content otherwise.
+        """
+
+        stat = None
+        if tile_file is not None:
+            try:
+                stat = os.fstat(tile_file.fileno())
+            except (AttributeError, UnsupportedOperation):
+                # Not a file (SQLite-based cache)
+                buf = tile_file.read()
+                tile_file.close()
+                tile_file = None
+        else:
+            stat = self.tile_cache_backend.stat_tile(self._get_tile_cache(layer_name, norder, ext), norder, npix)
+
+        if stat is not None:
+            timestamp = int(stat.st_mtime)
+            etag_data = [layer_name, norder, npix, ext, stat.st_mtime_ns, stat.st_size]
+            size = stat.st_size
+        else:
+            timestamp = None
+            etag_data = [hashlib.md5(buf).hexdigest()]
+            size = len(buf)
+
+        if req.environ['REQUEST_METHOD'] == 'HEAD':
+            if tile_file is not None:
+                tile_file.close()
+            body = None
+        else:
+            body = tile_file if tile_file is not None else BytesIO(buf)
+        resp = Response(body, content_type=_image_opts(ext).format.mime_type)
+        if body is None:
+            resp.headers['Content-length'] = str(size)
+        return self._make_cacheable(req, layer_name, resp, timestamp, etag_data)
+
+
+    def _empty_tile_response(self, req, layer_name, ext):
+        """ Return the Response of an empty tile, according to empty_tile_status """
+
+        if self.empty_tile_status == 204:
+            resp = Response(None, status=204)
+            del resp.headers['Content-type']
+            return resp
+        if self.empty_tile_status == 404:
+            return Response('Empty tile', content_type='text/plain', status=404)
+
+        tile_size = 1 << self._get_hips_shift(layer_name)
+        buf = _empty_tile_buffer(ext, tile_size)
+        body = None if req.environ['REQUEST_METHOD'] == 'HEAD' else BytesIO(buf)
+        resp = Response(body, content_type=_image_opts(ext).format.mime_type)
+        if body is None:
+            resp.headers['Content-length'] = str(len(buf))
+        return self._make_cacheable(req, layer_name, resp, None, ['empty', ext, tile_size])
+
+
+    def _passthrough_response(self, req, layer_name, resource, content_type):
+        """ Return the Response of a file of the HIPS source of a layer, from
+            its HTTPResource, with cache validators.
+
+            The ETag is derived from the one of the source when it returned
+            one, and from the content otherwise. The Last-Modified header is
+            the one of the source, or the time it was downloaded.
+        """
+
+        timestamp = parse_httpdate(resource.last_modified) if resource.last_modified else None
+        if timestamp is None:
+            timestamp = resource.fetch_time
+        if resource.etag:
+            etag_data = [layer_name, resource.etag]
+        else:
+            etag_data = [hashlib.md5(resource.body).hexdigest()]
+
+        body = None if req is not None and req.environ['REQUEST_METHOD'] == 'HEAD' else resource.body
+        resp = Response(body, content_type=content_type)
+        if body is None:
+            resp.headers['Content-length'] = str(len(resource.body))
+        return self._make_cacheable(req, layer_name, resp, int(timestamp), etag_data)
+
+
+    def _make_cacheable(self, req, layer_name, resp, timestamp, etag_data):
+        """ Set the ETag, Last-Modified and Cache-Control headers of a
+            response, and turn it into a 304 Not Modified response if the
+            If-None-Match or If-Modified-Since headers of the request match.
+
+            timestamp must be a whole number of seconds, as it is compared
+            to the one of If-Modified-Since.
+        """
+
+        # Response.cache_headers() only accepts ASCII etag_data
+        etag_src = ''.join(str(x) for x in etag_data).encode('UTF-8')
+        resp.cache_headers(timestamp=timestamp, etag_data=[hashlib.md5(etag_src).hexdigest()],
+                           max_age=self._get_hips_md(layer_name).get('cache_max_age'))
+        body = resp.response
+        resp.make_conditional(req)
+        if resp.status.startswith('304') and hasattr(body, 'close'):
+            body.close()
+        return resp
+
+
+    def _get_hot_tile(self, key):
+        """ Return the content of a tile or Allsky file from hot_tile_cache,
+            or None. Its statistics are logged every HOT_TILE_CACHE_STATS_INTERVAL
+            lookups """
+
+        buf = self.hot_tile_cache.get(key)
+        stats = self.hot_tile_cache.stats()
+        if (stats['hits'] + stats['misses']) % HOT_TILE_CACHE_STATS_INTERVAL == 0:
+            log_hips.info('Hot tile cache: %d hits, %d misses, %d evictions, %d entries, %d/%d bytes',
+                          stats['hits'], stats['misses'], stats['evictions'],
+                          stats['entries'], stats['size'], stats['max_size'])
+        return buf
+
+
+    def prewarm_hot_tile_cache(self, max_order):
+        """ Load the cached tiles of orders 0 to max_order, and the Allsky
+            files, of all layers in hot_tile_cache """
+
+        if self.hot_tile_cache is None:
+            return
+        for layer_name in self.layers:
+            if self._get_hips_source(layer_name) or not self._get_hips_md(layer_name).get('enabled', True):
+                continue
+            # Lowest orders loaded last, so that they are evicted last
+            for norder in range(max_order, -1, -1):
+                for ext in ('png', 'jpg'):
+                    filename = os.path.join(self.cache_dir, layer_name, 'Norder%d' % norder, 'Allsky.' + ext)
+                    try:
+                        with open(filename, 'rb') as f:
+                            self.hot_tile_cache.put((layer_name, str(norder), 'Allsky', ext), f.read())
+                    except FileNotFoundError:
+                        pass
+                    for npix in range(12 << (2 * norder)):
+                        tile_file = self._open_cached_tile(layer_name, norder, npix, ext)
+                        if tile_file is not None:
+                            with tile_file:
+                                self.hot_tile_cache.put((layer_name, norder, npix, ext), tile_file.read())
+        stats = self.hot_tile_cache.stats()
+        log_hips.info('Hot tile cache pre-warmed with %d entries (%d bytes)', stats['entries'], stats['size'])
+
+
+    def _get_tile_cache(self, layer_name, norder, ext):
+        """ Return the MapProxy cache (FileCache by default, see
+            HIPSTileCacheBackend) for the tiles of layer_name at order norder,
+            in the ext (png or jpg) format.
+
+            Reading it requires no lock, as tiles are written to a temporary
+            file which is then renamed (see FileCache.store_tile()), or in
+            a SQLite transaction.
+        """
+
+        key = (layer_name, norder, ext)
+        cache = self._tile_caches.get(key)
+        if cache is None:
+            cache_dir = os.path.join(self.cache_dir, layer_name, 'Norder%d' % norder)
+            cache = self._tile_caches.setdefault(key, self.tile_cache_backend.create_cache(cache_dir, ext))
+        return cache
+
+
+    def _get_generation_locker(self, layer_name, norder):
+        """ Return the TileLocker held while generating a tile of layer_name
+            at order norder, whatever its format """
+
+        key = (layer_name, norder)
+        locker = self._generation_lockers.get(key)
+        if locker is None:
+            cache_dir = os.path.join(self.cache_dir, layer_name, 'Norder%d' % norder)
+            lock_cache_id = 'hips-' + hashlib.md5(cache_dir.encode('UTF-8')).hexdigest()
+            locker = self._generation_lockers.setdefault(
+                key, TileLocker(self.lock_dir, self.lock_timeout, lock_cache_id))
+        return locker
+
+
+    def _get_hips_tile_exts(self, layer_name):
+        """ Return the file extensions of the formats of hips_tile_format """
+
+        tile_formats = self._get_hips_tile_format(layer_name)
+        exts = []
+        if 'png' in tile_formats:
+            exts.append('png')
+        if 'jpeg' in tile_formats:
+            exts.append('jpg')
+        return exts
+
+
+    def _get_empty_tile_index(self, layer_name):
+        """ Return the EmptyTileIndex of a layer """
+
+        index = self._empty_tile_indexes.get(layer_name)
+        if index is None:
+            index = EmptyTileIndex(os.path.join(self.cache_dir, layer_name),
+                                   self.lock_dir, self.lock_timeout)
+            index = self._empty_tile_indexes.setdefault(layer_name, index)
+        return index
+
+
+    def _get_empty_tile_content(self, layer_name, ext):
+        """ Return the _HIPSTileContent of an empty tile of a layer """
+
+        tile_size = 1 << self._get_hips_shift(layer_name)
+        return _HIPSTileContent({ext: _empty_tile_buffer(ext, tile_size)}, True)
+
+
+    def _is_tile_cached(self, layer_name, norder, npix, ext):
+        if self._get_empty_tile_index(layer_name).is_empty(norder, npix):
+            return True
+        cache = self._get_tile_cache(layer_name, norder, ext)
+        return cache.is_cached(self.tile_cache_backend.tile(norder, npix))
+
+
+    def _open_cached_tile(self, layer_name, norder, npix, ext):
+        """ Return a binary file object opened on a cached tile, or None if it
+            is not cached """
+
+        cache = self._get_tile_cache(layer_name, norder, ext)
+        return self.tile_cache_backend.open_tile(cache, norder, npix)
+
+
+    def _load_cached_tile(self, layer_name, norder, npix, ext):
+        """ Return the _HIPSTileContent of a cached tile, or None if it is not cached """
+
+        if self._get_empty_tile_index(layer_name).is_empty(norder, npix):
+            return self._get_empty_tile_content(layer_name, ext)
+
+        tile_file = self._open_cached_tile(layer_name, norder, npix, ext)
+        if tile_file is not None:
+            with tile_file:
+                return _HIPSTileContent({ext: tile_file.read()})
+        return None
+
+
+    def _get_hips_tile_content(self, layer_name, norder, npix, ext, populate_cache, pyramid=False,
+                               pending_tiles=None):
+        """ Return a _HIPSTileContent with the content of a HIPS tile in
+            (at least) the ext format, from the cache, or by generating it.
+
+            Concurrent requests for the same tile, whatever their format, are
+            coalesced: within this process, by waiting for the generation
+            started by the first request, and across processes, by holding
+            a tile lock during the generation.
+
+            If pyramid is set, and the 4 children of the tile are cached,
+            the tile is built from them rather than from the source.
+
+            If pending_tiles is set, generated tiles are not stored, but
+            appended to pending_tiles (see _store_hips_tile()).
+        """
+
+        content = self._load_cached_tile(layer_name, norder, npix, ext)
+        if content is not None:
+            return content
+
+        key = (layer_name, norder, npix)
+        with self._tiles_in_flight_lock:
+            future = self._tiles_in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._tiles_in_flight[key] = future
+
+        if not is_owner:
+            content = future.result()
+            if ext in content.bufs:
+                return content
+            # The tile has been generated by another process, but not in
+            # the requested format, or has not been cached in it.
+            return self._get_hips_tile_content(layer_name, norder, npix, ext, populate_cache, pyramid,
+                                               pending_tiles)
+
+        try:
+            if populate_cache:
+                locker = self._get_generation_locker(layer_name, norder)
+                tile = Tile([norder, npix, 0])
+                with locker.lock(tile):
+                    # Another process may have generated the tile while we
+                    # were waiting for the lock
+                    content = self._load_cached_tile(layer_name, norder, npix, ext)
+                    if content is None:
+                        content = self._generate_and_cache_hips_tile(layer_name, norder, npix, ext, populate_cache,
+                                                                     pyramid, pending_tiles)
+            else:
+                content = self._generate_and_cache_hips_tile(layer_name, norder, npix, ext, populate_cache, pyramid)
+            future.set_result(content)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._tiles_in_flight_lock:
+                del self._tiles_in_flight[key]
+
+        return content
+
+
+    def _generate_and_cache_hips_tile(self, layer_name, norder, npix, ext, populate_cache, pyramid,
+                                      pending_tiles=None):
+        """ Generate a HIPS tile and return a _HIPSTileContent with its encoded
+            content, in ext and the formats of hips_tile_format.
+            If populate_cache is set, those are also stored in the cache, or
+            appended to pending_tiles if set.
+        """
+
+        if ext == 'jpg':
+            # Transcode the PNG tile, if cached, rather than generating it
+            # again. The reverse is not done, as a PNG tile decoded from
+            # JPEG would differ from the generated one.
+            tile_file = self._open_cached_tile(layer_name, norder, npix, 'png')
+            if tile_file is not None:
+                with tile_file:
+                    img = Image.open(tile_file)
+                    img.load()
+                bufs = {ext: img_to_buf(img, _image_opts(ext)).read()}
+                if populate_cache:
+                    self._store_hips_tile(layer_name, norder, npix, ext, bufs[ext], pending_tiles)
+                return _HIPSTileContent(bufs)
+
+        exts = [ext] + [x for x in self._get_hips_tile_exts(layer_name) if x != ext]
 
-        # Check if the requested tile is already cached
-        cache_dir = os.path.join(self.cache_dir, layer_name, norder_arg)
-        cache = FileCache(cache_dir, ext)
-        locker = TileLocker(self.lock_dir, self.lock_timeout, cache.lock_cache_id)
-        tile = Tile([norder, npix, 0])
-        with locker.lock(tile):
-            if cache.is_cached(tile):
-                if cache.load_tile(tile):
-                    img = tile.source_image()
-                    if img:
-                        resp = Response(img_to_buf(img, img_opts), content_type=img_opts.format.mime_type)
-                        return resp
-
-
-        # If not, generate it
         hips_shift = self._get_hips_shift(layer_name)
-        hips_tile_ar = self._generate_hips_tile(layer_name, norder, npix, hips_shift)
+        hips_tile_ar = None
+        if pyramid:
+            hips_tile_ar = self._build_hips_tile_from_children(layer_name, norder, npix, hips_shift)
+        if hips_tile_ar is None:
+            hips_tile_ar = self._generate_hips_tile(layer_name, norder, npix, hips_shift)
         num_channels = hips_tile_ar.shape[2]
+
+        # Encoded tiles may not have an alpha channel, hence empty tiles
+        # can only be detected from the generated array
+        if num_channels == 4 and not hips_tile_ar[:, :, 3].any():
+            # Recorded in the empty tile index rather than stored as files
+            if populate_cache:
+                self._get_empty_tile_index(layer_name).set_empty(norder, npix)
+            return self._get_empty_tile_content(layer_name, ext)
+
         img = Image.fromarray(hips_tile_ar, mode= 'RGBA' if num_channels == 4 else 'RGB')
 
-        result_buf = img_to_buf(img, img_opts)
+        bufs = {}
+        for x in exts:
+            bufs[x] = img_to_buf(img, _image_opts(x)).read()
 
-        # And cache it if that's allowed in the service configuration
-        if self.populate_cache:
-            with locker.lock(tile):
-                tile.source = ImageSource(result_buf)
-                cache.store_tile(tile)
+            if populate_cache:
+                self._store_hips_tile(layer_name, norder, npix, x, bufs[x], pending_tiles)
 
-        resp = Response(result_buf, content_type=img_opts.format.mime_type)
-        return resp
+        return _HIPSTileContent(bufs, False)
+
+
+    def _store_hips_tile(self, layer_name, norder, npix, ext, buf, pending_tiles=None):
+        """ Store the encoded content of a tile in the cache or, if
+            pending_tiles is set, append it to the list of its cache in this
+            dictionary, for _seed_hips_tiles() to store them in bulk """
+
+        # Atomic write, under the generation lock of the tile, held by
+        # _get_hips_tile_content(), or by _seed_hips_tiles() for the bulk
+        # store of pending tiles
+        tile = self.tile_cache_backend.tile(norder, npix)
+        tile.source = ImageSource(BytesIO(buf))
+        cache = self._get_tile_cache(layer_name, norder, ext)
+        if pending_tiles is not None:
+            pending_tiles.setdefault(cache, []).append(tile)
+        else:
+            cache.store_tile(tile)
+
+
+    def _load_cached_tile_array(self, layer_name, norder, npix):
+        """ Return the content of a cached tile, in whatever format it is
+            cached (PNG preferred), as a RGBA array, or None if it is not cached """
+
+        for ext in ('png', 'jpg'):
+            tile_file = self._open_cached_tile(layer_name, norder, npix, ext)
+            if tile_file is not None:
+                with tile_file:
+                    return np.asarray(Image.open(tile_file).convert('RGBA'))
+        return None
+
+
+    def _build_hips_tile_from_children(self, layer_name, norder, npix, hips_shift):
+        """ Build a HIPS tile by downsampling its 4 children at order norder+1,
+            without accessing the source. Return None if they are not all cached """
+
+        tile_size = 1 << hips_shift
+        index = self._get_empty_tile_index(layer_name)
+        children = []
+        for c in range(4):
+            if index.is_empty(norder + 1, 4 * npix + c):
+                children.append(np.zeros((tile_size, tile_size, 4), dtype=np.uint8))
+                continue
+            child = self._load_cached_tile_array(layer_name, norder + 1, 4 * npix + c)
+            if child is None or child.shape[0:2] != (tile_size, tile_size):
+                return None
+            children.append(child)
+        return hips_tile_from_children(children)
+
+
+    def _seed_hips_tiles(self, layer_name, norder, npix_list, pyramid=False):
+        """ Seed a list of HIPS tiles of order norder with _seed_hips_tile(),
+            and store them in bulk (in a single transaction per format, for
+            SQLite-based caches).
+            Return the list of booleans indicating which tiles are empty.
+
+            Each tile is generated under its own generation lock, as for
+            requests. The generation locks of the tiles are taken again only
+            for their bulk store, in increasing npix order to avoid deadlocks
+            with other seeding processes. A request waiting for the lock of
+            one of them after its generation may thus generate it again, but
+            never waits for the generation of the whole chunk.
+        """
+
+        pending_tiles = {}
+        try:
+            return [self._seed_hips_tile(layer_name, norder, npix, pyramid, pending_tiles) for npix in npix_list]
+        finally:
+            if pending_tiles:
+                locker = self._get_generation_locker(layer_name, norder)
+                with contextlib.ExitStack() as locks:
+                    for npix in sorted(set(npix_list)):
+                        locks.enter_context(locker.lock(Tile([norder, npix, 0])))
+                    for cache, tiles in pending_tiles.items():
+                        cache.store_tiles(tiles)
+
+
+    def _seed_hips_tile(self, layer_name, norder, npix, pyramid=False, pending_tiles=None):
+        """ Generate and cache a HIPS tile in the formats of hips_tile_format,
+            if not already cached (or append it to pending_tiles, see
+            _store_hips_tile()).
+            Return True if the tile is empty (fully transparent).
+        """
+
+        # The generation of a tile in one format stores it in the other
+        # ones of hips_tile_format
+        missing_exts = [ext for ext in self._get_hips_tile_exts(layer_name)
+                        if not self._is_tile_cached(layer_name, norder, npix, ext)]
+        if missing_exts:
+            self._get_hips_tile_content(layer_name, norder, npix, missing_exts[0], True, pyramid, pending_tiles)
+        return self._get_empty_tile_index(layer_name).is_empty(norder, npix)
 
 
     def generate_allsky_file(self, mapproxy_conf, layer_name, norder, concurrency):
@@ -424,34 +1031,109 @@ class HIPSServer(Server):
         open(os.path.join(cache_dir, "Allsky.jpg"), "wb").write(result_buf.read())
 
 
-    def seed(self, mapproxy_conf, layer_name, norder, concurrency):
-        """ Generate all HIPS tiles of a give Norder.
+    def seed(self, mapproxy_conf, layer_name, norder, concurrency, pyramid=False,
+             min_order=None, bbox=None, prune=True):
+        """ Generate all HIPS tiles of orders min_order to norder, that
+            intersect the coverage of the layer.
             This method is used by the mapproxy-util hips-seed utility.
 
             :param mapproxy_conf: Configuration file name.
             :param layer_name: Name of the layer to generate.
-            :param norder: Norder to generate, generally in the [0-3] range.
+            :param norder: Maximum Norder to generate.
             :param concurrency: Number of concurrent processes to use for the generation.
+            :param pyramid: If set, orders below norder are generated, from
+                            the highest one to min_order, by downsampling the
+                            tiles of the order immediately above.
+            :param min_order: Minimum Norder to generate. Defaults to norder,
+                              or 0 if pyramid is set.
+            :param bbox: (min_lon, min_lat, max_lon, max_lat) geographic
+                         extent to generate. Defaults to the extent of the layer.
+            :param prune: If set, and pyramid is not, orders are generated from
+                          min_order to norder, and the descendants of fully
+                          transparent tiles are skipped.
         """
 
-        # Basic HIPS parameters
-        nside = 1 << norder
-        ntiles = 12 * nside * nside
-        shift = self.hips_shift
+        if min_order is None:
+            min_order = 0 if pyramid else norder
+        if bbox is None:
+            bbox = self._get_layer_lonlat_bbox(layer_name)
+
+        if pyramid:
+            tiles = self._get_seed_tiles(norder, bbox)
+            self._seed_order(mapproxy_conf, layer_name, norder, tiles, concurrency, False)
+            for order in range(norder - 1, min_order - 1, -1):
+                # Parents of the tiles of the order immediately above
+                tiles = np.unique(tiles >> 2)
+                self._seed_order(mapproxy_conf, layer_name, order, tiles, concurrency, True)
+            return
+
+        tiles = self._get_seed_tiles(min_order, bbox)
+        for order in range(min_order, norder + 1):
+            if prune and order > min_order:
+                # Children of the non-empty tiles of the order immediately below
+                children = (non_empty_tiles[:, np.newaxis] * 4 + np.arange(4)).reshape(-1)
+                tiles = self._get_seed_tiles(order, bbox)
+                tiles = np.intersect1d(children, tiles)
+            elif order > min_order:
+                tiles = self._get_seed_tiles(order, bbox)
+
+            empty = self._seed_order(mapproxy_conf, layer_name, order, tiles, concurrency, False)
+            if prune:
+                # Empty tiles, including the ones recorded by a previous run
+                # in the empty tile index, are not descended into
+                non_empty_tiles = tiles[~empty]
+                log_hips.info('Pruning %d empty tiles of Norder%d', int(empty.sum()), order)
+
+
+    def _get_layer_lonlat_bbox(self, layer_name):
+        """ Return the geographic extent of a layer, or None if it is unknown """
+
+        extent = getattr(self.layers[layer_name], 'extent', None)
+        if extent is None:
+            return None
+        return extent.llbbox
+
+
+    def _get_seed_tiles(self, norder, bbox):
+        """ Return the sorted array of the tiles of order norder intersecting bbox """
+
+        if bbox is None:
+            nside = 1 << norder
+            return np.arange(12 * nside * nside, dtype=np.int64)
+        return hp_tiles_in_bbox(norder, bbox)
+
+
+    def _seed_order(self, mapproxy_conf, layer_name, norder, tiles, concurrency, pyramid):
+        """ Generate the HIPS tiles of a give Norder. See seed().
+            Return a boolean array indicating which tiles are empty.
+        """
+
+        ntiles = len(tiles)
+        empty = np.zeros(ntiles, dtype=bool)
 
+        # Tiles are seeded, and stored, by chunks of SEED_CHUNK_SIZE
+        chunks = [[int(npix) for npix in tiles[i:i + SEED_CHUNK_SIZE]]
+                  for i in range(0, ntiles, SEED_CHUNK_SIZE)]
+
+        log_hips.info('Seeding %d tiles of Norder%d', ntiles, norder)
         if concurrency > 1:
             from multiprocessing import Pool
             with Pool(processes=concurrency) as pool:
-                it = pool.imap(_seed_task, [(mapproxy_conf, layer_name, norder, shift, npix) for npix in range(ntiles)])
-                i = 0
-                for _ in it:
-                    i += 1
-                    print('Seeding completed at %.2f %%' % (100.0 * i / ntiles))
+                it = pool.imap(_seed_task, [(mapproxy_conf, layer_name, norder, chunk, pyramid) for chunk in chunks])
+                done = 0
+                for chunk_empty in it:
+                    empty[done:done + len(chunk_empty)] = chunk_empty
+                    done += len(chunk_empty)
+                    print('Seeding completed at %.2f %%' % (100.0 * done / ntiles))
 
         else:
-            for npix in range(ntiles):
-                _seed_task((mapproxy_conf, layer_name, norder, shift, npix))
-                print('Seeding completed at %.2f %%' % (100.0 * (npix+1) / ntiles))
+            done = 0
+            for chunk in chunks:
+                empty[done:done + len(chunk)] = self._seed_hips_tiles(layer_name, norder, chunk, pyramid)
+                done += len(chunk)
+                print('Seeding completed at %.2f %%' % (100.0 * done / ntiles))
+
+        return empty
 
 
     def _generate_hips_tile(self, layer_name, norder, npix, hips_shift):
@@ -483,44 +1165,14 @@ class HIPSServer(Server):
 
         tile_size = 1 << hips_shift
 
-        # Get the coordinates of the 4 corners of our HealPIX pixel of interest
-        lon_bounds, lat_bounds = hp_boundaries_lonlat(norder, npix)
-        lon_bounds = [ x if x <= 180 else x - 360 for x in lon_bounds ]
-        # print(lon_bounds, lat_bounds)
-
-        # Do not take into account longitudes at poles
-        min_lon = float('inf')
-        max_lon = -float('inf')
-        found_lon_180 = False
-        for i in range(len(lon_bounds)):
-            if abs(lat_bounds[i]) != 90:
-                min_lon = min(min_lon, lon_bounds[i])
-                if lon_bounds[i] == 180:
-                    found_lon_180 = True
-                else:
-                    max_lon = max(max_lon, lon_bounds[i])
-
-        #for norder=0, tile=2, lon_bounds = [0.0, 180.0, -135.00000000000003, -90.0]
-        if found_lon_180:
-            if max_lon < 0:
-                min_lon = -180
-            else:
-                max_lon = 180
-
-        min_lat = min(lat_bounds)
-        max_lat = max(lat_bounds)
-
-        # Compute the angular resolution of a HealPIX pixel
-        healpix_resolution = healpix_resolution_degree(norder, tile_size)
-
-        # Compute the oversampling ratio to go from hips tile resolution
-        # to geodetic tile resolution.
-        oversampling_ratio_lat = (max_lat - min_lat) / (tile_size * healpix_resolution)
+        # Get the HealPIX geometry of the tile: coordinates of its corners
+        # and pixel centers, geographic extent and oversampling ratios
+        geometry = self.geometry_cache.get(norder, npix, hips_shift)
+        lon_bounds = geometry.lon_bounds
+        min_lon, min_lat, max_lon, max_lat = geometry.bbox
+        oversampling_ratio_lon = geometry.oversampling_ratio_lon
+        oversampling_ratio_lat = geometry.oversampling_ratio_lat
         EPSILON = 1e-5
-        if max_lon - min_lon <= 90 + EPSILON:
-            oversampling_ratio_lon = (max_lon - min_lon) / (tile_size * healpix_resolution)
-        else:
-            oversampling_ratio_lon = (lon_bounds[3] + 360 - lon_bounds[1]) / (tile_size * healpix_resolution)
 
         log_hips.debug(f'oversampling_ratio_lon = {oversampling_ratio_lon}')
         log_hips.debug(f'oversampling_ratio_lat = {oversampling_ratio_lat}')
@@ -593,12 +1245,8 @@ class HIPSServer(Server):
         src_image_xres = (max_lon - min_lon) / src_width
         src_image_yres = (max_lat - min_lat) / src_height
 
-        nside = 1 << (hips_shift + norder)
         hips_tile_ar = np.zeros((tile_size, tile_size, source_image.shape[2]), dtype=source_image.dtype)
-        healpix_pix_offset = npix * tile_size * tile_size
-        pixels = [healpix_pix_offset + i for i in range (tile_size*tile_size)]
-        lon, lat = hp.pix2ang(nside, pixels, nest=True, lonlat=True)
-        num_channels = hips_tile_ar.shape[2]
+        lon, lat = geometry.lon, geometry.lat
 
         """
         from mapproxy.util.hips import axis_coord_to_hp_subpixel
@@ -640,40 +1288,18 @@ class HIPSServer(Server):
 
         coord_array = subpixel_to_axis_coord_array(hips_shift, tile_size)
 
-        @jit(nopython=True)
-        def create_image(tile_size, source_image, hips_tile_ar, resample_func):
-            for i in range (tile_size*tile_size):
-                x, y = coord_array[i]
-                # The axis of the image are swapped compared to the HealPIX ones
-                y, x = x, y
-                lon_i = lon[i]
-                if wrap_long_to_m180_180:
-                    lon_i = lon_i if lon_i <= 180 else lon_i - 360
-
-                src_x_float = (lon_i - src_image_left) / src_image_xres
-                src_y_float = (lat[i] - src_image_top) / -src_image_yres
-                if resample_func is None:
-                    src_x = int(src_x_float)
-                    src_y = int(src_y_float)
-                    if src_x >= 0 and src_x < src_width and \
-                       src_y >= 0 and src_y < src_height:
-                        hips_tile_ar[y, x] = source_image[src_y, src_x]
-                else:
-                    # -0.5 to go from center-of-pixel to array indices,
-                    # as pix2ang computed coordinates of center of pixel
-                    src_x_float -= 0.5
-                    src_y_float -= 0.5
-                    if src_x_float >= 0 and src_x_float < src_width and \
-                       src_y_float >= 0 and src_y_float < src_height:
-                        if has_numba:
-                            # Faster to use the resample_func on scalars than numpy
-                            # arrays when using numba jit'ed functions
-                            for k in range(num_channels):
-                                hips_tile_ar[y,x,k] = max(0,min(255,int(resample_func(source_image[:,:,k], src_x_float, src_y_float, src_to_tgt_scaling_x, src_to_tgt_scaling_y) + 0.5)))
-                        else:
-                            hips_tile_ar[y,x] = np.clip(np.round_(resample_func(source_image, src_x_float, src_y_float, src_to_tgt_scaling_x, src_to_tgt_scaling_y)),0,255)
-
-        create_image(tile_size, source_image, hips_tile_ar, self.resample_func)
+        def render_strip(start, end):
+            # Strips are ranges of HealPIX pixels in NESTED order, hence
+            # they write to disjoint parts of hips_tile_ar
+            _create_hips_tile_image(source_image, hips_tile_ar,
+                                    coord_array[start:end], lon[start:end], lat[start:end],
+                                    wrap_long_to_m180_180,
+                                    float(src_image_left), float(src_image_top),
+                                    float(src_image_xres), float(src_image_yres),
+                                    self.resampling,
+                                    float(src_to_tgt_scaling_x), float(src_to_tgt_scaling_y))
+
+        run_in_strips(render_strip, coord_array.shape[0], self.render_threads)
         return hips_tile_ar
 
 
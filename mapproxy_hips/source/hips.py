@@ -9,28 +9,193 @@ from mapproxy.extent import DefaultMapExtent
 from mapproxy.layer import MapLayer
 from mapproxy.srs import SRS
 from mapproxy_hips.util import hips
-from mapproxy_hips.util.resampling import bilinear_resample, bicubic_resample, has_numba
+from mapproxy_hips.util.approx_transform import approximate_transform, pixel_center_grid
+from mapproxy_hips.util.http_cache import HTTPResourceCache
+from mapproxy_hips.util.mosaic import build_mosaic, mosaic_halo, slot_image
+from mapproxy_hips.util.parallel import map_in_threads, run_in_strips
+from mapproxy_hips.util.raw_tiles import RawTileStore
+from mapproxy_hips.util.resampling import bilinear_resample, bicubic_resample, has_numba, \
+                                          resample_channels, resampling_buffers, \
+                                          resampling_mode, RESAMPLING_NEAREST
+from functools import lru_cache
 import logging
 import math
 import numpy as np
 
 log_hips = logging.getLogger('mapproxy_hips')
 
+# Number of lookups in the decoded tile cache between two logs of its statistics
+DECODED_TILE_CACHE_STATS_INTERVAL = 10000
+
 if has_numba:
     from numba import jit
 else:
     class jit(object):
-        def __init__(self, nopython = True, nogil = True):
+        def __init__(self, nopython = True, nogil = True, cache = False):
             pass
 
         def __call__(self, f):
             return f
 
+
+@jit(nopython=True, nogil=True, cache=True)
+def _render_pixel(result_ar, j, i, pixel, dx, dy, pixel_order,
+                  mosaics, slot_layout, slot_of_face, tile_origin, tile_present, hips_shift, halo,
+                  resampling, src_to_tgt_scaling, tab_weightX, acc, resampled):
+    """ Set pixel (j, i) of result_ar from the HIPS tiles of a HIPSMosaic,
+        given the HealPIX pixel number at order pixel_order, and the
+        fractional offsets (dx, dy) within it, of its center """
+    num_channels = mosaics.shape[1]
+    slot = slot_of_face[pixel >> (2 * pixel_order)]
+    if slot < 0:
+        return
+    subpixel = pixel & ((1 << (2 * pixel_order)) - 1)
+    x = hips.compact_bits(subpixel)
+    y = hips.compact_bits(subpixel >> 1)
+    tile_row = (x >> hips_shift) - tile_origin[slot, 0]
+    tile_col = (y >> hips_shift) - tile_origin[slot, 1]
+    if tile_row < 0 or tile_col < 0 or tile_row >= tile_present.shape[1] or \
+       tile_col >= tile_present.shape[2] or tile_present[slot, tile_row, tile_col] == 0:
+        return
+
+    # The axis of the image are swapped compared to the HealPIX ones
+    row = x - (tile_origin[slot, 0] << hips_shift) + halo
+    col = y - (tile_origin[slot, 1] << hips_shift) + halo
+    source_ar = slot_image(mosaics, slot_layout, slot)
+
+    if resampling == RESAMPLING_NEAREST:
+        result_ar[j,i,0:num_channels] = source_ar[row,col]
+    else:
+        resample_channels(resampling, source_ar, col + dy, row + dx,
+                          src_to_tgt_scaling, src_to_tgt_scaling,
+                          tab_weightX, acc, resampled)
+        for k in range(num_channels):
+            result_ar[j,i,k] = max(0,min(255,int(resampled[k] + 0.5)))
+    result_ar[j,i,3] = 255
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _create_map_image(height, width,
+                      pixel_order, pixels, dx_ar, dy_ar,
+                      mosaics, slot_layout, slot_of_face, tile_origin, tile_present, hips_shift, halo,
+                      result_ar, resampling, src_to_tgt_scaling):
+    """ Fill result_ar from the HIPS tiles of a HIPSMosaic (see
+        mapproxy_hips.util.mosaic), given the HealPIX pixel number at order
+        pixel_order (pixels) and the fractional offsets within it
+        (dx_ar, dy_ar) of the center of each target pixel.
+
+        resampling is one of the RESAMPLING_xxx constants of
+        mapproxy_hips.util.resampling.
+    """
+    num_channels = mosaics.shape[1]
+    resampled = np.empty(num_channels, dtype=np.float64)
+    tab_weightX, acc = resampling_buffers(resampling, src_to_tgt_scaling, num_channels, resampled)
+    for j in range(height):
+        for i in range(width):
+            idx = j * width + i
+            pixel = pixels[idx]
+            if pixel < 0:
+                continue
+            _render_pixel(result_ar, j, i, pixel, dx_ar[idx], dy_ar[idx], pixel_order,
+                          mosaics, slot_layout, slot_of_face, tile_origin, tile_present, hips_shift, halo,
+                          resampling, src_to_tgt_scaling, tab_weightX, acc, resampled)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _create_geographic_map_image(pixel_order, lon_cols, lat_rows,
+                                 mosaics, slot_layout, slot_of_face, tile_origin, tile_present, hips_shift, halo,
+                                 result_ar, resampling, src_to_tgt_scaling):
+    """ Same as _create_map_image(), for a target image in a geographic CRS,
+        whose pixel centers have a longitude per column (lon_cols) and a
+        latitude per row (lat_rows). The HealPIX terms of the longitudes and
+        latitudes are computed once per column and row. Rows whose latitude
+        is outside of [-90, 90] are left empty.
+    """
+    num_channels = mosaics.shape[1]
+    resampled = np.empty(num_channels, dtype=np.float64)
+    tab_weightX, acc = resampling_buffers(resampling, src_to_tgt_scaling, num_channels, resampled)
+    tt_cols = np.empty(lon_cols.shape[0], dtype=np.float64)
+    for i in range(lon_cols.shape[0]):
+        tt_cols[i] = hips.hp_lon_term(lon_cols[i])
+    for j in range(lat_rows.shape[0]):
+        if not (lat_rows[j] >= -90 and lat_rows[j] <= 90):
+            continue
+        z, polar_scale = hips.hp_lat_terms(lat_rows[j])
+        for i in range(lon_cols.shape[0]):
+            pixel, dx, dy = hips.hp_loc2pix(pixel_order, tt_cols[i], z, polar_scale)
+            _render_pixel(result_ar, j, i, pixel, dx, dy, pixel_order,
+                          mosaics, slot_layout, slot_of_face, tile_origin, tile_present, hips_shift, halo,
+                          resampling, src_to_tgt_scaling, tab_weightX, acc, resampled)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _geographic_hips_tiles(pixel_order, hips_shift, lon_cols, lat_rows):
+    """ Return the list of the HIPS tiles, of order pixel_order - hips_shift,
+        of the pixels of a target image in a geographic CRS (see
+        _create_geographic_map_image()), with duplicates """
+    tiles = []
+    tt_cols = np.empty(lon_cols.shape[0], dtype=np.float64)
+    for i in range(lon_cols.shape[0]):
+        tt_cols[i] = hips.hp_lon_term(lon_cols[i])
+    for j in range(lat_rows.shape[0]):
+        if not (lat_rows[j] >= -90 and lat_rows[j] <= 90):
+            continue
+        z, polar_scale = hips.hp_lat_terms(lat_rows[j])
+        last_tile = -1
+        for i in range(lon_cols.shape[0]):
+            pixel, _, _ = hips.hp_loc2pix(pixel_order, tt_cols[i], z, polar_scale)
+            tile = pixel >> (2 * hips_shift)
+            # Consecutive pixels are generally in the same tile
+            if tile != last_tile:
+                tiles.append(tile)
+                last_tile = tile
+    return tiles
+
+
+@lru_cache()
+def _transformer(src_srs, dst_srs):
+    """ Return the pyproj Transformer from src_srs to dst_srs (mapproxy SRS),
+        with longitude, latitude order for geographic ones """
+    from pyproj import Transformer
+    return Transformer.from_crs(src_srs.proj, dst_srs.proj, always_xy=True)
+
+
+def warmup_kernels(hips_shift=2):
+    """ Compile (or load from the on-disk numba cache) the get_map() kernels
+        for each resampling method, so that the first request served by a
+        worker does not pay the compilation cost.
+    """
+    tile_size = 1 << hips_shift
+    halo = 2
+    for num_channels in (3, 4):
+        tile = np.zeros((tile_size, tile_size, num_channels), dtype=np.uint8)
+        mosaic = build_mosaic(0, [0, 1], [tile, tile], hips_shift, halo)
+        pixels = np.zeros(1, dtype=np.int64)
+        offsets = np.zeros(1, dtype=np.float64)
+        result_ar = np.zeros((1, 1, 4), dtype=np.uint8)
+        for resampling_method in ('nearest_neighbour', 'bilinear', 'bicubic'):
+            _create_map_image(1, 1, hips_shift, pixels, offsets, offsets,
+                              mosaic.mosaics, mosaic.slot_layout, mosaic.slot_of_face, mosaic.tile_origin,
+                              mosaic.tile_present, hips_shift, halo, result_ar,
+                              resampling_mode(resampling_method), 1.0)
+            _create_geographic_map_image(hips_shift, offsets, offsets,
+                                         mosaic.mosaics, mosaic.slot_layout, mosaic.slot_of_face, mosaic.tile_origin,
+                                         mosaic.tile_present, hips_shift, halo, result_ar,
+                                         resampling_mode(resampling_method), 1.0)
+    _geographic_hips_tiles(hips_shift, hips_shift, offsets, offsets)
+    hips.lonlat_to_hp_pixel(0, offsets, offsets, return_offsets=True)
+
+
 class HIPSSource(MapLayer):
-    def __init__(self, http_client, url, resampling_method, coverage=None, image_opts=None):
+    def __init__(self, http_client, url, resampling_method, coverage=None, image_opts=None,
+                 render_threads=1, http_cache=None, concurrent_requests=1,
+                 decoded_tile_cache=None, raw_tile_store_dir=None, approx_transform_max_error=0):
         MapLayer.__init__(self, image_opts=image_opts)
         self.http_client = http_client
         self.url = url
+        # HTTPResourceCache of /properties and Allsky files. By default,
+        # they are revalidated on each request
+        self.http_cache = http_cache or HTTPResourceCache(http_client)
         self.coverage = coverage
         if self.coverage:
             self.extent = coverage.extent
@@ -46,8 +211,28 @@ class HIPSSource(MapLayer):
             self.resample_func = bicubic_resample
         else:
             assert False, self.resampling_method
+        self.resampling = resampling_mode(self.resampling_method)
+        # Number of threads used to render a single get_map() request
+        self.render_threads = render_threads
+        # Maximum number of HIPS tiles loaded concurrently by get_map()
+        self.concurrent_requests = concurrent_requests
+        # Optional LRUCache of the decoded HIPS tiles, keyed by (order, npix).
+        # Its arrays are shared, and must not be modified.
+        self.decoded_tile_cache = decoded_tile_cache
+        # Directory of the optional RawTileStore of the decoded HIPS tiles,
+        # created once the tile size and format are known
+        self.raw_tile_store_dir = raw_tile_store_dir
+        # Maximum size of its directory, or 0 for no limit
+        self.raw_tile_store_max_size_mb = 0
+        self._raw_tile_store = None
+        # Maximum error, in target pixels, of the approximate transformation
+        # of the coordinates of GetMap requests in projected CRS, or 0 to
+        # transform each pixel exactly
+        self.approx_transform_max_error = approx_transform_max_error
         self.locker = None
         self.cache = None
+        # HIPSTileCacheBackend of cache
+        self.tile_cache_backend = None
         # Actual value of the below properties will only be known after
         # _load_properties() execution
         self.hips_shift = None
@@ -70,9 +255,9 @@ class HIPSSource(MapLayer):
 
         # Download the /properties document to get a few metadata we
         # need: size of tiles, maximum HIPS order and tile format.
-        resp = self.http_client.open(self.url + "/properties")
+        resource = self.http_cache.get(self.url + "/properties")
 
-        properties = hips.parse_properties(resp.read().decode('utf-8'))
+        properties = hips.parse_properties(resource.body.decode('utf-8'))
 
         if 'hips_order' in properties: # Mandatory element
             self.hips_order_max = int(properties['hips_order'])
@@ -99,65 +284,142 @@ class HIPSSource(MapLayer):
 
     def load_properties(self):
 
-        """ Load /properties. Only used from mapproxy_hips.service.hips, in passthrough mode """
-
-        from mapproxy.response import Response
-
-        resp = self.http_client.open(self.url + "/properties")
-        return Response(resp.read(), content_type='text/plain', status=200)
+        """ Return the HTTPResource of /properties. Only used from mapproxy_hips.service.hips, in passthrough mode """
 
+        return self.http_cache.get(self.url + "/properties")
 
 
-    def load_allsky(self, req, hips_tile_order):
+    def load_allsky(self, hips_tile_order):
 
-        """ Load a allsky file. Only used from mapproxy_hips.service.hips, in passthrough mode """
+        """ Return the (HTTPResource, content type) of a allsky file. Only used from mapproxy_hips.service.hips, in passthrough mode """
 
-        from mapproxy.response import Response
         from mapproxy.image.opts import ImageOptions
 
         self._load_properties()
         hips_image_ext = 'jpg' if self.hips_tile_format == 'jpeg' else 'png'
         img_opts = ImageOptions(format = self.hips_tile_format)
-        content_type = img_opts.format.mime_type
-
-        if req.environ['REQUEST_METHOD'] == 'HEAD':
-            return Response(None, status=200, content_type=content_type)
 
         url = self.url + f"/Norder{hips_tile_order}/Allsky.{hips_image_ext}"
         log_hips.info(f"Loading {url}")
-        img = self.http_client.open_image(url)
-        return Response(img.as_buffer(), content_type=content_type)
+        resource = self.http_cache.get(url)
+        if resource.content_type and not resource.content_type.lower().startswith('image'):
+            raise HTTPClientError('response is not an image: (%s)' % resource.body)
+        return resource, img_opts.format.mime_type
 
 
     def load_hips_tile(self, hips_tile_order, hips_tile):
+        """ Return a hips tile as an array, from the decoded tile cache, the
+            cache of hips tiles, or downloaded. None in case of error """
+
+        key = (hips_tile_order, hips_tile)
+        if self.decoded_tile_cache is not None:
+            ar = self._get_decoded_tile(key)
+            if ar is not None:
+                return ar
+
+        raw_tile_store = self._get_raw_tile_store()
+        if raw_tile_store is not None:
+            ar = raw_tile_store.get(hips_tile_order, hips_tile)
+            if ar is not None:
+                return ar
+
+        ar = self._load_hips_tile(hips_tile_order, hips_tile)
+        if ar is None:
+            return None
+        # Arrays of the raw tile store are cheap to get again, hence they
+        # do not use the budget of the decoded tile cache
+        if raw_tile_store is not None and raw_tile_store.put(hips_tile_order, hips_tile, ar):
+            return ar
+        if self.decoded_tile_cache is not None:
+            self.decoded_tile_cache.put(key, ar)
+        return ar
+
+
+    def _get_raw_tile_store(self):
+        """ Return the RawTileStore of the source, or None if it has none """
+
+        if self.raw_tile_store_dir is None:
+            return None
+        if self._raw_tile_store is None:
+            self._load_properties()
+            num_channels = 3 if self.hips_tile_format == 'jpeg' else 4
+            self._raw_tile_store = RawTileStore(self.raw_tile_store_dir, 1 << self.hips_shift, num_channels,
+                                                max_size_mb=self.raw_tile_store_max_size_mb)
+        return self._raw_tile_store
+
+
+    def _get_decoded_tile(self, key):
+        """ Return the array of key in decoded_tile_cache, or None. Its
+            statistics are logged every DECODED_TILE_CACHE_STATS_INTERVAL
+            lookups """
+
+        ar = self.decoded_tile_cache.get(key)
+        stats = self.decoded_tile_cache.stats()
+        if (stats['hits'] + stats['misses']) % DECODED_TILE_CACHE_STATS_INTERVAL == 0:
+            log_hips.info('Decoded tile cache of %s: %d hits, %d misses, %d evictions, %d entries, %d/%d bytes',
+                          self.url, stats['hits'], stats['misses'], stats['evictions'],
+                          stats['entries'], stats['size'], stats['max_size'])
+        return ar
+
+
+    def _load_hips_tile(self, hips_tile_order, hips_tile):
         """ Download a hips tile or get it from cache """
 
-        cached_tile = False
-        if self.cache:
-            from mapproxy.cache.tile import Tile
-            tile = Tile([hips_tile_order, hips_tile, 0])
-            with self.locker.lock(tile):
-                if self.cache.is_cached(tile):
-                    if self.cache.load_tile(tile):
-                        img = tile.source_image()
-                        if img:
-                            cached_tile = True
-                            return np.array(img)
-
-        if not cached_tile:
-            req_dir = hips_tile // 10000 * 10000
-            self._load_properties()
-            hips_image_ext = 'jpg' if self.hips_tile_format == 'jpeg' else 'png'
-            url = self.url + f"/Norder{hips_tile_order}/Dir{req_dir}/Npix{hips_tile}.{hips_image_ext}"
-            try:
-                img = self.http_client.open_image(url)
-                if self.cache:
-                    with self.locker.lock(tile):
-                        tile.source = img
-                        self.cache.store_tile(tile)
-                return np.array(img.as_image())
-            except HTTPClientError as e:
-                log_hips.warning('could not retrieve tile: %s', e)
+        if not self.cache:
+            return self._download_hips_tile(hips_tile_order, hips_tile, None)
+
+        tile = self.tile_cache_backend.tile(hips_tile_order, hips_tile)
+        # Tiles are written atomically, hence reading them requires no lock
+        ar = self._load_cached_hips_tile(tile)
+        if ar is not None:
+            return ar
+
+        with self.locker.lock(tile):
+            # Another process may have downloaded the tile while we were
+            # waiting for the lock
+            ar = self._load_cached_hips_tile(tile)
+            if ar is not None:
+                return ar
+            return self._download_hips_tile(hips_tile_order, hips_tile, tile)
+
+
+    def load_hips_tiles(self, hips_tile_order, hips_tiles):
+        """ Return the list of the arrays returned by load_hips_tile() for
+            each tile of hips_tiles, downloading them concurrently """
+
+        # Make sure it is done only once, before the threads need it
+        self._load_properties()
+        return map_in_threads(lambda hips_tile: self.load_hips_tile(hips_tile_order, hips_tile),
+                              hips_tiles, self.concurrent_requests)
+
+
+    def _load_cached_hips_tile(self, tile):
+        """ Return a cached hips tile as an array, or None if it is not cached """
+
+        if self.cache.is_cached(tile):
+            if self.cache.load_tile(tile):
+                img = tile.source_image()
+                if img:
+                    return np.array(img)
+        return None
+
+
+    def _download_hips_tile(self, hips_tile_order, hips_tile, tile):
+        """ Download a hips tile and return it as an array, or None in case of
+            error. If tile is not None, the hips tile is stored in the cache """
+
+        req_dir = hips_tile // 10000 * 10000
+        self._load_properties()
+        hips_image_ext = 'jpg' if self.hips_tile_format == 'jpeg' else 'png'
+        url = self.url + f"/Norder{hips_tile_order}/Dir{req_dir}/Npix{hips_tile}.{hips_image_ext}"
+        try:
+            img = self.http_client.open_image(url)
+            if tile is not None:
+                tile.source = img
+                self.cache.store_tile(tile)
+            return np.array(img.as_image())
+        except HTTPClientError as e:
+            log_hips.warning('could not retrieve tile: %s', e)
 
         return None
 
@@ -208,170 +470,87 @@ class HIPSSource(MapLayer):
                     num_res += 1
             res = sum_res / num_res
 
-            lonlat = query.srs.transform_to(geog_srs,
-                [(query.bbox[0] + (i + 0.5) * resx,
-                  query.bbox[3] - (j + 0.5) * resy) for j in range(query.size[1]) for i in range(query.size[0])])
-            lon = []
-            lat = []
-            if is_north_west_geog_srs:
-                for x in lonlat:
-                    lon.append(-x[1])
-                    lat.append(x[0])
-            else:
-                for x in lonlat:
-                    lon.append(x[0])
-                    lat.append(x[1])
+            transformer = _transformer(query.srs, geog_srs)
+
+            def transform(x, y):
+                lon, lat = transformer.transform(x, y)
+                if is_north_west_geog_srs:
+                    lon, lat = lat, lon
+                    np.negative(lon, out=lon)
+                return lon, lat
         else:
-            lon = [ query.bbox[0] + (i + 0.5) * resx for j in range(query.size[1]) for i in range(query.size[0]) ]
-            lat = [ query.bbox[3] - (j + 0.5) * resy for j in range(query.size[1]) for i in range(query.size[0]) ]
             res = resx
 
         hips_tile_size = 1 << self.hips_shift
         hips_tile_order = min(max(math.ceil(hips.hips_order_for_resolution(res, hips_tile_size)),0), self.hips_order_max)
         hips_tile_res = hips.healpix_resolution_degree(hips_tile_order, hips_tile_size)
         src_to_tgt_scaling = hips_tile_res / res
+        pixel_order = hips_tile_order + self.hips_shift
+        width = query.size[0]
 
-        # For geodetic tile at zoom level 0, part of the latitudes are outside of [-90,90]
-        # so clamp them, otherwise lonlat_to_hp_pixel() will emit an exception
-        lat_clamped = [ max(-90, min(90, x)) for x in lat ]
-
-        # Compute HealPIX pixel coordinates for the center of each target pixel
-        # Request also the fractional part of the HealPIX coordinate to be
-        # able to do interpolation.
-        pixels_filtered, dx_ar, dy_ar = hips.lonlat_to_hp_pixel(hips_tile_order + self.hips_shift, lon, lat_clamped, return_offsets=True)
-
-        # Set -1 as pixel number for invalid latitudes
-        pixels = np.array([ pixels_filtered[x] if lat[x] == lat_clamped[x] else -1 for x in range(len(pixels_filtered)) ], dtype=np.int64)
-
-        if has_numba:
-            # Numba cannot take a untyped dict for an input parameter, so
-            # we have to specify the key and value types
-            from numba.core import types
-            from numba.typed import Dict
-            map_tiles = Dict.empty(
-                key_type=types.int64,
-                value_type=types.uint8[:,:,:],
-            )
-            map_tile_coord_shift = Dict.empty(
-                key_type=types.int64,
-                value_type=types.int32[:],
-            )
+        if geog_srs != query.srs:
+            # Coordinates of the center of each target pixel, row by row
+            if self.approx_transform_max_error > 0:
+                lon, lat = approximate_transform(transform, query.bbox, query.size,
+                                                 self.approx_transform_max_error, res)
+            else:
+                lon, lat = transform(*pixel_center_grid(query.bbox, query.size))
+
+            # Points that could not be transformed are infinite.
+            invalid = ~((lat >= -90) & (lat <= 90) & np.isfinite(lon))
+            np.clip(lat, -90, 90, out=lat)
+            lat[np.isnan(lat)] = 0
+            lon[~np.isfinite(lon)] = 0
+
+            # Compute HealPIX pixel coordinates for the center of each target pixel
+            # Request also the fractional part of the HealPIX coordinate to be
+            # able to do interpolation.
+            pixels, dx_ar, dy_ar = hips.lonlat_to_hp_pixel(pixel_order, lon, lat, return_offsets=True)
+            del lon, lat
+
+            # Set -1 as pixel number for invalid latitudes
+            pixels[invalid] = -1
+            hips_tiles = np.unique(pixels[~invalid] >> (2 * self.hips_shift))
+
+            def render_strip(start, end):
+                # Strips are ranges of rows of result_ar
+                _create_map_image(end - start, width, pixel_order,
+                                  pixels[start * width:end * width],
+                                  dx_ar[start * width:end * width],
+                                  dy_ar[start * width:end * width],
+                                  mosaic.mosaics, mosaic.slot_layout, mosaic.slot_of_face, mosaic.tile_origin,
+                                  mosaic.tile_present, mosaic.hips_shift, mosaic.halo,
+                                  result_ar[start:end],
+                                  self.resampling, float(src_to_tgt_scaling))
         else:
-            map_tiles = dict()
-            map_tile_coord_shift = dict()
-
-
-        # Collect all HIPS tiles that intersect the request
-        hips_tiles = set(pixels_filtered >> (2 * self.hips_shift))
-        tiles_of_expected_dimension = True
-        for hips_tile in hips_tiles:
-
-            map_tile_coord_shift[hips_tile] = np.array([0, 0], np.int32)
-
-            tile = self.load_hips_tile(hips_tile_order, hips_tile)
-            if tile is not None:
-                map_tiles[hips_tile] = tile
-                if tile.shape[0] != 1 << self.hips_shift or tile.shape[1] != 1 << self.hips_shift:
-                    tiles_of_expected_dimension = False
-                    log_hips.warning('tile %d,%d has not expected shape', hips_tile_order, hips_tile)
-
-
-        # Potential optimization for quality of images if the source HIPS tiles
-        # belong to the same of one of the base 12 pixels
-        set_tiles_level_zero = set([hips_tile >> (2 * hips_tile_order) for hips_tile in hips_tiles])
-        if tiles_of_expected_dimension and len(set_tiles_level_zero) == 1:
-
-            # Get subpixel coordinates of source HIPS tiles, relative to their
-            # base pixel and at order hips_tile_order
-            max_x = -1
-            max_y = -1
-            min_x = 1 << hips_tile_order
-            min_y = 1 << hips_tile_order
-            for hips_tile in hips_tiles:
-                x, y = hips.hp_subpixel_to_axis_coord(hips_tile_order, hips_tile % (1 << (2 * hips_tile_order)))
-                # The axis of the image are swapped compared to the HealPIX ones
-                y, x = x, y
-                min_x = min(min_x, x)
-                min_y = min(min_y, y)
-                max_x = max(max_x, x)
-                max_y = max(max_y, y)
-
-            # If the source tiles are grouped together, we can build a single
-            # source array and composite them together
-            if max_y - min_y <= 1 and max_x - min_x <= 1:
-                source_ar = np.zeros(((max_y - min_y + 1) << self.hips_shift,
-                                      (max_x - min_x + 1) << self.hips_shift,
-                                      4), np.uint8)
-                tile_size = 1 << self.hips_shift
-                for hips_tile in hips_tiles:
-                    if hips_tile in map_tiles:
-                        x, y = hips.hp_subpixel_to_axis_coord(hips_tile_order, hips_tile % (1 << (2 * hips_tile_order)))
-                        y, x = x, y
-                        tile_ar = map_tiles[hips_tile]
-                        y_shift = (y - min_y) << self.hips_shift
-                        x_shift = (x - min_x) << self.hips_shift
-                        source_ar[y_shift:y_shift + tile_size,
-                                  x_shift:x_shift + tile_size,
-                                  0:tile_ar.shape[2]] = tile_ar
-                        if tile_ar.shape[2] == 3:
-                            source_ar[y_shift:y_shift + tile_size,
-                                      x_shift:x_shift + tile_size,
-                                      3] = 255
-                        map_tiles[hips_tile] = source_ar
-
-                        # Offset to add to go from tile coordinate to global source array coordinate
-                        map_tile_coord_shift[hips_tile] = np.array([y_shift, x_shift], np.int32)
-
-
-        @jit(nopython=True)
-        def create_image(height, width,
-                         hips_shift, pixels, dx_ar, dy_ar, map_tiles,
-                         map_tile_coord_shift,
-                         result_ar, resample_func, src_to_tgt_scaling):
-            for j in range(height):
-                for i in range(width):
-                    idx = j * width + i
-                    pixel = pixels[idx]
-                    if pixel < 0:
-                        continue
-                    hips_tile = pixel >> (2 * hips_shift)
-                    if hips_tile in map_tiles:
-                        subpixel = pixel - (hips_tile << (2 * hips_shift))
-                        x, y = hips.hp_subpixel_to_axis_coord(hips_shift, subpixel)
-                        # The axis of the image are swapped compared to the HealPIX ones
-                        y, x = x, y
-
-                        source_ar = map_tiles[hips_tile]
-
-                        # Offset to add to go from tile coordinate to global source array coordinate
-                        shift = map_tile_coord_shift[hips_tile]
-                        y += shift[0]
-                        x += shift[1]
-
-                        if resample_func is None:
-                            result_ar[j,i,0:source_ar.shape[2]] = source_ar[y,x]
-                        else:
-                            dy, dx = dx_ar[idx], dy_ar[idx]
-                            num_channels = source_ar.shape[2]
-                            for k in range(num_channels):
-                                resampled_val = resample_func(source_ar[:,:,k],
-                                                              x + dx,
-                                                              y + dy,
-                                                              src_to_tgt_scaling,
-                                                              src_to_tgt_scaling)
-                                result_ar[j,i,k] = max(0,min(255,int(resampled_val + 0.5)))
-                        result_ar[j,i,3] = 255
-
+            # The longitude of the center of the target pixels only depends
+            # on their column, and their latitude on their row. For geodetic
+            # tiles at zoom level 0, part of the latitudes are outside of
+            # [-90,90].
+            lon_cols = query.bbox[0] + (np.arange(width, dtype=np.float64) + 0.5) * resx
+            lat_rows = query.bbox[3] - (np.arange(query.size[1], dtype=np.float64) + 0.5) * resy
+            hips_tiles = np.unique(np.array(
+                _geographic_hips_tiles(pixel_order, self.hips_shift, lon_cols, lat_rows), dtype=np.int64))
+
+            def render_strip(start, end):
+                _create_geographic_map_image(pixel_order, lon_cols, lat_rows[start:end],
+                                             mosaic.mosaics, mosaic.slot_layout, mosaic.slot_of_face, mosaic.tile_origin,
+                                             mosaic.tile_present, mosaic.hips_shift, mosaic.halo,
+                                             result_ar[start:end],
+                                             self.resampling, float(src_to_tgt_scaling))
+
+        # Collect all HIPS tiles that intersect the request, and assemble
+        # them, with the halo needed for interpolation
+        hips_tiles = [int(x) for x in hips_tiles]
+        loaded_tiles = self.load_hips_tiles(hips_tile_order, hips_tiles)
+        mosaic = build_mosaic(hips_tile_order, hips_tiles, loaded_tiles, self.hips_shift,
+                              mosaic_halo(self.resampling, src_to_tgt_scaling))
 
         result_ar = np.zeros((query.size[1],query.size[0],4), dtype=np.uint8)
 
         import time
         start = time.time()
-        create_image(query.size[1], query.size[0],
-                     self.hips_shift, pixels, dx_ar, dy_ar,
-                     map_tiles, map_tile_coord_shift,
-                     result_ar,
-                     self.resample_func, src_to_tgt_scaling)
+        run_in_strips(render_strip, query.size[1], self.render_threads)
         log_hips.info('Processing time: %.02f s', time.time() - start)
 
         return ImageSource(Image.fromarray(result_ar, mode='RGBA'))
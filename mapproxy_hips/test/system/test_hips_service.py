@@ -12,12 +12,34 @@ from mapproxy.test.http import mock_httpd
 from mapproxy.test.image import tmp_image
 from mapproxy.test.system import SysTest
 
+import numpy as np
 import os
 import os.path
 import pytest
+import threading
+import time
+
+def _white_image(bbox, width, height):
+    return np.full((height, width, 4), 255, dtype=np.uint8)
+
+
+def _transparent_image(bbox, width, height):
+    return np.zeros((height, width, 4), dtype=np.uint8)
+
+
+def _no_source_access(bbox, width, height):
+    assert False, 'unexpected source access'
+
 
 class MySysTest(SysTest):
 
+    @staticmethod
+    def set_source_image(monkeypatch, server, image=_white_image):
+        """ Make the tiles of server be generated from image(bbox, width, height),
+            a RGBA array, rather than from the WMS source of the layer """
+        monkeypatch.setattr(server, '_get_source_image',
+                            lambda layer_name, srs, bbox, width, height: image(bbox, width, height))
+
     @pytest.fixture(scope="class")
     def base_dir(self, tmpdir_factory, config_file):
         dir = tmpdir_factory.mktemp("base_dir")
@@ -61,6 +83,26 @@ class TestHIPSService(MySysTest):
         assert text == 'creator_did=ivo://example.com/unknown_resource_FIXME\nobs_title=Direct Layer\ndataproduct_type=image\nhips_version=1.4\nhips_status=public master clonableOnce\nhips_tile_format=png jpeg\nhips_order=5\nhips_tile_width=512\nhips_frame=planet\ndataproduct_subtype=color\n'
 
 
+    def test_properties_stable(self, app, monkeypatch):
+        server = app.app.handlers['hips']
+        # The cache directory is cleaned between tests
+        monkeypatch.setattr(server, '_properties', {})
+        resp = app.get("/hips/direct/properties")
+        assert 'Last-Modified' in resp.headers
+
+        # The release date is persisted in the cache directory, and shared
+        # by other processes, or after a restart
+        monkeypatch.setattr(server, '_properties', {})
+        time.sleep(1.1)
+        resp2 = app.get("/hips/direct/properties")
+        assert resp2.text == resp.text
+        assert resp2.headers['ETag'] == resp.headers['ETag']
+        with open(os.path.join(server.cache_dir, 'direct', 'hips_release_date'), 'rt') as f:
+            assert 'hips_release_date=' + f.read() in resp.text
+
+        app.get("/hips/direct/properties", headers={'If-Modified-Since': resp.headers['Last-Modified']}, status=304)
+
+
     def test_bad_layer(self, app):
         resp = app.get("/hips/bad_layer/properties", status=404)
         assert resp.content_type == "text/plain"
@@ -111,6 +153,59 @@ class TestHIPSService(MySysTest):
         assert resp.content_type == "image/jpeg"
         assert resp.body == b'should be some jpeg content'
 
+        resp = app.get("/hips/direct/Norder3/Allsky.jpg", headers={'If-None-Match': resp.headers['ETag']}, status=304)
+        assert resp.body == b''
+
+
+    def test_passthrough_http_caching(self, app, monkeypatch):
+        """ Check that the /properties and Allsky files of a HIPS source are
+            served with cache validators """
+
+        server = app.app.handlers['hips']
+
+        from mapproxy.client.http import HTTPClient
+        from mapproxy_hips.source.hips import HIPSSource
+        from mapproxy_hips.util.http_cache import HTTPResourceCache
+        http_cache = HTTPResourceCache(HTTPClient(), ttl=3600)
+        source = HIPSSource(HTTPClient(), "http://localhost:42423/hips_source", 'nearest_neighbour',
+                            http_cache=http_cache)
+        monkeypatch.setattr(server, '_get_hips_source', lambda layer_name: source)
+
+        properties = b"hips_tile_format=png\nhips_order=3\nhips_tile_width=512"
+        expected_reqs = [
+            (
+                {"path": r"/hips_source/properties"},
+                {"body": properties,
+                 "headers": {"content-type": "text/plain", "ETag": '"abc"',
+                             "Last-Modified": "Fri, 31 Dec 2021 12:34:56 GMT"}},
+            ),
+            (
+                {"path": r"/hips_source/Norder3/Allsky.png"},
+                {"body": b"some png content", "headers": {"content-type": "image/png"}},
+            ),
+        ]
+        with mock_httpd(("localhost", 42423), expected_reqs):
+            resp = app.get("/hips/direct/properties")
+            assert resp.body == properties
+            assert resp.headers['Last-Modified'] == 'Fri, 31 Dec 2021 12:34:56 GMT'
+            etag = resp.headers['ETag']
+
+            resp = app.head("/hips/direct/Norder3/Allsky.png")
+            assert resp.content_type == "image/png"
+            assert resp.headers['Content-Length'] == str(len(b"some png content"))
+            allsky_etag = resp.headers['ETag']
+            assert 'Last-Modified' in resp.headers
+
+        # Served from the HTTP resource cache
+        resp = app.get("/hips/direct/properties", headers={'If-None-Match': etag}, status=304)
+        assert resp.body == b''
+        resp = app.get("/hips/direct/properties", headers={'If-Modified-Since': 'Fri, 31 Dec 2021 12:34:56 GMT'}, status=304)
+        assert resp.body == b''
+        resp = app.get("/hips/direct/Norder3/Allsky.png")
+        assert resp.body == b"some png content"
+        assert resp.headers['ETag'] == allsky_etag
+        app.get("/hips/direct/Norder3/Allsky.png", headers={'If-None-Match': allsky_etag}, status=304)
+
 
     def test_bad_path4(self, app):
         resp = app.get("/hips/direct/Norder3", status=404)
@@ -188,6 +283,239 @@ class TestHIPSService(MySysTest):
                 assert hashlib.md5(resp.body).hexdigest() in ('e5893f926c84fb46ff1ef0fddf37b19d', 'e5893f926c84fb46ff1ef0fddf37b19d', '83db47dc57b237f47d1b3a81bb910e00', 'b1825835f83dda08e4e84e1ccd7a66e1')
 
 
+    def test_concurrent_requests_same_tile(self, app, monkeypatch):
+        """ Check that concurrent requests for the same tile, in different
+            formats, trigger a single generation """
+
+        server = app.app.handlers['hips']
+        calls = []
+
+        def image(bbox, width, height):
+            calls.append(bbox)
+            time.sleep(0.5)
+            return _white_image(bbox, width, height)
+
+        self.set_source_image(monkeypatch, server, image)
+
+        responses = {}
+
+        def request(path):
+            responses[path] = app.get(path)
+
+        paths = ["/hips/direct/Norder2/Dir0/Npix5.png",
+                 "/hips/direct/Norder2/Dir0/Npix5.jpg",
+                 "/hips/direct/Norder2/Dir0/Npix5.png"]
+        threads = [threading.Thread(target=request, args=(path,)) for path in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(calls) == 1
+        assert responses[paths[0]].content_type == "image/png"
+        assert responses[paths[1]].content_type == "image/jpeg"
+
+        # Both formats have been cached
+        assert server._is_tile_cached('direct', 2, 5, 'png')
+        assert server._is_tile_cached('direct', 2, 5, 'jpg')
+
+
+    def test_wait_for_generation_by_other_process(self, app, monkeypatch):
+        """ Check that the cache is checked again after the generation lock
+            held by another process is released """
+
+        server = app.app.handlers['hips']
+
+        self.set_source_image(monkeypatch, server, _no_source_access)
+
+        from mapproxy.cache.tile import Tile
+        from mapproxy.image import ImageSource
+        tile = Tile([2, 6, 0])
+        responses = []
+        locker = server._get_generation_locker('direct', 2)
+        with locker.lock(tile):
+            thread = threading.Thread(target=lambda: responses.append(app.get("/hips/direct/Norder2/Dir0/Npix6.png")))
+            thread.start()
+            time.sleep(0.2)
+            # Emulate the other process storing the tile
+            cache = server._get_tile_cache('direct', 2, 'png')
+            with tmp_image((512, 512), format="png", color=(0, 255, 0)) as img:
+                tile.source = ImageSource(BytesIO(img.read()))
+                cache.store_tile(tile)
+        thread.join()
+
+        assert len(responses) == 1
+        img = Image.open(BytesIO(responses[0].body))
+        assert img.convert('RGB').getpixel((0, 0)) == (0, 255, 0)
+
+
+
+    def test_cache_hit_raw_bytes(self, app, monkeypatch):
+        """ Check that cache hits are served as stored, and that a missing JPEG
+            tile is transcoded from the cached PNG one """
+
+        server = app.app.handlers['hips']
+
+        self.set_source_image(monkeypatch, server, _no_source_access)
+
+        from mapproxy.cache.tile import Tile
+        from mapproxy.image import ImageSource
+        tile = Tile([2, 7, 0])
+        cache = server._get_tile_cache('direct', 2, 'png')
+        with tmp_image((512, 512), format="png", color=(0, 0, 255)) as img:
+            tile.source = ImageSource(BytesIO(img.read()))
+            cache.store_tile(tile)
+        with open(cache.tile_location(tile), 'rb') as f:
+            stored = f.read()
+
+        resp = app.get("/hips/direct/Norder2/Dir0/Npix7.png")
+        assert resp.content_type == "image/png"
+        assert resp.body == stored
+
+        resp = app.get("/hips/direct/Norder2/Dir0/Npix7.jpg")
+        assert resp.content_type == "image/jpeg"
+        img = Image.open(BytesIO(resp.body))
+        assert img.format == 'JPEG'
+        r, g, b = img.convert('RGB').getpixel((0, 0))
+        assert r < 10 and g < 10 and b > 245
+
+
+    def test_no_torn_reads(self, app):
+        """ Check that lock-free reads of a tile being rewritten concurrently
+            always see a complete version of it """
+
+        server = app.app.handlers['hips']
+
+        from mapproxy.cache.tile import Tile
+        from mapproxy.image import ImageSource
+        versions = []
+        for color in ((255, 0, 0), (0, 255, 0), (0, 0, 255)):
+            with tmp_image((512, 512), format="png", color=color) as img:
+                versions.append(img.read())
+
+        cache = server._get_tile_cache('direct', 4, 'png')
+        stop = threading.Event()
+
+        def write():
+            i = 0
+            while not stop.is_set():
+                tile = Tile([4, 8, 0])
+                tile.source = ImageSource(BytesIO(versions[i % len(versions)]))
+                cache.store_tile(tile)
+                i += 1
+
+        reads = []
+
+        def read():
+            while not stop.is_set():
+                tile_file = server._open_cached_tile('direct', 4, 8, 'png')
+                if tile_file is not None:
+                    with tile_file:
+                        reads.append(tile_file.read())
+
+        threads = [threading.Thread(target=write) for _ in range(2)] + \
+                  [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(1)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        assert reads
+        for buf in reads:
+            assert buf in versions
+
+
+    def test_hot_tile_cache(self, app, monkeypatch):
+        server = app.app.handlers['hips']
+
+        self.set_source_image(monkeypatch, server, _no_source_access)
+
+        from mapproxy.cache.tile import Tile
+        from mapproxy.image import ImageSource
+        from mapproxy_hips.util.lru import LRUCache
+        cache = server._get_tile_cache('direct', 0, 'png')
+        for npix in (10, 11):
+            tile = Tile([0, npix, 0])
+            with tmp_image((512, 512), format="png", color=(0, npix, 0)) as img:
+                tile.source = ImageSource(BytesIO(img.read()))
+                cache.store_tile(tile)
+
+        monkeypatch.setattr(server, 'hot_tile_cache', LRUCache(10 * 1024 * 1024))
+        server.prewarm_hot_tile_cache(0)
+        assert len(server.hot_tile_cache) >= 2
+
+        resp = app.get("/hips/direct/Norder0/Dir0/Npix10.png")
+        # Served from memory, even once removed from the disk cache
+        os.unlink(cache.tile_location(Tile([0, 11, 0])))
+        resp2 = app.get("/hips/direct/Norder0/Dir0/Npix11.png")
+        assert resp2.body != resp.body
+        assert Image.open(BytesIO(resp2.body)).convert('RGB').getpixel((0, 0)) == (0, 11, 0)
+        assert server.hot_tile_cache.stats()['hits'] == 2
+
+
+    def test_http_caching(self, app, monkeypatch):
+        server = app.app.handlers['hips']
+
+        self.set_source_image(monkeypatch, server, _no_source_access)
+
+        # HEAD on a tile that is not cached does not generate it, and
+        # does not claim validators
+        resp = app.head("/hips/direct/Norder3/Dir0/Npix8.png")
+        assert resp.content_type == "image/png"
+        assert 'ETag' not in resp.headers
+        assert 'Last-Modified' not in resp.headers
+        assert not server._is_tile_cached('direct', 3, 8, 'png')
+
+        # Unless generate_on_head is set: it is then answered as GET, hence
+        # generates (and caches) it
+        self.set_source_image(monkeypatch, server)
+        monkeypatch.setattr(server, 'generate_on_head', True)
+        resp = app.head("/hips/direct/Norder3/Dir0/Npix8.png")
+        assert resp.content_type == "image/png"
+        assert resp.body == b''
+        assert server._is_tile_cached('direct', 3, 8, 'png')
+
+        self.set_source_image(monkeypatch, server, _no_source_access)
+
+        resp2 = app.get("/hips/direct/Norder3/Dir0/Npix8.png")
+        assert resp2.headers['ETag'] == resp.headers['ETag']
+        assert resp.headers['Content-Length'] == str(len(resp2.body))
+
+        from mapproxy.cache.tile import Tile
+        from mapproxy.image import ImageSource
+        tile = Tile([3, 9, 0])
+        cache = server._get_tile_cache('direct', 3, 'png')
+        with tmp_image((512, 512), format="png", color=(0, 0, 255)) as img:
+            tile.source = ImageSource(BytesIO(img.read()))
+            cache.store_tile(tile)
+
+        resp = app.get("/hips/direct/Norder3/Dir0/Npix9.png")
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+        # No cache_max_age for this layer
+        assert 'Cache-Control' not in resp.headers
+
+        resp2 = app.head("/hips/direct/Norder3/Dir0/Npix9.png")
+        assert resp2.headers['ETag'] == etag
+        assert resp2.headers['Content-Length'] == str(len(resp.body))
+
+        resp2 = app.get("/hips/direct/Norder3/Dir0/Npix9.png", headers={'If-None-Match': etag}, status=304)
+        assert resp2.body == b''
+        resp2 = app.get("/hips/direct/Norder3/Dir0/Npix9.png", headers={'If-Modified-Since': last_modified}, status=304)
+        assert resp2.body == b''
+        resp2 = app.get("/hips/direct/Norder3/Dir0/Npix9.png", headers={'If-None-Match': 'foo'})
+        assert resp2.body == resp.body
+
+        # The ETag does not depend on whether the tile is served from the
+        # hot tile cache
+        from mapproxy_hips.util.lru import LRUCache
+        monkeypatch.setattr(server, 'hot_tile_cache', LRUCache(10 * 1024 * 1024))
+        for _ in range(2):
+            resp2 = app.get("/hips/direct/Norder3/Dir0/Npix9.png")
+            assert resp2.headers['ETag'] == etag
+
 class TestHIPSServiceResamplingBilinear(MySysTest):
 
     @pytest.fixture(scope="class")
@@ -246,3 +574,268 @@ class TestHIPSServiceCustomProperties(MySysTest):
         resp = app.get("/hips/direct/properties")
         assert resp.content_type == "text/plain"
         assert resp.text == 'creator_did=my_creator_did\nobs_title=my_obs_title\ndataproduct_type=image\nhips_version=1.4\nhips_release_date=2021-12-31T12:34:56Z\nhips_status=my_hips_status\nhips_tile_format=jpeg\nhips_order=6\nhips_tile_width=512\nhips_frame=mars\ndataproduct_subtype=color\nfoo=bar\n'
+        assert resp.headers['Cache-Control'] == 'public, max-age=3600, s-maxage=3600'
+        assert resp.headers['Last-Modified'] == 'Fri, 31 Dec 2021 12:34:56 GMT'
+
+        resp2 = app.get("/hips/direct/properties", headers={'If-None-Match': resp.headers['ETag']}, status=304)
+        assert resp2.body == b''
+
+
+class TestHIPSServicePyramid(MySysTest):
+
+    @pytest.fixture(scope="class")
+    def config_file(self):
+        return "hips_service_pyramid.yaml"
+
+
+    def test_pyramid_on_demand(self, app, monkeypatch):
+        server = app.app.handlers['hips']
+
+        self.set_source_image(monkeypatch, server, _no_source_access)
+
+        from mapproxy.cache.tile import Tile
+        from mapproxy.image import ImageSource
+        colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255)]
+        cache = server._get_tile_cache('direct', 3, 'png')
+        for c in range(4):
+            tile = Tile([3, 4 * 7 + c, 0])
+            with tmp_image((16, 16), format="png", color=colors[c]) as img:
+                tile.source = ImageSource(BytesIO(img.read()))
+                cache.store_tile(tile)
+
+        resp = app.get("/hips/direct/Norder2/Dir0/Npix7.png")
+        img = Image.open(BytesIO(resp.body)).convert('RGB')
+        assert img.width == 16
+        assert img.height == 16
+        # Child c covers the rows starting at (c & 1) * 8 and the columns
+        # starting at (c >> 1) * 8
+        for c in range(4):
+            assert img.getpixel(((c >> 1) * 8 + 4, (c & 1) * 8 + 4)) == colors[c]
+
+
+    def test_seed_pyramid(self, app, monkeypatch):
+        server = app.app.handlers['hips']
+
+        self.set_source_image(monkeypatch, server)
+
+        generated_orders = []
+        _generate_hips_tile = server._generate_hips_tile
+
+        def _generate_hips_tile_wrapper(layer_name, norder, npix, hips_shift):
+            generated_orders.append(norder)
+            return _generate_hips_tile(layer_name, norder, npix, hips_shift)
+
+        monkeypatch.setattr(server, '_generate_hips_tile', _generate_hips_tile_wrapper)
+
+        server.seed(None, 'direct', 1, 1, pyramid=True)
+
+        # Only tiles of order 1 are generated from the source
+        assert generated_orders == [1] * 48
+        for npix in range(12):
+            assert server._is_tile_cached('direct', 0, npix, 'png')
+            assert server._is_tile_cached('direct', 0, npix, 'jpg')
+
+
+    def test_seed_bbox(self, app, monkeypatch):
+        server = app.app.handlers['hips']
+
+        self.set_source_image(monkeypatch, server)
+
+        generated_tiles = []
+        _generate_hips_tile = server._generate_hips_tile
+
+        def _generate_hips_tile_wrapper(layer_name, norder, npix, hips_shift):
+            generated_tiles.append((norder, npix))
+            return _generate_hips_tile(layer_name, norder, npix, hips_shift)
+
+        monkeypatch.setattr(server, '_generate_hips_tile', _generate_hips_tile_wrapper)
+
+        server.seed(None, 'direct', 4, 1, min_order=3, bbox=(-5, 40, 5, 45))
+
+        from mapproxy_hips.util.hips import hp_tiles_in_bbox
+        expected = [(norder, int(npix)) for norder in (3, 4) for npix in hp_tiles_in_bbox(norder, (-5, 40, 5, 45))]
+        assert generated_tiles == expected
+        assert len(generated_tiles) < 100
+
+
+    def test_seed_prune(self, app, monkeypatch):
+        server = app.app.handlers['hips']
+
+        def image(bbox, width, height):
+            # Only data in the northern polar area
+            if (bbox[1] + bbox[3]) / 2 > 30:
+                return _white_image(bbox, width, height)
+            return _transparent_image(bbox, width, height)
+
+        self.set_source_image(monkeypatch, server, image)
+
+        generated_tiles = []
+        _generate_hips_tile = server._generate_hips_tile
+
+        def _generate_hips_tile_wrapper(layer_name, norder, npix, hips_shift):
+            generated_tiles.append((norder, npix))
+            return _generate_hips_tile(layer_name, norder, npix, hips_shift)
+
+        monkeypatch.setattr(server, '_generate_hips_tile', _generate_hips_tile_wrapper)
+
+        server.seed(None, 'sparse', 2, 1, min_order=0)
+
+        # Only the children of the 4 northern tiles of order 0 are generated
+        assert [x for x in generated_tiles if x[0] == 0] == [(0, npix) for npix in range(12)]
+        generated_order1 = [x[1] for x in generated_tiles if x[0] == 1]
+        assert generated_order1 == list(range(16))
+        for norder, npix in generated_tiles:
+            if norder == 2:
+                assert npix // 4 in generated_order1
+        assert len(generated_tiles) < 12 + 16 + 64
+
+        index = server._get_empty_tile_index('sparse')
+        for npix in range(4, 12):
+            assert index.is_empty(0, npix)
+
+        # Resuming seeding does not generate anything, and does not
+        # descend into pruned tiles
+        del generated_tiles[:]
+        server.seed(None, 'sparse', 3, 1, min_order=0)
+        assert generated_tiles
+        for norder, npix in generated_tiles:
+            assert norder == 3
+            assert not index.is_empty(2, npix // 4)
+            assert not index.is_empty(1, npix // 16)
+            assert not index.is_empty(0, npix // 64)
+
+
+    def test_empty_tile(self, app, monkeypatch):
+        server = app.app.handlers['hips']
+
+        self.set_source_image(monkeypatch, server, _transparent_image)
+
+        resp = app.get("/hips/sparse/Norder5/Dir0/Npix100.png")
+        assert resp.content_type == "image/png"
+        img = Image.open(BytesIO(resp.body))
+        assert img.width == 16
+        assert img.height == 16
+
+        # Recorded in the index rather than stored as an image file
+        from mapproxy.cache.tile import Tile
+        assert server._get_empty_tile_index('sparse').is_empty(5, 100)
+        for ext in ('png', 'jpg'):
+            cache = server._get_tile_cache('sparse', 5, ext)
+            assert not cache.is_cached(Tile([5, 100, 0]))
+
+        _generate_hips_tile_orig = server._generate_hips_tile
+
+        def _generate_hips_tile(layer_name, norder, npix, hips_shift):
+            assert False, 'unexpected generation'
+
+        monkeypatch.setattr(server, '_generate_hips_tile', _generate_hips_tile)
+
+        # Served from the shared empty buffer
+        resp2 = app.get("/hips/sparse/Norder5/Dir0/Npix100.png")
+        assert resp2.body == resp.body
+        resp = app.get("/hips/sparse/Norder5/Dir0/Npix100.jpg")
+        assert resp.content_type == "image/jpeg"
+
+        monkeypatch.setattr(server, 'empty_tile_status', 404)
+        app.get("/hips/sparse/Norder5/Dir0/Npix100.png", status=404)
+
+        # HEAD on an empty tile that is not cached yet, with generate_on_head
+        monkeypatch.setattr(server, '_generate_hips_tile', _generate_hips_tile_orig)
+        monkeypatch.setattr(server, 'generate_on_head', True)
+        app.head("/hips/sparse/Norder5/Dir0/Npix101.png", status=404)
+        assert server._get_empty_tile_index('sparse').is_empty(5, 101)
+
+        monkeypatch.setattr(server, 'empty_tile_status', 204)
+        resp = app.get("/hips/sparse/Norder5/Dir0/Npix100.png", status=204)
+        assert resp.body == b''
+
+
+    def test_seed_mbtiles(self, app, monkeypatch):
+        server = app.app.handlers['hips']
+
+        self.set_source_image(monkeypatch, server)
+
+        from mapproxy_hips.util.tile_cache import HIPSTileCacheBackend
+        monkeypatch.setattr(server, 'tile_cache_backend', HIPSTileCacheBackend('mbtiles'))
+        monkeypatch.setattr(server, '_tile_caches', {})
+
+        stored = []
+        seed_hips_tiles = server._seed_hips_tiles
+
+        def _seed_hips_tiles(layer_name, norder, npix_list, pyramid=False):
+            ret = seed_hips_tiles(layer_name, norder, npix_list, pyramid)
+            stored.append(len(npix_list))
+            return ret
+
+        monkeypatch.setattr(server, '_seed_hips_tiles', _seed_hips_tiles)
+
+        server.seed(None, 'direct', 2, 1, min_order=2, prune=False)
+        # 192 tiles, seeded and stored in bulk by chunks
+        assert stored == [64, 64, 64]
+
+        import sqlite3
+        for ext in ('png', 'jpg'):
+            filename = os.path.join(server.cache_dir, 'direct', 'Norder2', ext + '.mbtiles')
+            with sqlite3.connect(filename) as db:
+                assert db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0] == 192
+
+        def _generate_hips_tile(layer_name, norder, npix, hips_shift):
+            assert False, 'unexpected generation'
+
+        monkeypatch.setattr(server, '_generate_hips_tile', _generate_hips_tile)
+        resp = app.get("/hips/direct/Norder2/Dir0/Npix100.png")
+        assert resp.content_type == "image/png"
+        assert Image.open(BytesIO(resp.body)).convert('RGB').getpixel((0, 0)) == (255, 255, 255)
+
+
+    def test_seed_locks_until_stored(self, app, monkeypatch):
+        """ Check that the generation locks of seeded tiles are held during
+            their bulk store, but not while other tiles are generated """
+
+        server = app.app.handlers['hips']
+
+        self.set_source_image(monkeypatch, server)
+
+        from mapproxy.cache.base import TileLocker
+        from mapproxy.cache.tile import Tile
+        from mapproxy.util.lock import LockTimeout
+        generation_locker = server._get_generation_locker('direct', 1)
+        locker = TileLocker(server.lock_dir, 0.1, generation_locker.lock_cache_id)
+
+        stored = []
+        cache = server._get_tile_cache('direct', 1, 'png')
+        store_tiles = cache.store_tiles
+
+        def store_tiles_wrapper(tiles):
+            for tile in tiles:
+                # Not yet in the cache, hence still locked
+                assert not server._is_tile_cached('direct', 1, tile.coord[1], 'png')
+                with pytest.raises(LockTimeout):
+                    with locker.lock(Tile([1, tile.coord[1], 0])):
+                        pass
+                stored.append(tile.coord[1])
+            return store_tiles(tiles)
+
+        monkeypatch.setattr(cache, 'store_tiles', store_tiles_wrapper)
+
+        generated = []
+        generate_hips_tile = server._generate_hips_tile
+
+        def generate_hips_tile_wrapper(layer_name, norder, npix, hips_shift):
+            # The other tiles of the chunk, generated or not, are not locked
+            for other_npix in (1, 2, 3):
+                if other_npix != npix:
+                    with locker.lock(Tile([1, other_npix, 0])):
+                        pass
+            generated.append(npix)
+            return generate_hips_tile(layer_name, norder, npix, hips_shift)
+
+        monkeypatch.setattr(server, '_generate_hips_tile', generate_hips_tile_wrapper)
+
+        server._seed_hips_tiles('direct', 1, [3, 1, 2])
+        assert generated == [3, 1, 2]
+        assert sorted(stored) == [1, 2, 3]
+
+        # Released once stored
+        with locker.lock(Tile([1, 3, 0])):
+            assert server._is_tile_cached('direct', 1, 3, 'png')
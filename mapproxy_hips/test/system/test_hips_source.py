@@ -5,14 +5,28 @@
 import hashlib
 import os
 import shutil
+import threading
+import time
 
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
 
 from PIL import Image
+import numpy as np
+from mapproxy.client.http import HTTPClient
+from mapproxy.layer import MapQuery
+from mapproxy.srs import SRS
 from mapproxy.test.http import mock_httpd
 from mapproxy.test.image import tmp_image
 from mapproxy.test.system import SysTest
 
+from mapproxy_hips.source.hips import HIPSSource, _create_geographic_map_image, _create_map_image, \
+                                     _geographic_hips_tiles
+from mapproxy_hips.util.hips import lonlat_to_hp_pixel
+from mapproxy_hips.util.lru import LRUCache
+from mapproxy_hips.util.mosaic import build_mosaic
+from mapproxy_hips.util.resampling import resampling_mode
+
 import pytest
 
 class MySysTest(SysTest):
@@ -46,8 +60,14 @@ class TestHIPSSource(MySysTest):
                     {"path": r"/hips_source/Norder0/Dir0/Npix2.jpg"},
                     {"body": img.read(), "headers": {"content-type": "image/jpeg"}},
                 )
+            ] + [
+                (
+                    {"path": r"/hips_source/Norder0/Dir0/Npix%d.jpg" % npix},
+                    {"body": b"not found", "status": 404},
+                ) for npix in (3, 4, 6, 7, 10, 11)
             ]
-            with mock_httpd(("localhost", 42423), expected_reqs):
+            # Tiles are downloaded concurrently, hence in any order
+            with mock_httpd(("localhost", 42423), expected_reqs, unordered=True):
                 resp = app.get("/tms/1.0.0/hips/geodetic/0/0/0.png")
                 assert resp.content_type == "image/png"
                 img = Image.open(BytesIO(resp.body))
@@ -63,15 +83,20 @@ class TestHIPSSource(MySysTest):
             img_data = img.read()
             expected_reqs = [
                 (
-                    {"path": r"/hips_source/Norder0/Dir0/Npix10.jpg"},
+                    {"path": r"/hips_source/Norder0/Dir0/Npix6.jpg"},
                     {"body": img_data, "headers": {"content-type": "image/jpeg"}},
                 ),
                 (
-                    {"path": r"/hips_source/Norder0/Dir0/Npix6.jpg"},
+                    {"path": r"/hips_source/Norder0/Dir0/Npix7.jpg"},
+                    {"body": b"not found", "status": 404},
+                ),
+                (
+                    {"path": r"/hips_source/Norder0/Dir0/Npix10.jpg"},
                     {"body": img_data, "headers": {"content-type": "image/jpeg"}},
                 )
             ]
-            with mock_httpd(("localhost", 42423), expected_reqs):
+            # Tiles are downloaded concurrently, hence in any order
+            with mock_httpd(("localhost", 42423), expected_reqs, unordered=True):
                 resp = app.get("/tms/1.0.0/hips/geodetic/1/0/0.png")
                 assert resp.content_type == "image/png"
                 img = Image.open(BytesIO(resp.body))
@@ -80,3 +105,188 @@ class TestHIPSSource(MySysTest):
                 assert img.width == 256
                 assert img.height == 256
                 assert hashlib.md5(resp.body).hexdigest() in ('bd3dff3ccb40f9cb3edabf60c23bc86f', 'b57fe370becf5892b08e79ef2b1d2acb', 'a0c574b92f8b2dfd41f23507615cede5')
+
+
+class _SlowHIPSServer(ThreadingHTTPServer):
+    """ HIPS server answering tile requests after a delay, and recording the
+        maximum number of requests processed concurrently """
+
+    def __init__(self, delay):
+        ThreadingHTTPServer.__init__(self, ("localhost", 0), _SlowHIPSHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active_requests = 0
+        self.num_tile_requests = 0
+        self.max_active_requests = 0
+        img = BytesIO()
+        Image.new('RGB', (64, 64), (255, 0, 0)).save(img, 'JPEG')
+        self.tile_data = img.getvalue()
+
+
+class _SlowHIPSHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        if self.path.endswith('/properties'):
+            self._send(b"hips_tile_format=jpeg\nhips_order=3\nhips_tile_width=64", 'text/plain')
+            return
+        with server.lock:
+            server.active_requests += 1
+            server.num_tile_requests += 1
+            server.max_active_requests = max(server.max_active_requests, server.active_requests)
+        time.sleep(server.delay)
+        with server.lock:
+            server.active_requests -= 1
+        self._send(server.tile_data, 'image/jpeg')
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def slow_hips_server():
+    server = _SlowHIPSServer(delay=0.2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.mark.parametrize("concurrent_requests", [1, 4])
+def test_concurrent_requests(slow_hips_server, concurrent_requests):
+    server = slow_hips_server
+    url = "http://localhost:%d/hips_source" % server.server_address[1]
+    source = HIPSSource(HTTPClient(), url, 'nearest_neighbour',
+                        concurrent_requests=concurrent_requests)
+    hips_tiles = list(range(8))
+    start = time.time()
+    tiles = source.load_hips_tiles(1, hips_tiles)
+    duration = time.time() - start
+
+    assert len(tiles) == len(hips_tiles)
+    for tile in tiles:
+        assert tile.shape == (64, 64, 3)
+        assert tuple(tile[32, 32]) == (254, 0, 0)
+    assert server.max_active_requests == concurrent_requests
+    if concurrent_requests > 1:
+        # The latencies of the downloads overlap
+        assert duration < len(hips_tiles) * server.delay
+
+
+
+def test_concurrent_requests_per_get_map(slow_hips_server):
+    """ Check that concurrent callers do not share their download threads """
+    server = slow_hips_server
+    url = "http://localhost:%d/hips_source" % server.server_address[1]
+    source = HIPSSource(HTTPClient(), url, 'nearest_neighbour',
+                        concurrent_requests=2)
+    source.load_properties()
+
+    threads = [threading.Thread(target=source.load_hips_tiles, args=(1, list(range(4 * i, 4 * i + 4))))
+               for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert server.num_tile_requests == 8
+    assert server.max_active_requests == 4
+
+def test_decoded_tile_cache(slow_hips_server):
+    server = slow_hips_server
+    url = "http://localhost:%d/hips_source" % server.server_address[1]
+    tile_size = 64 * 64 * 3
+    # Room for 3 decoded tiles
+    decoded_tile_cache = LRUCache(3 * tile_size, sizeof=lambda ar: ar.nbytes)
+    source = HIPSSource(HTTPClient(), url, 'nearest_neighbour',
+                        decoded_tile_cache=decoded_tile_cache)
+
+    tiles = source.load_hips_tiles(1, [0, 1, 2])
+    assert server.num_tile_requests == 3
+    assert decoded_tile_cache.stats()['misses'] == 3
+
+    # Hits return the same arrays, without downloading or decoding them
+    assert all(x is y for x, y in zip(source.load_hips_tiles(1, [0, 1, 2]), tiles))
+    assert server.num_tile_requests == 3
+
+    source.load_hips_tile(1, 3)
+    assert server.num_tile_requests == 4
+    stats = decoded_tile_cache.stats()
+    assert stats['hits'] == 3
+    assert stats['misses'] == 4
+    assert stats['evictions'] == 1
+    assert stats['entries'] == 3
+    assert stats['size'] == 3 * tile_size
+
+
+def test_raw_tile_store(slow_hips_server, tmpdir):
+    server = slow_hips_server
+    url = "http://localhost:%d/hips_source" % server.server_address[1]
+    source = HIPSSource(HTTPClient(), url, 'nearest_neighbour',
+                        raw_tile_store_dir=tmpdir.strpath)
+    tiles = source.load_hips_tiles(1, [0, 1])
+    assert server.num_tile_requests == 2
+
+    # Another process reads the decoded tiles from the memory-mapped files
+    other_source = HIPSSource(HTTPClient(), url, 'nearest_neighbour',
+                              raw_tile_store_dir=tmpdir.strpath)
+    other_tiles = other_source.load_hips_tiles(1, [0, 1])
+    assert server.num_tile_requests == 2
+    for tile, other_tile in zip(tiles, other_tiles):
+        assert np.array_equal(tile, other_tile)
+
+
+@pytest.mark.parametrize("approx_transform_max_error", [0, 0.125])
+def test_get_map_projected(slow_hips_server, approx_transform_max_error):
+    server = slow_hips_server
+    server.delay = 0
+    url = "http://localhost:%d/hips_source" % server.server_address[1]
+    source = HIPSSource(HTTPClient(), url, 'bilinear', approx_transform_max_error=approx_transform_max_error)
+    query = MapQuery((-20037508.34, -20037508.34, 20037508.34, 20037508.34), (320, 240), SRS(3857))
+    ar = np.array(source.get_map(query).as_image())
+    assert ar.shape == (240, 320, 4)
+    assert (ar == (254, 0, 0, 255)).all()
+
+
+@pytest.mark.parametrize("resampling_method", ['nearest_neighbour', 'bilinear', 'bicubic'])
+@pytest.mark.parametrize("bbox", [(10, 10, 12, 12), (-180, -90, 180, 90), (-180, -90, 180, 270)])
+def test_create_geographic_map_image(resampling_method, bbox):
+    hips_order = 1
+    hips_shift = 5
+    pixel_order = hips_order + hips_shift
+    width, height = 200, 150
+    lon_cols = bbox[0] + (np.arange(width) + 0.5) * (bbox[2] - bbox[0]) / width
+    lat_rows = bbox[3] - (np.arange(height) + 0.5) * (bbox[3] - bbox[1]) / height
+    hips_tiles = np.unique(_geographic_hips_tiles(pixel_order, hips_shift, lon_cols, lat_rows))
+    rng = np.random.default_rng(0)
+    tiles = [rng.integers(0, 256, (32, 32, 3), dtype=np.uint8) for _ in hips_tiles]
+    mosaic = build_mosaic(hips_order, list(hips_tiles), tiles, hips_shift, 3)
+    resampling = resampling_mode(resampling_method)
+
+    # Same as with the pixel numbers and offsets of each target pixel
+    lon = np.tile(lon_cols, height)
+    lat = np.repeat(lat_rows, width)
+    valid = (lat >= -90) & (lat <= 90)
+    pixels, dx_ar, dy_ar = lonlat_to_hp_pixel(pixel_order, lon, np.clip(lat, -90, 90), return_offsets=True)
+    pixels[~valid] = -1
+    assert np.array_equal(hips_tiles, np.unique(pixels[valid] >> (2 * hips_shift)))
+    expected = np.zeros((height, width, 4), dtype=np.uint8)
+    _create_map_image(height, width, pixel_order, pixels, dx_ar, dy_ar,
+                      mosaic.mosaics, mosaic.slot_layout, mosaic.slot_of_face, mosaic.tile_origin, mosaic.tile_present,
+                      hips_shift, mosaic.halo, expected, resampling, 0.75)
+
+    result = np.zeros((height, width, 4), dtype=np.uint8)
+    _create_geographic_map_image(pixel_order, lon_cols, lat_rows,
+                                 mosaic.mosaics, mosaic.slot_layout, mosaic.slot_of_face, mosaic.tile_origin, mosaic.tile_present,
+                                 hips_shift, mosaic.halo, result, resampling, 0.75)
+    assert np.array_equal(result, expected)
+    assert result[:, :, 3].any()
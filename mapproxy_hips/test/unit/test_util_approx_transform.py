@@ -0,0 +1,66 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from mapproxy_hips.util.approx_transform import angular_error, approximate_transform, pixel_center_grid
+from pyproj import Transformer
+import numpy as np
+import pytest
+
+
+def _res(lon, lat, size):
+    """ Median distance in degrees between horizontally adjacent pixels """
+    lon = lon.reshape((size[1], size[0]))
+    lat = lat.reshape((size[1], size[0]))
+    with np.errstate(invalid='ignore'):
+        return np.nanmedian(angular_error(lon[:, 1:], lat[:, 1:], lon[:, :-1], lat[:, :-1]))
+
+
+@pytest.mark.parametrize("srs,bbox", [
+    ('EPSG:3857', (-20037508.34, -20037508.34, 20037508.34, 20037508.34)),
+    ('EPSG:3857', (-2e6, -2e6, 2e6, 2e6)),
+    ('EPSG:3413', (-4e6, -4e6, 4e6, 4e6)),
+    ('EPSG:3031', (-3e6, -3e6, 3e6, 3e6)),
+    ('ESRI:54009', (-18e6, -9e6, 18e6, 9e6)),
+    ('EPSG:32631', (0, 4e6, 1e6, 5e6)),
+])
+@pytest.mark.parametrize("max_error", [0.125, 1])
+def test_approximate_transform(srs, bbox, max_error):
+    transformer = Transformer.from_crs(srs, 'EPSG:4326', always_xy=True)
+    size = (600, 500)
+    lon, lat = transformer.transform(*pixel_center_grid(bbox, size))
+    res = _res(lon, lat, size)
+
+    approx_lon, approx_lat = approximate_transform(transformer.transform, bbox, size, max_error, res)
+    assert approx_lon.shape == lon.shape
+
+    # Points that cannot be transformed are the same
+    finite = np.isfinite(lon) & np.isfinite(lat)
+    assert (finite == (np.isfinite(approx_lon) & np.isfinite(approx_lat))).all()
+    # Worst case error in pixels
+    error = angular_error(approx_lon[finite], approx_lat[finite], lon[finite], lat[finite]) / res
+    assert error.max() <= max_error
+
+
+def test_approximate_transform_is_approximate():
+    calls = []
+
+    def transform(x, y):
+        calls.append(len(x))
+        return x, y
+
+    bbox = (0, 0, 10, 10)
+    size = (1000, 1000)
+    lon, lat = approximate_transform(transform, bbox, size, 0.125, 0.01)
+    x, y = pixel_center_grid(bbox, size)
+    assert np.allclose(lon, x) and np.allclose(lat, y)
+    # A linear transformation is interpolated from the coarsest grid
+    assert sum(calls) < 2000
+
+
+def test_approximate_transform_small_image():
+    transformer = Transformer.from_crs('EPSG:3857', 'EPSG:4326', always_xy=True)
+    bbox = (0, 0, 1e5, 1e5)
+    size = (3, 1000)
+    lon, lat = approximate_transform(transformer.transform, bbox, size, 0.125, 1e-3)
+    assert np.array_equal((lon, lat), transformer.transform(*pixel_center_grid(bbox, size)))
@@ -0,0 +1,45 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from mapproxy_hips.util.empty_tiles import EmptyTileIndex
+import os
+
+
+def test_empty_tile_index(tmpdir):
+    index = EmptyTileIndex(tmpdir.join('layer').strpath, tmpdir.strpath)
+    assert not index.is_empty(3, 5)
+
+    index.set_empty(3, 5)
+    index.set_empty(3, 767)
+    assert index.is_empty(3, 5)
+    assert index.is_empty(3, 767)
+    assert not index.is_empty(3, 4)
+    assert not index.is_empty(3, 6)
+    assert not index.is_empty(2, 5)
+    # 12 * 4^3 bits
+    assert os.path.getsize(index._filename(3)) == 96
+
+    index.set_empty(3, 5, False)
+    assert not index.is_empty(3, 5)
+    assert index.is_empty(3, 767)
+
+    # Clearing a tile of an order without index does not create it
+    index.set_empty(4, 0, False)
+    assert not os.path.exists(index._filename(4))
+
+
+def test_empty_tile_index_shared(tmpdir):
+    directory = tmpdir.join('layer').strpath
+    reader = EmptyTileIndex(directory, tmpdir.strpath)
+    writer = EmptyTileIndex(directory, tmpdir.strpath)
+
+    # Order 0 has a single byte, with 12 bits
+    writer.set_empty(0, 11)
+    assert os.path.getsize(writer._filename(0)) == 2
+    assert reader.is_empty(0, 11)
+
+    # Updates are visible through an existing mapping
+    writer.set_empty(0, 3)
+    assert reader.is_empty(0, 3)
+    assert not reader.is_empty(0, 2)
@@ -0,0 +1,90 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from mapproxy_hips.util.geometry import compute_hips_tile_geometry, \
+                                        HIPSTileGeometryCache
+import healpy as hp
+import numpy as np
+import os
+import pytest
+
+
+def test_compute_hips_tile_geometry():
+
+    geometry = compute_hips_tile_geometry(1, 16, 2)
+    assert geometry.bbox == pytest.approx((-22.5, -41.81031489577862, 22.5, 0.0))
+    assert geometry.oversampling_ratio_lon == pytest.approx(1.53499, abs=1e-5)
+    assert geometry.oversampling_ratio_lat == pytest.approx(1.42619, abs=1e-5)
+    lon, lat = hp.pix2ang(1 << 3, list(range(16 * 16, 17 * 16)), nest=True, lonlat=True)
+    assert geometry.lon == pytest.approx(lon, abs=1e-10)
+    assert geometry.lat == pytest.approx(lat, abs=1e-10)
+
+
+def test_compute_hips_tile_geometry_antimeridian():
+
+    geometry = compute_hips_tile_geometry(0, 6, 2)
+    min_lon, _, max_lon, _ = geometry.bbox
+    assert max_lon - min_lon > 90
+
+
+def test_hips_tile_geometry_cache_lru():
+
+    cache = HIPSTileGeometryCache(max_entries=2)
+    g0 = cache.get(1, 0, 2)
+    g1 = cache.get(1, 1, 2)
+    assert cache.get(1, 0, 2) is g0
+    cache.get(1, 2, 2)
+    # (1, 1, 2) was the least recently used entry
+    assert cache.get(1, 0, 2) is g0
+    assert cache.get(1, 1, 2) is not g1
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_hips_tile_geometry_cache_directory(tmpdir, dtype):
+
+    cache = HIPSTileGeometryCache(max_entries=0, directory=tmpdir.strpath, dtype=dtype)
+    g = cache.get(2, 10, 3)
+    assert g.lon.dtype == np.dtype(dtype)
+    assert os.path.exists(os.path.join(tmpdir.strpath, 'shift3', 'Norder2', 'Dir0', 'Npix10_meta.npy'))
+
+    # Read back from another cache instance, as another process would do
+    g2 = HIPSTileGeometryCache(directory=tmpdir.strpath, dtype=dtype).get(2, 10, 3)
+    assert isinstance(g2.lon, np.memmap)
+    assert np.array_equal(g.lon, g2.lon)
+    assert np.array_equal(g.lat, g2.lat)
+    assert g2.bbox == g.bbox
+    assert g2.lon_bounds == g.lon_bounds
+    assert g2.oversampling_ratio_lon == g.oversampling_ratio_lon
+
+
+def test_hips_tile_geometry_cache_invalid_dtype():
+
+    with pytest.raises(ValueError):
+        HIPSTileGeometryCache(dtype='int8')
+
+
+def test_hips_tile_geometry_cache_directory_cleanup(tmpdir, monkeypatch):
+
+    from mapproxy_hips.util import geometry
+    monkeypatch.setattr(geometry, 'DIRECTORY_CLEANUP_INTERVAL', 1)
+
+    # Room for 2 geometries of 4x4 pixels (752 bytes each, with the headers
+    # of the .npy files)
+    cache = HIPSTileGeometryCache(max_entries=0, directory=tmpdir.strpath, max_size_mb=1600 / (1024 * 1024))
+    location = lambda npix: os.path.join(tmpdir.strpath, 'shift2', 'Norder1', 'Dir0', 'Npix%d' % npix)
+    cache.get(1, 0, 2)
+    os.utime(location(0) + '_meta.npy', (0, 0))
+    cache.get(1, 1, 2)
+    os.utime(location(1) + '_meta.npy', (1, 1))
+    # Loading it makes npix 0 the most recently used geometry
+    cache.get(1, 0, 2)
+    cache.get(1, 2, 2)
+    assert os.path.exists(location(0) + '_meta.npy')
+    assert not os.path.exists(location(1) + '_meta.npy')
+    assert not os.path.exists(location(1) + '_lon.npy')
+    assert os.path.exists(location(2) + '_meta.npy')
+
+    # Removed geometries are computed again
+    g = cache.get(1, 1, 2)
+    assert np.array_equal(g.lon, compute_hips_tile_geometry(1, 1, 2).lon)
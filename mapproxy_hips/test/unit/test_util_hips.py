@@ -3,12 +3,22 @@
 # Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
 
 from mapproxy_hips.util.hips import parse_properties, \
+                               compact_bits, \
+                               spread_bits, \
                                hp_subpixel_to_axis_coord, \
                                axis_coord_to_hp_subpixel, \
+                               hp_subpixel_to_axis_coord_array, \
+                               axis_coord_to_hp_subpixel_array, \
+                               hips_tile_from_children, \
+                               hp_tiles_in_bbox, \
                                hp_boundaries_lonlat, \
+                               hp_ang2pix, \
+                               hp_pix2ang, \
+                               hp_pix2ang_array, \
                                lonlat_to_hp_pixel, \
                                healpix_resolution_degree, \
                                hips_order_for_resolution
+import healpy as hp
 import numpy as np
 import pytest
 
@@ -40,6 +50,98 @@ def test_axis_coord_to_hp_subpixel():
     assert axis_coord_to_hp_subpixel(2, (0, 3)) == 10
 
 
+def _hp_subpixel_to_axis_coord_reference(order, subpixel):
+    x = 0
+    y = 0
+    for l in range(0, order):
+        tmp = (subpixel >> (2*l)) & 3
+        x = x | ((tmp & 1) << l)
+        y = y | ((tmp >> 1) << l)
+    return (x, y)
+
+
+def test_compact_spread_bits():
+    assert spread_bits(0) == 0
+    assert spread_bits(0b1011) == 0b1000101
+    assert compact_bits(0b1000101) == 0b1011
+    assert compact_bits(0b1010) == 0
+    v = (1 << 29) - 1
+    assert compact_bits(spread_bits(v)) == v
+    ar = np.array([0, 1, 2, 3, v], dtype=np.int64)
+    assert np.array_equal(compact_bits(spread_bits(ar)), ar)
+
+
+@pytest.mark.parametrize("order", [0, 1, 5, 9, 20, 29])
+def test_hp_subpixel_to_axis_coord_array(order):
+    rng = np.random.default_rng(order)
+    subpixels = rng.integers(0, 1 << (2 * order), 1000, dtype=np.int64)
+    subpixels[0] = 0
+    subpixels[1] = (1 << (2 * order)) - 1
+    x, y = hp_subpixel_to_axis_coord_array(order, subpixels)
+    for i in range(len(subpixels)):
+        expected = _hp_subpixel_to_axis_coord_reference(order, int(subpixels[i]))
+        assert (x[i], y[i]) == expected
+        assert hp_subpixel_to_axis_coord(order, subpixels[i]) == expected
+
+    assert np.array_equal(axis_coord_to_hp_subpixel_array(order, x, y), subpixels)
+
+
+def test_hp_subpixel_to_axis_coord_array_shape():
+    x, y = hp_subpixel_to_axis_coord_array(2, [[5, 10], [15, 0]])
+    assert np.array_equal(x, np.array([[3, 0], [3, 0]]))
+    assert np.array_equal(y, np.array([[0, 3], [3, 0]]))
+    assert np.array_equal(axis_coord_to_hp_subpixel_array(2, x, y), np.array([[5, 10], [15, 0]]))
+
+
+def test_hips_tile_from_children():
+    hips_shift = 3
+    tile_size = 1 << hips_shift
+    rng = np.random.default_rng(0)
+    children = [rng.integers(0, 256, (tile_size, tile_size, 4), dtype=np.uint8) for _ in range(4)]
+    ar = hips_tile_from_children(children)
+    assert ar.shape == (tile_size, tile_size, 4)
+    assert ar.dtype == np.uint8
+
+    # Check against the NESTED numbering: the 4 sub-pixels of subpixel s
+    # of the tile are the subpixels 4*s+q at order hips_shift + 1, that
+    # belong to the child numbered by their 2 most significant bits.
+    for s in range(tile_size * tile_size):
+        x, y = hp_subpixel_to_axis_coord(hips_shift, s)
+        total = np.zeros(4, dtype=np.int64)
+        for q in range(4):
+            child_subpixel = 4 * s + q
+            c = child_subpixel >> (2 * hips_shift)
+            cx, cy = hp_subpixel_to_axis_coord(hips_shift, child_subpixel & (tile_size * tile_size - 1))
+            # The axis of the image are swapped compared to the HealPIX ones
+            total += children[c][cx, cy]
+        assert np.array_equal(ar[x, y], (total + 2) // 4)
+
+
+@pytest.mark.parametrize("order,bbox", [(3, (0, 0, 10, 10)),
+                                        (5, (-20, -30, 40, 25)),
+                                        (4, (170, -10, 200, 10)),
+                                        (4, (-180, 70, 180, 90)),
+                                        (6, (-100, -90, -60, -75)),
+                                        (2, (-180, -90, 180, 90))])
+def test_hp_tiles_in_bbox(order, bbox):
+    nside = 1 << order
+    tiles = hp_tiles_in_bbox(order, bbox)
+    assert np.array_equal(tiles, np.unique(tiles))
+
+    # All tiles containing a point of the bbox must be returned
+    rng = np.random.default_rng(0)
+    lon = rng.uniform(bbox[0], bbox[2], 10000)
+    lat = rng.uniform(bbox[1], bbox[3], 10000)
+    expected = np.unique(hp.ang2pix(nside, lon, lat, nest=True, lonlat=True))
+    assert np.all(np.isin(expected, tiles))
+
+    # And only a few more
+    if bbox == (-180, -90, 180, 90):
+        assert len(tiles) == 12 * nside * nside
+    else:
+        assert len(tiles) < 12 * nside * nside / 2
+
+
 def test_hp_boundaries_lonlat():
 
     order = 2
@@ -56,13 +158,50 @@ def test_lonlat_to_hp_pixel():
     lat = 49.0
     assert lonlat_to_hp_pixel(order, lon, lat) == 10
     assert lonlat_to_hp_pixel(order, [lon, lon], [lat, lat]) == pytest.approx(np.array([10, 10]))
-    assert lonlat_to_hp_pixel(order, lon, lat, return_offsets=True) == (10, 0.6449339464306831, 0.9237484931945801)
+    assert lonlat_to_hp_pixel(order, lon, lat, return_offsets=True) == pytest.approx((10, 0.6449339464306831, 0.9237484931945801))
     res = lonlat_to_hp_pixel(order, [lon, lon], [lat, lat], return_offsets=True)
     assert res[0] ==  pytest.approx(np.array([10,10]))
     assert res[1] ==  pytest.approx(np.array([0.6449339464306831,0.6449339464306831]))
     assert res[2] ==  pytest.approx(np.array([0.9237484931945801,0.9237484931945801]))
 
 
+@pytest.mark.parametrize("order", [0, 1, 3, 12, 20, 29])
+def test_hp_ang2pix(order):
+    rng = np.random.default_rng(order)
+    lon = rng.uniform(-180, 360, 10000)
+    lat = np.degrees(np.arcsin(rng.uniform(-1, 1, 10000)))
+    # Poles, limits of the polar caps, and a base pixel corner
+    lon[0:6] = [0, 0, 10, 10, 45, 0]
+    lat[0:6] = [90, -90, np.degrees(np.arcsin(2 / 3)), -np.degrees(np.arcsin(2 / 3)), 89.99999999, 41.8103148957786]
+    pixels, dx, dy = lonlat_to_hp_pixel(order, lon, lat, return_offsets=True)
+    assert np.array_equal(pixels, hp.ang2pix(1 << order, lon, lat, nest=True, lonlat=True))
+    assert dx.min() >= 0 and dx.max() <= 1
+    assert dy.min() >= 0 and dy.max() <= 1
+    assert hp_ang2pix(order, lon[0], lat[0]) == (pixels[0], dx[0], dy[0])
+
+    # The offsets match the position of the point in the pixels of a higher order
+    if order <= 20:
+        extra_order = 9
+        sub_pixels = hp.ang2pix(1 << (order + extra_order), lon, lat, nest=True, lonlat=True)
+        x, y = hp_subpixel_to_axis_coord_array(extra_order, sub_pixels & ((1 << (2 * extra_order)) - 1))
+        assert np.abs(x + 0.5 - dx * (1 << extra_order)).max() <= 0.5 + 1e-6
+        assert np.abs(y + 0.5 - dy * (1 << extra_order)).max() <= 0.5 + 1e-6
+
+
+@pytest.mark.parametrize("order", [0, 1, 3, 12, 29])
+def test_hp_pix2ang(order):
+    npix = 12 << (2 * order)
+    pixels = np.random.default_rng(order).integers(0, npix, 10000)
+    pixels[0:3] = [0, npix - 1, npix // 2]
+    lon, lat = hp_pix2ang_array(order, pixels)
+    expected_lon, expected_lat = hp.pix2ang(1 << order, pixels, nest=True, lonlat=True)
+    assert lon == pytest.approx(expected_lon, abs=1e-10)
+    assert lat == pytest.approx(expected_lat, abs=1e-10)
+    assert hp_pix2ang(order, pixels[0]) == (lon[0], lat[0])
+    # Round trip
+    assert np.array_equal(lonlat_to_hp_pixel(order, lon, lat), pixels)
+
+
 def test_healpix_resolution_degree():
 
     assert healpix_resolution_degree(0, 512) == 0.11451621372724687
@@ -0,0 +1,152 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from mapproxy.client.http import HTTPClient, HTTPClientError
+from mapproxy.test.http import mock_httpd
+from mapproxy_hips.util.http_cache import HTTPResourceCache
+import os
+import pytest
+import threading
+import time
+
+URL = "http://localhost:42423/hips/properties"
+
+
+def _get(headers=None):
+    return {"path": r"/hips/properties", "headers": headers or {}}
+
+
+def test_http_resource_cache_ttl(tmpdir):
+    cache = HTTPResourceCache(HTTPClient(), tmpdir.strpath, ttl=3600)
+    expected_reqs = [
+        (_get(), {"body": b"foo=bar", "headers": {"content-type": "text/plain", "ETag": '"v1"'}}),
+    ]
+    with mock_httpd(("localhost", 42423), expected_reqs):
+        resource = cache.get(URL)
+        assert resource.body == b"foo=bar"
+        assert resource.content_type == "text/plain"
+        assert resource.etag == '"v1"'
+        # Fresh: no request
+        assert cache.get(URL).body == b"foo=bar"
+
+    # Another process reuses the stored copy
+    other_cache = HTTPResourceCache(HTTPClient(), tmpdir.strpath, ttl=3600)
+    with mock_httpd(("localhost", 42423), []):
+        assert other_cache.get(URL).body == b"foo=bar"
+
+
+def test_http_resource_cache_revalidation(tmpdir):
+    cache = HTTPResourceCache(HTTPClient(), tmpdir.strpath, ttl=0)
+    last_modified = "Fri, 31 Dec 2021 12:34:56 GMT"
+    expected_reqs = [
+        (_get(), {"body": b"foo=bar", "headers": {"ETag": '"v1"', "Last-Modified": last_modified}}),
+        (_get({"If-None-Match": '"v1"', "If-Modified-Since": last_modified}),
+         {"body": b"", "status": 304}),
+        (_get({"If-None-Match": '"v1"'}),
+         {"body": b"foo=baz", "headers": {"ETag": '"v2"'}}),
+        (_get({"If-None-Match": '"v2"'}),
+         {"body": b"error", "status": 500}),
+    ]
+    with mock_httpd(("localhost", 42423), expected_reqs):
+        assert cache.get(URL).body == b"foo=bar"
+        # Not modified
+        assert cache.get(URL).body == b"foo=bar"
+        # Modified
+        assert cache.get(URL).body == b"foo=baz"
+        # Upstream error: the stale copy is served
+        assert cache.get(URL).body == b"foo=baz"
+
+
+
+def test_http_resource_cache_not_modified_not_rewritten(tmpdir):
+    cache = HTTPResourceCache(HTTPClient(), tmpdir.strpath, ttl=0)
+    expected_reqs = [
+        (_get(), {"body": b"foo=bar", "headers": {"ETag": '"v1"'}}),
+        (_get({"If-None-Match": '"v1"'}), {"body": b"", "status": 304}),
+    ]
+    with mock_httpd(("localhost", 42423), expected_reqs):
+        cache.get(URL)
+        filename = cache._filename(URL)
+        os.utime(filename, (0, 0))
+        inode = os.stat(filename).st_ino
+        assert cache.get(URL).body == b"foo=bar"
+
+    # Only the modification time of the stored copy is updated
+    assert os.stat(filename).st_ino == inode
+    assert time.time() - os.stat(filename).st_mtime < 60
+
+    # Another process sees the revalidation
+    other_cache = HTTPResourceCache(HTTPClient(), tmpdir.strpath, ttl=3600)
+    with mock_httpd(("localhost", 42423), []):
+        assert other_cache.get(URL).body == b"foo=bar"
+
+def test_http_resource_cache_error_without_copy():
+    cache = HTTPResourceCache(HTTPClient(), ttl=3600)
+    expected_reqs = [
+        (_get(), {"body": b"error", "status": 500}),
+    ]
+    with mock_httpd(("localhost", 42423), expected_reqs):
+        with pytest.raises(HTTPClientError):
+            cache.get(URL)
+
+
+class _SlowHTTPClient(object):
+    """ HTTP client answering after a delay, and recording the requested
+        URLs and the maximum number of concurrent requests """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.urls = []
+        self.active_requests = 0
+        self.max_active_requests = 0
+        self.lock = threading.Lock()
+
+    def open(self, url, headers=None):
+        with self.lock:
+            self.urls.append(url)
+            self.active_requests += 1
+            self.max_active_requests = max(self.max_active_requests, self.active_requests)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active_requests -= 1
+        return _Response(url.encode('utf-8'))
+
+
+class _Response(object):
+
+    def __init__(self, body):
+        self.body = body
+        self.headers = {}
+
+    def read(self):
+        return self.body
+
+
+def _get_concurrently(cache, urls):
+    results = {}
+
+    def get(i, url):
+        results[i] = cache.get(url).body
+
+    threads = [threading.Thread(target=get, args=(i, url)) for i, url in enumerate(urls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [results[i] for i in range(len(urls))]
+
+
+def test_http_resource_cache_concurrency():
+    http_client = _SlowHTTPClient(0.2)
+    cache = HTTPResourceCache(http_client, ttl=0)
+
+    # Different URLs are fetched concurrently
+    urls = ["http://localhost/a", "http://localhost/b"]
+    assert _get_concurrently(cache, urls) == [b"http://localhost/a", b"http://localhost/b"]
+    assert http_client.max_active_requests == 2
+
+    # Concurrent requests of the same URL are coalesced
+    del http_client.urls[:]
+    assert _get_concurrently(cache, [urls[0]] * 4) == [b"http://localhost/a"] * 4
+    assert http_client.urls == [urls[0]]
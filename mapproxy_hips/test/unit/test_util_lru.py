@@ -0,0 +1,36 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from mapproxy_hips.util.lru import LRUCache
+import time
+
+
+def test_lru_cache():
+    cache = LRUCache(10)
+    assert cache.get('a') is None
+    cache.put('a', b'1234')
+    cache.put('b', b'1234')
+    assert cache.get('a') == b'1234'
+    # Evicts b, the least recently used entry
+    cache.put('c', b'1234')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+    assert cache.get('c') == b'1234'
+    # Larger than the cache
+    cache.put('d', b'12345678901')
+    assert cache.get('d') is None
+    # Replacement
+    cache.put('a', b'12')
+    assert cache.get('a') == b'12'
+    assert cache.stats() == {'hits': 4, 'misses': 3, 'evictions': 1,
+                             'entries': 2, 'size': 6, 'max_size': 10}
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(10, ttl=0.05)
+    cache.put('a', b'1234')
+    assert cache.get('a') == b'1234'
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    assert cache.stats()['size'] == 0
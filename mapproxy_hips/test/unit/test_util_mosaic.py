@@ -0,0 +1,114 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from mapproxy_hips.util import hips
+from mapproxy_hips.util.mosaic import build_mosaic, hp_neighbour_axis_coord
+import healpy as hp
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("order", [0, 1, 3])
+def test_hp_neighbour_axis_coord(order):
+    nside = 1 << order
+    for pixel in range(12 * nside * nside):
+        face = pixel >> (2 * order)
+        x, y = hips.hp_subpixel_to_axis_coord(order, pixel & ((1 << (2 * order)) - 1))
+        neighbours = set()
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if dx == 0 and dy == 0:
+                    continue
+                new_face, new_x, new_y = hp_neighbour_axis_coord(nside, face, x + dx, y + dy)
+                if new_face >= 0:
+                    assert 0 <= new_x < nside and 0 <= new_y < nside
+                    neighbours.add((new_face << (2 * order)) +
+                                   hips.axis_coord_to_hp_subpixel(order, (new_x, new_y)))
+        expected = set(int(x) for x in hp.get_all_neighbours(nside, pixel, nest=True) if x >= 0)
+        assert neighbours == expected
+
+
+def _tile_of_pixel_numbers(order, hips_shift, npix):
+    """ Return a tile whose pixels hold (the 24 lower bits of) their HealPIX
+        pixel number at order order + hips_shift """
+    tile_size = 1 << hips_shift
+    rows, cols = np.meshgrid(np.arange(tile_size), np.arange(tile_size), indexing='ij')
+    subpixels = hips.axis_coord_to_hp_subpixel_array(hips_shift, rows, cols)
+    pixels = (npix << (2 * hips_shift)) + subpixels
+    return np.dstack(((pixels >> 16) & 255, (pixels >> 8) & 255, pixels & 255)).astype(np.uint8)
+
+
+def _pixel_number(ar):
+    return (int(ar[0]) << 16) + (int(ar[1]) << 8) + int(ar[2])
+
+
+@pytest.mark.parametrize("npix", [0, 5, 17, 28, 40])
+def test_build_mosaic_halo(npix):
+    order = 1
+    hips_shift = 3
+    halo = 2
+    pixel_order = order + hips_shift
+    nside = 1 << pixel_order
+
+    # Load a tile and all its neighbours
+    hips_tiles = [npix] + [int(x) for x in hp.get_all_neighbours(1 << order, npix, nest=True) if x >= 0]
+    tiles = [_tile_of_pixel_numbers(order, hips_shift, x) for x in hips_tiles]
+    mosaic = build_mosaic(order, hips_tiles, tiles, hips_shift, halo)
+
+    face = npix >> (2 * order)
+    slot = mosaic.slot_of_face[face]
+    tile_x, tile_y = hips.hp_subpixel_to_axis_coord(order, npix & ((1 << (2 * order)) - 1))
+    x0 = (mosaic.tile_origin[slot, 0] << hips_shift) - halo
+    y0 = (mosaic.tile_origin[slot, 1] << hips_shift) - halo
+    # Check the tile and its halo
+    for x in range((tile_x << hips_shift) - halo, ((tile_x + 1) << hips_shift) + halo):
+        for y in range((tile_y << hips_shift) - halo, ((tile_y + 1) << hips_shift) + halo):
+            value = _pixel_number(mosaic.slot_image(slot)[x - x0, y - y0])
+            new_face, new_x, new_y = hp_neighbour_axis_coord(nside, face, x, y)
+            if new_face < 0:
+                # No HealPIX pixel there: the closest pixel of the tile is replicated
+                x = min(max(x, tile_x << hips_shift), ((tile_x + 1) << hips_shift) - 1)
+                y = min(max(y, tile_y << hips_shift), ((tile_y + 1) << hips_shift) - 1)
+                new_face, new_x, new_y = face, x, y
+            expected = (new_face << (2 * pixel_order)) + \
+                hips.axis_coord_to_hp_subpixel(pixel_order, (new_x, new_y))
+            assert value == expected & 0xFFFFFF
+
+
+def test_build_mosaic_missing_tiles():
+    tile = np.full((4, 4, 3), 100, dtype=np.uint8)
+    mosaic = build_mosaic(1, [0, 3, 4], [tile, tile, None], 2, 1)
+    assert mosaic.slot_of_face[0] == 0
+    assert mosaic.slot_of_face[1] == -1
+    image = mosaic.slot_image(0)
+    assert image.shape == (2 * 4 + 2, 2 * 4 + 2, 3)
+    assert mosaic.tile_present.tolist() == [[[1, 0], [0, 1]]]
+    # Halo pixels without neighbour are replicated from the tile
+    assert (image[0:5, 0:5] == 100).all()
+    # Missing tile, outside of the halo
+    assert (image[7:9, 1:3] == 0).all()
+
+    # RGB and RGBA tiles
+    rgba_tile = np.full((4, 4, 4), 50, dtype=np.uint8)
+    mosaic = build_mosaic(0, [0, 1], [tile, rgba_tile], 2, 0)
+    assert mosaic.mosaics.shape == (2 * 4 * 4, 4)
+    assert (mosaic.slot_image(mosaic.slot_of_face[0]) == [100, 100, 100, 255]).all()
+    assert (mosaic.slot_image(mosaic.slot_of_face[1]) == 50).all()
+
+
+def test_build_mosaic_slot_sizes():
+    # One tile of base pixel 0, and 2 x 3 tiles of base pixel 1, at order 2
+    tile = np.full((4, 4, 3), 100, dtype=np.uint8)
+    order = 2
+    hips_tiles = [hips.axis_coord_to_hp_subpixel(order, (1, 2))]
+    hips_tiles += [(1 << (2 * order)) + hips.axis_coord_to_hp_subpixel(order, (x, y))
+                   for x in (0, 1) for y in (1, 2, 3)]
+    mosaic = build_mosaic(order, hips_tiles, [tile] * len(hips_tiles), 2, 1)
+
+    # Each slot is sized after its own tiles
+    assert mosaic.slot_image(mosaic.slot_of_face[0]).shape == (1 * 4 + 2, 1 * 4 + 2, 3)
+    assert mosaic.slot_image(mosaic.slot_of_face[1]).shape == (2 * 4 + 2, 3 * 4 + 2, 3)
+    assert mosaic.mosaics.shape == (6 * 6 + 10 * 14, 3)
+    assert mosaic.tile_origin[mosaic.slot_of_face[1]].tolist() == [0, 1]
+    assert (mosaic.slot_image(mosaic.slot_of_face[1])[1:9, 1:13] == 100).all()
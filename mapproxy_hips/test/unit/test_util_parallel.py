@@ -0,0 +1,58 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from mapproxy_hips.util.parallel import map_in_threads, run_in_strips
+import threading
+import pytest
+
+
+@pytest.mark.parametrize("num_items,num_threads", [(0, 4), (1, 4), (10, 1), (10, 3), (7, 8), (1000, 4)])
+def test_run_in_strips(num_items, num_threads):
+    strips = []
+    lock = threading.Lock()
+
+    def func(start, end):
+        with lock:
+            strips.append((start, end))
+
+    run_in_strips(func, num_items, num_threads)
+    strips.sort()
+    if num_items == 0:
+        assert strips == [(0, 0)]
+        return
+    # Strips must be non-empty, contiguous and cover all items
+    assert strips[0][0] == 0
+    assert strips[-1][1] == num_items
+    for i in range(len(strips)):
+        assert strips[i][0] < strips[i][1]
+        if i > 0:
+            assert strips[i][0] == strips[i - 1][1]
+    if num_threads == 1:
+        assert len(strips) == 1
+
+
+def test_run_in_strips_exception():
+
+    def func(start, end):
+        if start > 0:
+            raise ValueError('failure')
+
+    with pytest.raises(ValueError):
+        run_in_strips(func, 100, 2)
+
+
+@pytest.mark.parametrize("num_items,num_threads", [(0, 4), (1, 4), (10, 1), (10, 3)])
+def test_map_in_threads(num_items, num_threads):
+    assert map_in_threads(lambda x: x * 2, list(range(num_items)), num_threads) == \
+        [x * 2 for x in range(num_items)]
+
+
+def test_map_in_threads_exception():
+
+    def func(x):
+        if x > 0:
+            raise ValueError('failure')
+
+    with pytest.raises(ValueError):
+        map_in_threads(func, [0, 1, 2], 2)
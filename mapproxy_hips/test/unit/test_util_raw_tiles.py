@@ -0,0 +1,88 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from mapproxy_hips.util.raw_tiles import RawTileStore
+import numpy as np
+import os
+
+
+def test_raw_tile_store(tmpdir):
+    store = RawTileStore(tmpdir.strpath, 4, 3)
+    assert store.get(3, 300) is None
+
+    ar = np.arange(4 * 4 * 3, dtype=np.uint8).reshape((4, 4, 3))
+    assert store.put(3, 300, ar)
+    filename = os.path.join(tmpdir.strpath, 'Norder3', 'Block1.raw')
+    assert os.path.getsize(filename) == RawTileStore.HEADER_SIZE + RawTileStore.TILES_PER_FILE * 4 * 4 * 3
+
+    stored_ar = store.get(3, 300)
+    assert type(stored_ar) is np.ndarray
+    assert stored_ar.flags.writeable
+    assert np.array_equal(stored_ar, ar)
+    assert store.get(3, 301) is None
+    assert store.get(2, 300) is None
+
+    # Tiles written by another process are seen through the existing mapping
+    other_store = RawTileStore(tmpdir.strpath, 4, 3)
+    assert np.array_equal(other_store.get(3, 300), ar)
+    other_store.put(3, 301, ar + 1)
+    assert np.array_equal(store.get(3, 301), ar + 1)
+
+    # Arrays of another shape are not stored
+    assert not store.put(3, 302, np.zeros((4, 4), dtype=np.uint8))
+    assert not store.put(3, 302, np.zeros((8, 8, 3), dtype=np.uint8))
+    assert store.get(3, 302) is None
+
+
+def test_raw_tile_store_rgba(tmpdir):
+    store = RawTileStore(tmpdir.strpath, 4, 4)
+    ar = np.full((4, 4, 3), 10, dtype=np.uint8)
+    assert store.put(0, 0, ar)
+    stored_ar = store.get(0, 0)
+    assert stored_ar.shape == (4, 4, 4)
+    assert np.array_equal(stored_ar[:, :, 0:3], ar)
+    assert (stored_ar[:, :, 3] == 255).all()
+
+
+def test_raw_tile_store_max_open_files(tmpdir):
+    store = RawTileStore(tmpdir.strpath, 4, 3, max_open_files=4)
+    ar = np.full((4, 4, 3), 10, dtype=np.uint8)
+    for block in range(20):
+        store.put(3, block * RawTileStore.TILES_PER_FILE, ar)
+
+    num_fds = len(os.listdir('/proc/self/fd'))
+    in_use = store.get(3, 0)
+    for block in range(20):
+        assert np.array_equal(store.get(3, block * RawTileStore.TILES_PER_FILE), ar)
+    # The mappings evicted from the LRU are closed, but the ones of arrays
+    # still in use
+    assert len(store._memmaps) == 4
+    assert len(os.listdir('/proc/self/fd')) <= num_fds + 5
+    assert np.array_equal(in_use, ar)
+
+
+def test_raw_tile_store_cleanup(tmpdir, monkeypatch):
+    from mapproxy_hips.util import raw_tiles
+    monkeypatch.setattr(raw_tiles, 'DIRECTORY_CLEANUP_INTERVAL', 1)
+
+    # 64x64 RGB tiles, 12 kB each: room for 2 blocks with 1 tile each,
+    # whatever the block size of the file system
+    store = RawTileStore(tmpdir.strpath, 64, 3, max_size_mb=40 / 1024)
+    ar = np.full((64, 64, 3), 10, dtype=np.uint8)
+    filename = lambda block: os.path.join(tmpdir.strpath, 'Norder3', 'Block%d.raw' % block)
+    store.put(3, 0, ar)
+    os.utime(filename(0), (0, 0))
+    store.put(3, RawTileStore.TILES_PER_FILE, ar)
+    os.utime(filename(1), (1, 1))
+    # Using it makes block 0 the most recently used one
+    assert store.get(3, 0) is not None
+    store.put(3, 2 * RawTileStore.TILES_PER_FILE, ar)
+    assert os.path.exists(filename(0))
+    assert not os.path.exists(filename(1))
+    assert os.path.exists(filename(2))
+
+    # Removed tiles are stored again in a new file, seen by the store
+    assert store.get(3, RawTileStore.TILES_PER_FILE) is None
+    store.put(3, RawTileStore.TILES_PER_FILE, ar)
+    assert np.array_equal(store.get(3, RawTileStore.TILES_PER_FILE), ar)
@@ -5,7 +5,13 @@
 from mapproxy_hips.util.resampling import bilinear_weight, \
                                      cubic_weight, \
                                      bilinear_resample, \
-                                     bicubic_resample
+                                     bicubic_resample, \
+                                     resample, \
+                                     resample_points, \
+                                     resampling_mode, \
+                                     RESAMPLING_NEAREST, \
+                                     RESAMPLING_BILINEAR, \
+                                     RESAMPLING_BICUBIC
 import numpy
 import pytest
 
@@ -55,6 +61,39 @@ def test_bicubic_resample():
         for i_dst in range(ar.shape[1]):
             assert bicubic_resample(ar, i_dst, j_dst, 1, 1) == ar[j_dst][i_dst]
 
+def test_resampling_mode():
+    assert resampling_mode('nearest_neighbour') == RESAMPLING_NEAREST
+    assert resampling_mode('bilinear') == RESAMPLING_BILINEAR
+    assert resampling_mode('bicubic') == RESAMPLING_BICUBIC
+    with pytest.raises(ValueError):
+        resampling_mode('invalid')
+
+
+def test_resample():
+    ar = numpy.arange(8*12).reshape(8,12).astype(numpy.float32)
+    assert resample(RESAMPLING_BILINEAR, ar, 3.25, 2.5, 0.5, 1) == bilinear_resample(ar, 3.25, 2.5, 0.5, 1)
+    assert resample(RESAMPLING_BICUBIC, ar, 3.25, 2.5, 0.5, 1) == bicubic_resample(ar, 3.25, 2.5, 0.5, 1)
+
+@pytest.mark.parametrize("resampling", [RESAMPLING_BILINEAR, RESAMPLING_BICUBIC])
+@pytest.mark.parametrize("x_scale,y_scale", [(1, 1), (0.3, 0.45), (2, 0.7)])
+def test_resample_points(resampling, x_scale, y_scale):
+    rng = numpy.random.default_rng(0)
+    ar = rng.integers(0, 256, (20, 30, 4)).astype(numpy.uint8)
+    xs = numpy.concatenate((rng.uniform(0, ar.shape[1] - 1, 200), [0, ar.shape[1] - 1, 0.5]))
+    ys = numpy.concatenate((rng.uniform(0, ar.shape[0] - 1, 200), [ar.shape[0] - 1, 0, 0.5]))
+
+    out = numpy.empty((xs.shape[0], ar.shape[2]))
+    resample_points(resampling, ar, xs, ys, x_scale, y_scale, out)
+    for n in range(xs.shape[0]):
+        for k in range(ar.shape[2]):
+            # Must be bit-identical to the single channel code path
+            assert out[n, k] == resample(resampling, ar[:,:,k], xs[n], ys[n], x_scale, y_scale)
+
+    out_float32 = numpy.empty((xs.shape[0], ar.shape[2]), dtype=numpy.float32)
+    resample_points(resampling, ar, xs, ys, x_scale, y_scale, out_float32)
+    assert numpy.abs(out_float32 - out).max() < 1e-3
+
+
 @pytest.mark.parametrize("method", ["bicubic", "bilinear"])
 def test_resample_against_gdal(method):
 
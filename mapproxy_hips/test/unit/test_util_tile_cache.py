@@ -0,0 +1,47 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from io import BytesIO
+from mapproxy.image import ImageSource
+from mapproxy_hips.util.tile_cache import HIPSTileCacheBackend
+import os
+import pytest
+import sqlite3
+
+
+@pytest.mark.parametrize("cache_type", ['file', 'mbtiles'])
+def test_tile_cache_backend(tmpdir, cache_type):
+    backend = HIPSTileCacheBackend(cache_type)
+    cache = backend.create_cache(tmpdir.strpath, 'png')
+    assert backend.open_tile(cache, 3, 5) is None
+    assert not cache.is_cached(backend.tile(3, 5))
+
+    tiles = []
+    for npix in (5, 6):
+        tile = backend.tile(3, npix)
+        tile.source = ImageSource(BytesIO(b'content%d' % npix))
+        tiles.append(tile)
+    cache.store_tiles(tiles)
+
+    assert cache.is_cached(backend.tile(3, 5))
+    with backend.open_tile(cache, 3, 6) as f:
+        assert f.read() == b'content6'
+    assert backend.open_tile(cache, 2, 6) is None
+
+
+def test_tile_cache_backend_mbtiles_layout(tmpdir):
+    backend = HIPSTileCacheBackend('mbtiles')
+    cache = backend.create_cache(tmpdir.strpath, 'jpg')
+    tile = backend.tile(3, 5)
+    tile.source = ImageSource(BytesIO(b'content'))
+    cache.store_tile(tile)
+
+    with sqlite3.connect(os.path.join(tmpdir.strpath, 'jpg.mbtiles')) as db:
+        rows = db.execute('SELECT zoom_level, tile_column, tile_row FROM tiles').fetchall()
+    assert rows == [(3, 5, 0)]
+
+
+def test_tile_cache_backend_invalid():
+    with pytest.raises(ValueError):
+        HIPSTileCacheBackend('foo')
@@ -0,0 +1,173 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+import numpy as np
+
+# Width in pixels of the cells of the coarsest and finest grids
+MAX_CELL_SIZE = 128
+MIN_CELL_SIZE = 8
+
+# Number of intervals between the check points along each side of a cell
+CHECK_SUBDIVISIONS = 4
+
+
+def pixel_center_grid(bbox, size):
+    """ Return the (x, y) float64 arrays of the coordinates of the center of
+        the pixels of an image of size (width, height) covering bbox, row by
+        row from the top one.
+    """
+    resx = (bbox[2] - bbox[0]) / size[0]
+    resy = (bbox[3] - bbox[1]) / size[1]
+    x = bbox[0] + (np.arange(size[0], dtype=np.float64) + 0.5) * resx
+    y = bbox[3] - (np.arange(size[1], dtype=np.float64) + 0.5) * resy
+    return np.tile(x, size[1]), np.repeat(y, size[0])
+
+
+def angular_error(lon, lat, ref_lon, ref_lat):
+    """ Return the (approximate) angular distance in degrees between
+        (lon, lat) and (ref_lon, ref_lat) """
+    dlon = (lon - ref_lon + 180) % 360 - 180
+    return np.hypot(dlon * np.cos(np.radians(ref_lat)), lat - ref_lat)
+
+
+def approximate_transform(transform, bbox, size, max_error, res):
+    """ Return the (lon, lat) arrays of the center of the pixels of an image
+        of size (width, height) covering bbox, as pixel_center_grid(), but
+        transformed by transform(x, y) -> (lon, lat) arrays in degrees.
+
+        Like GDAL's approximate transformer, only the corners of cells of
+        pixels are transformed exactly, and the other pixels are bilinearly
+        interpolated from them. Cells, of MAX_CELL_SIZE pixels at first, are
+        checked on a grid of points, and those where the interpolation is off
+        by more than max_error pixels of res degrees are split in 4, down to
+        MIN_CELL_SIZE pixels. The pixels of the cells that are still not
+        accurate enough, typically around discontinuities of the projection
+        (antimeridian, poles, limits of validity), are transformed exactly.
+    """
+    width, height = size
+    resx = (bbox[2] - bbox[0]) / width
+    resy = (bbox[3] - bbox[1]) / height
+    max_error_deg = max_error * res
+
+    def transform_pixels(rows, cols):
+        return transform(bbox[0] + (cols + 0.5) * resx, bbox[3] - (rows + 0.5) * resy)
+
+    with np.errstate(invalid='ignore'):
+        lon = np.empty((height, width), dtype=np.float64)
+        lat = np.empty((height, width), dtype=np.float64)
+        pending = np.ones((height, width), dtype=bool)
+
+        cell_size = MAX_CELL_SIZE
+        while cell_size >= MIN_CELL_SIZE and min(width, height) > cell_size:
+            # Pending pixels are the ones of the cells of the previous grid
+            # that failed the check, hence whole cells of the current one
+            _interpolate_cells(transform_pixels, width, height, cell_size,
+                               pending, max_error_deg, lon, lat)
+            if not pending.any():
+                break
+            cell_size //= 2
+
+        rows, cols = np.nonzero(pending)
+        if len(rows):
+            lon[rows, cols], lat[rows, cols] = transform_pixels(rows.astype(np.float64), cols.astype(np.float64))
+
+    return lon.reshape(-1), lat.reshape(-1)
+
+
+def _cell_nodes(length, cell_size):
+    """ Return the pixel indices of the edges of the cells of cell_size pixels
+        covering length pixels, and the index of the cell of each pixel """
+    nodes = np.arange(0, length, cell_size)
+    if nodes[-1] != length - 1:
+        nodes = np.append(nodes, length - 1)
+    cell_of_pixel = np.minimum(np.arange(length) // cell_size, len(nodes) - 2)
+    return nodes, cell_of_pixel
+
+
+def _interpolate_cells(transform_pixels, width, height, cell_size, pending, max_error_deg, lon, lat):
+    """ Fill the pending pixels of the cells of cell_size pixels that are
+        accurate enough with their bilinear interpolation, and mark them as no
+        longer pending """
+    col_nodes, cell_of_col = _cell_nodes(width, cell_size)
+    row_nodes, cell_of_row = _cell_nodes(height, cell_size)
+    num_cols = len(col_nodes) - 1
+    num_rows = len(row_nodes) - 1
+
+    # Cells with pending pixels: as pending pixels are whole cells of a
+    # coarser grid, checking their top-left pixel is enough
+    cells = pending[row_nodes[:-1]][:, col_nodes[:-1]]
+    if not cells.any():
+        return
+
+    # Grid of the check points: the corners of the cells, and the points
+    # dividing them in CHECK_SUBDIVISIONS x CHECK_SUBDIVISIONS. Checking only
+    # the center of the cells would miss errors symmetric around it.
+    k = CHECK_SUBDIVISIONS
+    steps = np.arange(k)
+    grid_cols = (col_nodes[:-1, np.newaxis] + (steps * np.diff(col_nodes)[:, np.newaxis]) // k).reshape(-1)
+    grid_cols = np.append(grid_cols, col_nodes[-1])
+    grid_rows = (row_nodes[:-1, np.newaxis] + (steps * np.diff(row_nodes)[:, np.newaxis]) // k).reshape(-1)
+    grid_rows = np.append(grid_rows, row_nodes[-1])
+
+    # Only transform the points of the pending cells
+    needed = np.zeros((k * num_rows + 1, k * num_cols + 1), dtype=bool)
+    for dr in range(k + 1):
+        for dc in range(k + 1):
+            needed[dr:dr + k * num_rows:k, dc:dc + k * num_cols:k] |= cells
+    grid_lon = np.full(needed.shape, np.nan)
+    grid_lat = np.full(needed.shape, np.nan)
+    r, c = np.nonzero(needed)
+    grid_lon[r, c], grid_lat[r, c] = transform_pixels(grid_rows[r].astype(np.float64),
+                                                      grid_cols[c].astype(np.float64))
+
+    # Compare the check points of the pending cells to their bilinear
+    # interpolation from the corners of their cell. Non finite coordinates
+    # give a NaN error, and make the cell fail.
+    cell_rows, cell_cols = np.nonzero(cells)
+    rows0 = k * cell_rows
+    cols0 = k * cell_cols
+    corners_lon = (grid_lon[rows0, cols0], grid_lon[rows0, cols0 + k],
+                   grid_lon[rows0 + k, cols0], grid_lon[rows0 + k, cols0 + k])
+    corners_lat = (grid_lat[rows0, cols0], grid_lat[rows0, cols0 + k],
+                   grid_lat[rows0 + k, cols0], grid_lat[rows0 + k, cols0 + k])
+    row_sizes = np.diff(row_nodes)[cell_rows]
+    col_sizes = np.diff(col_nodes)[cell_cols]
+    cell_ok = np.ones(len(cell_rows), dtype=bool)
+    for dr in range(k + 1):
+        v = (grid_rows[rows0 + dr] - row_nodes[cell_rows]) / row_sizes
+        for dc in range(k + 1):
+            u = (grid_cols[cols0 + dc] - col_nodes[cell_cols]) / col_sizes
+            error = angular_error(_bilinear(corners_lon, u, v), _bilinear(corners_lat, u, v),
+                                  grid_lon[rows0 + dr, cols0 + dc], grid_lat[rows0 + dr, cols0 + dc])
+            cell_ok &= error <= max_error_deg
+    ok = np.zeros_like(cells)
+    ok[cell_rows[cell_ok], cell_cols[cell_ok]] = True
+
+    if not ok.any():
+        return
+
+    # Interpolate the pixels of the accurate cells, one row of cells at a time
+    u = (np.arange(width) - col_nodes[cell_of_col]) / np.diff(col_nodes)[cell_of_col]
+    corners_lon = [corner[:, cell_of_col] for corner in
+                   (grid_lon[0:-1:k, 0:-1:k], grid_lon[0:-1:k, k::k], grid_lon[k::k, 0:-1:k], grid_lon[k::k, k::k])]
+    corners_lat = [corner[:, cell_of_col] for corner in
+                   (grid_lat[0:-1:k, 0:-1:k], grid_lat[0:-1:k, k::k], grid_lat[k::k, 0:-1:k], grid_lat[k::k, k::k])]
+    for cell_row in np.nonzero(ok.any(axis=1))[0]:
+        r0 = row_nodes[cell_row]
+        r1 = row_nodes[cell_row + 1] if cell_row < num_rows - 1 else height
+        v = ((np.arange(r0, r1) - r0) / (row_nodes[cell_row + 1] - r0))[:, np.newaxis]
+        ok_cols = ok[cell_row][cell_of_col]
+        for dst, corners in ((lon, corners_lon), (lat, corners_lat)):
+            np.copyto(dst[r0:r1], _bilinear([corner[cell_row] for corner in corners], u, v), where=ok_cols)
+        pending[r0:r1] &= ~ok_cols
+
+
+def _bilinear(corners, u, v):
+    """ Bilinear interpolation of the (top-left, top-right, bottom-left,
+        bottom-right) corners at the relative positions u (columns) and v
+        (rows) in [0, 1] """
+    top_left, top_right, bottom_left, bottom_right = corners
+    top = top_left + (top_right - top_left) * u
+    bottom = bottom_left + (bottom_right - bottom_left) * u
+    return top + (bottom - top) * v
@@ -0,0 +1,96 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from mapproxy.util.lock import FileLock
+import hashlib
+import mmap
+import os
+import threading
+
+
+class EmptyTileIndex(object):
+    """ Index of the fully transparent HIPS tiles of a layer.
+
+        Rather than storing an image file for each of them, empty tiles are
+        recorded in one bitmap file per order, with one bit per tile in NESTED
+        order (1.5 * 4^norder bytes), stored in directory/NorderK/empty_tiles.bin.
+
+        Reads are done through a memory mapping of the file, without locking.
+        Updates are done in place, under a lock file in lock_dir, so that
+        they are seen by the mappings of other processes.
+    """
+
+    FILENAME = 'empty_tiles.bin'
+
+    def __init__(self, directory, lock_dir, lock_timeout=60.0):
+        self.directory = directory
+        self.lock_dir = lock_dir
+        self.lock_timeout = lock_timeout
+        self._mmaps = {}
+        # FileLock only protects against other processes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(norder):
+        """ Size in bytes of the bitmap of order norder """
+        return ((12 << (2 * norder)) + 7) // 8
+
+    def _filename(self, norder):
+        return os.path.join(self.directory, 'Norder%d' % norder, self.FILENAME)
+
+    def _lock_filename(self, norder):
+        h = hashlib.md5(self._filename(norder).encode('UTF-8')).hexdigest()
+        return os.path.join(self.lock_dir, 'hips-empty-tiles-' + h + '.lck')
+
+    def _get_mmap(self, norder):
+        """ Return a read-only memory mapping of the bitmap of order norder,
+            or None if it does not exist yet """
+        m = self._mmaps.get(norder)
+        if m is not None:
+            return m
+        filename = self._filename(norder)
+        try:
+            with open(filename, 'rb') as f:
+                # The file is created with its final size under lock, but
+                # may be read while being created
+                if os.fstat(f.fileno()).st_size != self._size(norder):
+                    return None
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            return self._mmaps.setdefault(norder, m)
+
+    def is_empty(self, norder, npix):
+        """ Return whether tile npix of order norder is recorded as empty """
+        m = self._get_mmap(norder)
+        if m is None:
+            return False
+        return (m[npix >> 3] >> (npix & 7)) & 1 == 1
+
+    def set_empty(self, norder, npix, empty=True):
+        """ Record tile npix of order norder as empty (or not) """
+        filename = self._filename(norder)
+        with self._lock, FileLock(self._lock_filename(norder), timeout=self.lock_timeout):
+            if not os.path.exists(filename):
+                if not empty:
+                    return
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                tmp_filename = filename + '.tmp'
+                with open(tmp_filename, 'wb') as f:
+                    f.truncate(self._size(norder))
+                os.replace(tmp_filename, filename)
+
+            fd = os.open(filename, os.O_RDWR)
+            try:
+                offset = npix >> 3
+                value = os.pread(fd, 1, offset)[0]
+                if empty:
+                    new_value = value | (1 << (npix & 7))
+                else:
+                    new_value = value & ~(1 << (npix & 7))
+                if new_value != value:
+                    os.pwrite(fd, bytes([new_value]), offset)
+            finally:
+                os.close(fd)
@@ -0,0 +1,253 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from collections import OrderedDict
+from mapproxy_hips.util.hips import hp_boundaries_lonlat, hp_pix2ang_array, healpix_resolution_degree
+import numpy as np
+import logging
+import os
+import tempfile
+import threading
+
+log_hips = logging.getLogger('mapproxy.hips')
+
+# Number of geometries stored by a process between two checks of the size
+# of the directory of a HIPSTileGeometryCache
+DIRECTORY_CLEANUP_INTERVAL = 64
+
+_FILE_SUFFIXES = ('_meta.npy', '_lon.npy', '_lat.npy')
+
+
+class HIPSTileGeometry(object):
+    """ HealPIX geometry of a HIPS tile, that only depends on (norder, npix, hips_shift).
+
+        - lon, lat: arrays of the coordinates (in degree) of the center of
+          the tile_size^2 HealPIX pixels of the tile, in NESTED order.
+        - lon_bounds, lat_bounds: coordinates of the 4 corners of the tile.
+        - bbox: (min_lon, min_lat, max_lon, max_lat) geographic extent of the tile.
+          For tiles crossing the antimeridian, max_lon - min_lon is larger
+          than 90 degrees.
+        - oversampling_ratio_lon, oversampling_ratio_lat: ratio between the
+          extent of the tile and the one of tile_size HealPIX pixels, in
+          longitude and latitude.
+    """
+
+    def __init__(self, lon, lat, lon_bounds, lat_bounds, bbox,
+                 oversampling_ratio_lon, oversampling_ratio_lat):
+        self.lon = lon
+        self.lat = lat
+        self.lon_bounds = lon_bounds
+        self.lat_bounds = lat_bounds
+        self.bbox = bbox
+        self.oversampling_ratio_lon = oversampling_ratio_lon
+        self.oversampling_ratio_lat = oversampling_ratio_lat
+
+    def _meta_array(self):
+        """ Serialize all members, but lon and lat, as an array """
+        return np.array(list(self.lon_bounds) + list(self.lat_bounds) + list(self.bbox) +
+                        [self.oversampling_ratio_lon, self.oversampling_ratio_lat], dtype=np.float64)
+
+    @staticmethod
+    def _from_arrays(lon, lat, meta):
+        return HIPSTileGeometry(lon, lat,
+                                [float(x) for x in meta[0:4]],
+                                [float(x) for x in meta[4:8]],
+                                tuple(float(x) for x in meta[8:12]),
+                                float(meta[12]), float(meta[13]))
+
+
+def compute_hips_tile_geometry(norder, npix, hips_shift, dtype=np.float64):
+    """ Compute the HIPSTileGeometry of tile npix at order norder, with tiles
+        of 2^hips_shift x 2^hips_shift pixels """
+
+    tile_size = 1 << hips_shift
+
+    # Get the coordinates of the 4 corners of our HealPIX pixel of interest
+    lon_bounds, lat_bounds = hp_boundaries_lonlat(norder, npix)
+    lon_bounds = [ float(x) if x <= 180 else float(x) - 360 for x in lon_bounds ]
+    lat_bounds = [ float(x) for x in lat_bounds ]
+
+    # Do not take into account longitudes at poles
+    min_lon = float('inf')
+    max_lon = -float('inf')
+    found_lon_180 = False
+    for i in range(len(lon_bounds)):
+        if abs(lat_bounds[i]) != 90:
+            min_lon = min(min_lon, lon_bounds[i])
+            if lon_bounds[i] == 180:
+                found_lon_180 = True
+            else:
+                max_lon = max(max_lon, lon_bounds[i])
+
+    #for norder=0, tile=2, lon_bounds = [0.0, 180.0, -135.00000000000003, -90.0]
+    if found_lon_180:
+        if max_lon < 0:
+            min_lon = -180
+        else:
+            max_lon = 180
+
+    min_lat = min(lat_bounds)
+    max_lat = max(lat_bounds)
+
+    # Compute the angular resolution of a HealPIX pixel
+    healpix_resolution = healpix_resolution_degree(norder, tile_size)
+
+    # Compute the oversampling ratio to go from hips tile resolution
+    # to geodetic tile resolution.
+    oversampling_ratio_lat = (max_lat - min_lat) / (tile_size * healpix_resolution)
+    EPSILON = 1e-5
+    if max_lon - min_lon <= 90 + EPSILON:
+        oversampling_ratio_lon = (max_lon - min_lon) / (tile_size * healpix_resolution)
+    else:
+        oversampling_ratio_lon = (lon_bounds[3] + 360 - lon_bounds[1]) / (tile_size * healpix_resolution)
+
+    healpix_pix_offset = npix * tile_size * tile_size
+    pixels = np.arange(healpix_pix_offset, healpix_pix_offset + tile_size * tile_size, dtype=np.int64)
+    lon, lat = hp_pix2ang_array(hips_shift + norder, pixels)
+
+    return HIPSTileGeometry(np.ascontiguousarray(lon, dtype=dtype),
+                            np.ascontiguousarray(lat, dtype=dtype),
+                            lon_bounds, lat_bounds,
+                            (float(min_lon), float(min_lat), float(max_lon), float(max_lat)),
+                            float(oversampling_ratio_lon), float(oversampling_ratio_lat))
+
+
+class HIPSTileGeometryCache(object):
+    """ Cache of HIPSTileGeometry objects.
+
+        Recently used geometries are kept in a bounded in-memory LRU.
+        If directory is set, geometries are also persisted there as .npy files,
+        loaded as memory-mapped arrays, so that they are computed only once
+        and shared between all worker processes.
+
+        The directory grows with the number of distinct tiles rendered. If
+        max_size_mb is set, the least recently loaded geometries are removed
+        from it by cleanup(), called every DIRECTORY_CLEANUP_INTERVAL
+        geometries stored by the process, when it exceeds that size.
+    """
+
+    def __init__(self, max_entries=16, directory=None, dtype='float64', max_size_mb=0):
+        if dtype not in ('float32', 'float64'):
+            raise ValueError(f'unsupported geometry cache dtype = {dtype}')
+        self.max_entries = max_entries
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._num_stored = 0
+
+    def _location(self, norder, npix, hips_shift):
+        """ Return the prefix of the .npy files of a tile geometry """
+        return os.path.join(self.directory, f'shift{hips_shift}', f'Norder{norder}',
+                            f'Dir{(npix // 10000) * 10000}', f'Npix{npix}')
+
+    def _load(self, location):
+        try:
+            meta = np.load(location + '_meta.npy')
+            lon = np.load(location + '_lon.npy', mmap_mode='r')
+            lat = np.load(location + '_lat.npy', mmap_mode='r')
+        except (IOError, ValueError):
+            return None
+        if lon.dtype != self.dtype or lat.dtype != self.dtype:
+            return None
+        if self.max_size > 0:
+            # The modification time of the _meta.npy file is the last use
+            # of the geometry for cleanup()
+            try:
+                os.utime(location + '_meta.npy')
+            except OSError:
+                pass
+        return HIPSTileGeometry._from_arrays(lon, lat, meta)
+
+    def _store(self, location, geometry):
+        dirname = os.path.dirname(location)
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            # The _meta.npy file is written last, so that its presence
+            # indicates that the _lon and _lat ones are complete.
+            for suffix, ar in (('_lon.npy', geometry.lon),
+                               ('_lat.npy', geometry.lat),
+                               ('_meta.npy', geometry._meta_array())):
+                fd, tmp_filename = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        np.save(f, ar)
+                    os.replace(tmp_filename, location + suffix)
+                except OSError:
+                    os.unlink(tmp_filename)
+                    raise
+        except OSError as e:
+            log_hips.warning('cannot store tile geometry in %s: %s', dirname, e)
+            return
+
+        if self.max_size > 0:
+            with self._lock:
+                self._num_stored += 1
+                cleanup = self._num_stored % DIRECTORY_CLEANUP_INTERVAL == 0
+            if cleanup:
+                self.cleanup()
+
+    def cleanup(self):
+        """ Remove the least recently used geometries of directory until the
+            size of their files is below max_size_mb. Geometries removed while
+            memory-mapped by a process remain valid in it. """
+
+        entries = []
+        total_size = 0
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('_meta.npy'):
+                    continue
+                location = os.path.join(dirpath, filename[:-len('_meta.npy')])
+                try:
+                    stats = [os.stat(location + suffix) for suffix in _FILE_SUFFIXES]
+                except OSError:
+                    # Incomplete, or being removed by another process
+                    continue
+                size = sum(stat.st_size for stat in stats)
+                entries.append((stats[0].st_mtime, location, size))
+                total_size += size
+
+        entries.sort()
+        for _, location, size in entries:
+            if total_size <= self.max_size:
+                break
+            # The _meta.npy file is removed first, so that the geometry is
+            # no longer loaded
+            for suffix in _FILE_SUFFIXES:
+                try:
+                    os.unlink(location + suffix)
+                except OSError:
+                    pass
+            total_size -= size
+
+    def get(self, norder, npix, hips_shift):
+        """ Return the HIPSTileGeometry of tile npix at order norder """
+
+        key = (norder, npix, hips_shift)
+        with self._lock:
+            geometry = self._entries.get(key)
+            if geometry is not None:
+                self._entries.move_to_end(key)
+                return geometry
+
+        geometry = None
+        if self.directory:
+            location = self._location(norder, npix, hips_shift)
+            geometry = self._load(location)
+            if geometry is None:
+                geometry = compute_hips_tile_geometry(norder, npix, hips_shift, self.dtype)
+                self._store(location, geometry)
+        else:
+            geometry = compute_hips_tile_geometry(norder, npix, hips_shift, self.dtype)
+
+        if self.max_entries > 0:
+            with self._lock:
+                self._entries[key] = geometry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        return geometry
@@ -9,7 +9,7 @@ try:
     from numba import jit
 except:
     class jit(object):
-        def __init__(self, nopython = True, nogil = True):
+        def __init__(self, nopython = True, nogil = True, cache = False):
             pass
 
         def __call__(self, f):
@@ -32,7 +32,37 @@ def parse_properties(content_utf8):
     return d
 
 
-@jit(nopython=True)
+@jit(nopython=True, nogil=True, cache=True)
+def compact_bits(v):
+    """ Extract the even bits of v (a 64-bit integer or an array of them)
+        and pack them together: bit 2*i of v becomes bit i of the result.
+        This is the inverse of spread_bits().
+    """
+    v = v & 0x5555555555555555
+    v = (v | (v >> 1)) & 0x3333333333333333
+    v = (v | (v >> 2)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v >> 4)) & 0x00FF00FF00FF00FF
+    v = (v | (v >> 8)) & 0x0000FFFF0000FFFF
+    v = (v | (v >> 16)) & 0x00000000FFFFFFFF
+    return v
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def spread_bits(v):
+    """ Spread the 32 lower bits of v (a 64-bit integer or an array of them)
+        over the even bits of the result: bit i of v becomes bit 2*i of the result.
+        This is the inverse of compact_bits().
+    """
+    v = v & 0x00000000FFFFFFFF
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+@jit(nopython=True, nogil=True, cache=True)
 def hp_subpixel_to_axis_coord(order, subpixel):
     """ Convert HealPIX subpixel coordinates to axis coordinates.
         The x axis goes from the bottom point of the diamond to the north-east direction
@@ -53,25 +83,306 @@ def hp_subpixel_to_axis_coord(order, subpixel):
             2 -> x,y=0,1
             3 -> x,y=1,1
        """
-    x = 0
-    y = 0
     assert subpixel >= 0 and subpixel < (1 << (2 * order))
-    for l in range(0, order):
-        tmp = (subpixel >> (2*l)) & 3
-        x = x | ((tmp & 1) << l)
-        y = y | ((tmp >> 1) << l)
-
-    return (x, y)
+    return (compact_bits(subpixel), compact_bits(subpixel >> 1))
 
 
 def axis_coord_to_hp_subpixel(order, xy_tuple):
+    """ Convert axis coordinates to HealPIX subpixel coordinates.
+        This is the inverse of :func:hp_subpixel_to_axis_coord()
+    """
     x, y = xy_tuple
     assert x >= 0 and x < (1 << order)
     assert y >= 0 and y < (1 << order)
-    subpixel = 0
-    for l in range(0, order):
-        subpixel = subpixel | ((((x >> l) & 1) | (((y >> l) & 1) << 1)) << (2*l))
-    return subpixel
+    return int(spread_bits(x) | (spread_bits(y) << 1))
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _hp_subpixel_to_axis_coord_array(subpixels, x, y):
+    for i in range(subpixels.shape[0]):
+        x[i] = compact_bits(subpixels[i])
+        y[i] = compact_bits(subpixels[i] >> 1)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _axis_coord_to_hp_subpixel_array(x, y, subpixels):
+    for i in range(subpixels.shape[0]):
+        subpixels[i] = spread_bits(x[i]) | (spread_bits(y[i]) << 1)
+
+
+def hp_subpixel_to_axis_coord_array(order, subpixels):
+    """ Array version of :func:hp_subpixel_to_axis_coord().
+        Return a (x, y) tuple of int64 arrays, of the shape of subpixels.
+    """
+    subpixels = np.asarray(subpixels, dtype=np.int64)
+    assert subpixels.size == 0 or (subpixels.min() >= 0 and subpixels.max() < (1 << (2 * order)))
+    flat = np.ascontiguousarray(subpixels).reshape(-1)
+    x = np.empty(flat.shape, dtype=np.int64)
+    y = np.empty(flat.shape, dtype=np.int64)
+    _hp_subpixel_to_axis_coord_array(flat, x, y)
+    return x.reshape(subpixels.shape), y.reshape(subpixels.shape)
+
+
+def axis_coord_to_hp_subpixel_array(order, x, y):
+    """ Array version of :func:axis_coord_to_hp_subpixel().
+        Return an int64 array of the shape of x and y.
+    """
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    assert x.shape == y.shape
+    assert x.size == 0 or (x.min() >= 0 and x.max() < (1 << order))
+    assert y.size == 0 or (y.min() >= 0 and y.max() < (1 << order))
+    subpixels = np.empty(x.size, dtype=np.int64)
+    _axis_coord_to_hp_subpixel_array(np.ascontiguousarray(x).reshape(-1),
+                                     np.ascontiguousarray(y).reshape(-1),
+                                     subpixels)
+    return subpixels.reshape(x.shape)
+
+
+# Row (in units of nside, from the north pole) of the southernmost corner,
+# and longitude (in units of 45 degrees) of the center, of each base pixel
+_JRLL = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4], dtype=np.int64)
+_JPLL = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7], dtype=np.int64)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def hp_lon_term(lon):
+    """ Return the longitude lon in degrees in units of 90 degrees, in
+        [0, 4), as expected by hp_loc2pix() """
+    tt = (lon / 90.0) % 4.0
+    if tt >= 4.0:
+        tt = 0.0
+    return tt
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def hp_lat_terms(lat):
+    """ Return the (z, polar_scale) of the latitude lat in degrees, as
+        expected by hp_loc2pix(): z = sin(lat), and
+        polar_scale = sqrt(3 * (1 - |z|)), computed accurately near the poles """
+    z = math.sin(math.radians(lat))
+    return z, math.cos(math.radians(lat)) * math.sqrt(3.0 / (1.0 + abs(z)))
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def hp_loc2pix(order, tt, z, polar_scale):
+    """ hp_ang2pix() for a point given by the terms of its longitude
+        (hp_lon_term()) and latitude (hp_lat_terms()), which can be computed
+        once per column and row of a geographic image.
+
+        This is the algorithm of loc2pix() of the HEALPix C++ library, with
+        continuous coordinates.
+    """
+    nside = 1 << order
+    za = abs(z)
+
+    if za <= 2.0 / 3:
+        # Equatorial region: coordinates along the ascending (jp) and
+        # descending (jm) edge lines
+        temp1 = nside * (0.5 + tt)
+        temp2 = nside * (z * 0.75)
+        jp = temp1 - temp2
+        jm = temp1 + temp2
+        ijp = math.floor(jp)
+        ijm = math.floor(jm)
+        ifp = ijp >> order
+        ifm = ijm >> order
+        if ifp == ifm:
+            face = ifp | 4
+        elif ifp < ifm:
+            face = ifp
+        else:
+            face = ifm + 8
+        ix = ijm & (nside - 1)
+        iy = nside - (ijp & (nside - 1)) - 1
+        dx = jm - ijm
+        dy = 1.0 - (jp - ijp)
+    else:
+        # Polar caps
+        ntt = min(3, int(tt))
+        tp = tt - ntt
+        tmp = nside * polar_scale
+        jp = tp * tmp
+        jm = (1.0 - tp) * tmp
+        ijp = min(math.floor(jp), nside - 1)
+        ijm = min(math.floor(jm), nside - 1)
+        fp = min(jp - ijp, 1.0)
+        fm = min(jm - ijm, 1.0)
+        if z >= 0:
+            face = ntt
+            ix = nside - ijm - 1
+            iy = nside - ijp - 1
+            dx = 1.0 - fm
+            dy = 1.0 - fp
+        else:
+            face = ntt + 8
+            ix = ijp
+            iy = ijm
+            dx = fp
+            dy = fm
+
+    pixel = (face << (2 * order)) + (spread_bits(ix) | (spread_bits(iy) << 1))
+    return pixel, dx, dy
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def hp_ang2pix(order, lon, lat):
+    """ Return the (pixel, dx, dy) of the NESTED HealPIX pixel at order
+        containing the point of longitude lon and latitude lat (in degrees),
+        where dx and dy, in [0, 1], are the fractional axis coordinates of the
+        point within the pixel (see hp_subpixel_to_axis_coord()).
+    """
+    z, polar_scale = hp_lat_terms(lat)
+    return hp_loc2pix(order, hp_lon_term(lon), z, polar_scale)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def hp_pix2ang(order, pixel):
+    """ Return the (lon, lat) in degrees of the center of the NESTED HealPIX
+        pixel at order, with lon in [0, 360), as healpy.pix2ang(lonlat=True).
+
+        This is the algorithm of pix2loc() of the HEALPix C++ library.
+    """
+    nside = 1 << order
+    face = pixel >> (2 * order)
+    subpixel = pixel & ((1 << (2 * order)) - 1)
+    ix = compact_bits(subpixel)
+    iy = compact_bits(subpixel >> 1)
+
+    # Ring number, counted from the north pole
+    jr = (_JRLL[face] << order) - ix - iy - 1
+    kshift = 0
+    if jr < nside:
+        nr = jr
+        tmp = (nr * nr) / (3.0 * nside * nside)
+        z = 1.0 - tmp
+        sth = math.sqrt(tmp * (2.0 - tmp))
+    elif jr > 3 * nside:
+        nr = 4 * nside - jr
+        tmp = (nr * nr) / (3.0 * nside * nside)
+        z = tmp - 1.0
+        sth = math.sqrt(tmp * (2.0 - tmp))
+    else:
+        nr = nside
+        z = (2 * nside - jr) * 2.0 / (3.0 * nside)
+        sth = math.sqrt((1.0 - z) * (1.0 + z))
+        kshift = (jr - nside) & 1
+
+    jp = (_JPLL[face] * nr + ix - iy + 1 + kshift) // 2
+    if jp > 4 * nside:
+        jp -= 4 * nside
+    if jp < 1:
+        jp += 4 * nside
+    lon = (jp - (kshift + 1) * 0.5) * (90.0 / nr)
+    return lon, math.degrees(math.atan2(z, sth))
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _hp_ang2pix_array(order, lon, lat, pixels, dx, dy):
+    for i in range(pixels.shape[0]):
+        pixels[i], dx[i], dy[i] = hp_ang2pix(order, lon[i], lat[i])
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _hp_pix2ang_array(order, pixels, lon, lat):
+    for i in range(pixels.shape[0]):
+        lon[i], lat[i] = hp_pix2ang(order, pixels[i])
+
+
+def hp_pix2ang_array(order, pixels):
+    """ Array version of :func:hp_pix2ang().
+        Return a (lon, lat) tuple of float64 arrays, of the shape of pixels.
+    """
+    pixels = np.asarray(pixels, dtype=np.int64)
+    flat = np.ascontiguousarray(pixels).reshape(-1)
+    lon = np.empty(flat.shape, dtype=np.float64)
+    lat = np.empty(flat.shape, dtype=np.float64)
+    _hp_pix2ang_array(order, flat, lon, lat)
+    return lon.reshape(pixels.shape), lat.reshape(pixels.shape)
+
+
+def hips_tile_from_children(children):
+    """ Build a HIPS tile from the 4 tiles of its NESTED children
+        (4*npix+c for c in 0...3) at the next order, as (tile_size, tile_size,
+        channels) uint8 arrays, by downsampling them by a factor of 2 with a
+        box filter.
+
+        As the axis of the image are swapped compared to the HealPIX ones,
+        child c covers the rows starting at (c & 1) * tile_size / 2 and the
+        columns starting at (c >> 1) * tile_size / 2 of the tile.
+    """
+    tile_size = children[0].shape[0]
+    half_size = tile_size // 2
+    ar = np.empty((tile_size, tile_size, children[0].shape[2]), dtype=np.uint8)
+    for c in range(4):
+        child = children[c].astype(np.uint16)
+        row = (c & 1) * half_size
+        col = (c >> 1) * half_size
+        ar[row:row + half_size, col:col + half_size] = \
+            (child[0::2, 0::2] + child[1::2, 0::2] + child[0::2, 1::2] + child[1::2, 1::2] + 2) >> 2
+    return ar
+
+
+def _bbox_piece_vertices(lon0, lon1, lat_equatorward, lat_poleward):
+    """ Return the vertices of a convex spherical polygon containing the
+        [lon0, lon1] x [lat_equatorward, lat_poleward] geographic box,
+        lying in a single hemisphere, with lon1 - lon0 small.
+
+        The great circle arc between two points of a parallel bulges towards
+        the pole. Hence the poleward edge is approximated by a single arc,
+        which contains the box, and the equatorward edge is densified.
+    """
+    num_segments = 1
+    if lat_equatorward != 0:
+        num_segments = max(1, int(math.ceil(lon1 - lon0)))
+    lons = [lon0 + (lon1 - lon0) * i / num_segments for i in range(num_segments + 1)]
+    lats = [lat_equatorward] * (num_segments + 1)
+    if abs(lat_poleward) == 90:
+        lons.append(0.0)
+        lats.append(lat_poleward)
+    else:
+        lons += [lon1, lon0]
+        lats += [lat_poleward, lat_poleward]
+    return hp.ang2vec(np.array(lons), np.array(lats), lonlat=True)
+
+
+def hp_tiles_in_bbox(order, bbox, margin=None, max_piece_width=10.0):
+    """ Return the sorted array of the NESTED HEALPix pixels at order that
+        intersect the bbox=(min_lon, min_lat, max_lon, max_lat) geographic
+        box, in degrees. max_lon may be larger than 180 for boxes crossing
+        the antimeridian.
+
+        The result may contain a few pixels around the box: the box is
+        enlarged by margin degrees (by default the size of a pixel) and
+        decomposed in convex pieces at most max_piece_width degrees wide
+        in longitude, on each side of the equator, that are passed to
+        healpy.query_polygon().
+    """
+    nside = 1 << order
+    npix = 12 * nside * nside
+    if margin is None:
+        margin = math.degrees(hp.nside2resol(nside))
+    min_lon, min_lat, max_lon, max_lat = bbox
+    min_lat = max(-90.0, min_lat - margin)
+    max_lat = min(90.0, max_lat + margin)
+    min_lon -= margin
+    max_lon += margin
+    if max_lon - min_lon >= 360 and min_lat == -90 and max_lat == 90:
+        return np.arange(npix, dtype=np.int64)
+    max_lon = min(max_lon, min_lon + 360)
+
+    num_pieces = max(1, int(math.ceil((max_lon - min_lon) / max_piece_width)))
+    pixels = []
+    for i in range(num_pieces):
+        lon0 = min_lon + (max_lon - min_lon) * i / num_pieces
+        lon1 = min_lon + (max_lon - min_lon) * (i + 1) / num_pieces
+        if max_lat > 0:
+            vertices = _bbox_piece_vertices(lon0, lon1, max(min_lat, 0.0), max_lat)
+            pixels.append(hp.query_polygon(nside, vertices, inclusive=True, nest=True))
+        if min_lat < 0:
+            vertices = _bbox_piece_vertices(lon0, lon1, min(max_lat, 0.0), min_lat)
+            pixels.append(hp.query_polygon(nside, vertices, inclusive=True, nest=True))
+    return np.unique(np.concatenate(pixels)).astype(np.int64)
 
 
 def hp_boundaries_lonlat(order, pixel):
@@ -91,20 +402,28 @@ def hp_boundaries_lonlat_with_astropy_healpix(order, pixel):
 
 
 def lonlat_to_hp_pixel(order, lon, lat, return_offsets=False):
+    """ Return the NESTED HealPIX pixel(s) at order containing the point(s)
+        of longitude lon and latitude lat in degrees, and if return_offsets,
+        the fractional axis coordinates of the points within them, as
+        a (pixel, dx, dy) tuple (see hp_ang2pix()).
+    """
+    if np.ndim(lon) == 0 and np.ndim(lat) == 0:
+        pixel, dx, dy = hp_ang2pix(order, float(lon), float(lat))
+        return (pixel, dx, dy) if return_offsets else pixel
+
+    lon = np.ascontiguousarray(lon, dtype=np.float64)
+    lat = np.ascontiguousarray(lat, dtype=np.float64)
+    lon, lat = np.broadcast_arrays(lon, lat)
+    shape = lon.shape
+    lon = np.ascontiguousarray(lon).reshape(-1)
+    lat = np.ascontiguousarray(lat).reshape(-1)
+    pixels = np.empty(lon.shape, dtype=np.int64)
+    dx = np.empty(lon.shape, dtype=np.float64)
+    dy = np.empty(lon.shape, dtype=np.float64)
+    _hp_ang2pix_array(order, lon, lat, pixels, dx, dy)
     if not return_offsets:
-        nside = 1 << order
-        return hp.ang2pix(nside, lon, lat, nest=True, lonlat=True)
-
-    # healpy can't handle order > 29
-    extra_order = 29 - order
-    nside = 1 << (order + extra_order)
-    pixel = hp.ang2pix(nside, lon, lat, nest=True, lonlat=True)
-    if isinstance(pixel, list) or isinstance(pixel, np.int64):
-        x, y = hp_subpixel_to_axis_coord(extra_order, pixel % (1 << (2 * extra_order)))
-        return pixel >> (2 * extra_order), x / float(1 << extra_order), y / float(1 << extra_order)
-    else:
-        xy = np.array([hp_subpixel_to_axis_coord(extra_order, p % (1 << (2 * extra_order))) for p in pixel]).reshape((len(pixel), 2)).transpose()
-        return pixel >> (2 * extra_order), xy[0] / float(1 << extra_order), xy[1] / float(1 << extra_order)
+        return pixels.reshape(shape)
+    return pixels.reshape(shape), dx.reshape(shape), dy.reshape(shape)
 
 
 def lonlat_to_hp_pixel_with_astropy_healpix(order, lon, lat, return_offsets=False):
@@ -0,0 +1,172 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from mapproxy.client.http import HTTPClientError
+from mapproxy.util.fs import ensure_directory, write_atomic
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+log_hips = logging.getLogger('mapproxy_hips')
+
+
+class HTTPResource(object):
+    """ Content of a resource downloaded by HTTPResourceCache """
+
+    def __init__(self, body, content_type=None, etag=None, last_modified=None, fetch_time=0):
+        self.body = body
+        self.content_type = content_type
+        # Validators returned by the server, used for conditional requests
+        self.etag = etag
+        self.last_modified = last_modified
+        # time.time() of the last download or successful revalidation
+        self.fetch_time = fetch_time
+
+
+class HTTPResourceCache(object):
+    """ Cache of resources downloaded with a MapProxy HTTPClient.
+
+        Resources younger than ttl seconds are returned without contacting
+        the server. Older ones are revalidated with a conditional request
+        (If-None-Match / If-Modified-Since). If the server cannot be reached
+        or returns an error, the stale copy is returned, and the server is
+        not contacted again before ttl seconds.
+
+        If directory is set, resources are also stored in it, so that they
+        are shared between processes and survive restarts.
+    """
+
+    def __init__(self, http_client, directory=None, ttl=0):
+        self.http_client = http_client
+        self.directory = directory
+        self.ttl = ttl
+        self._resources = {}
+        # Locks of the URLs being revalidated, so that requests for
+        # different URLs do not wait for each other
+        self._url_locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """ Return the HTTPResource of url. Raises HTTPClientError if it cannot
+            be downloaded and no copy is cached.
+
+            Concurrent requests of the same URL are coalesced: the ones
+            waiting for a revalidation use its result.
+        """
+
+        resource = self._resources.get(url)
+        if resource is not None and self._is_fresh(resource):
+            return resource
+
+        start_time = time.time()
+        with self._lock:
+            url_lock = self._url_locks.setdefault(url, threading.Lock())
+        with url_lock:
+            # Another thread may have revalidated it while we were waiting
+            resource = self._resources.get(url)
+            if resource is not None and resource.fetch_time > start_time:
+                return resource
+            if resource is None or not self._is_fresh(resource):
+                # Another process may have revalidated it
+                stored_resource = self._read(url)
+                if stored_resource is not None and \
+                   (resource is None or stored_resource.fetch_time > resource.fetch_time):
+                    resource = stored_resource
+            if resource is None or not self._is_fresh(resource):
+                resource = self._fetch(url, resource)
+            self._resources[url] = resource
+            return resource
+
+    def _is_fresh(self, resource):
+        return time.time() - resource.fetch_time < self.ttl
+
+    def _fetch(self, url, resource):
+        """ Download url, or revalidate resource if it is not None """
+
+        headers = {}
+        if resource is not None:
+            if resource.etag:
+                headers['If-None-Match'] = resource.etag
+            if resource.last_modified:
+                headers['If-Modified-Since'] = resource.last_modified
+        try:
+            resp = self.http_client.open(url, headers=headers)
+            new_resource = HTTPResource(resp.read(),
+                                        content_type=resp.headers.get('Content-Type'),
+                                        etag=resp.headers.get('ETag'),
+                                        last_modified=resp.headers.get('Last-Modified'),
+                                        fetch_time=time.time())
+        except HTTPClientError as e:
+            if resource is None:
+                raise
+            if e.response_code == 304:
+                resource.fetch_time = time.time()
+                self._touch(url, resource)
+            else:
+                log_hips.warning('could not revalidate %s, using cached copy: %s', url, e)
+                # Do not retry before the end of a new TTL period, but
+                # let other processes try, as it is not stored
+                resource.fetch_time = time.time()
+            return resource
+
+        self._write(url, new_resource)
+        return new_resource
+
+    def _filename(self, url):
+        return os.path.join(self.directory, hashlib.md5(url.encode('utf-8')).hexdigest())
+
+    def _read(self, url):
+        """ Return the HTTPResource of url stored in directory, or None """
+
+        if not self.directory:
+            return None
+        try:
+            with open(self._filename(url), 'rb') as f:
+                # A JSON line with the metadata, followed by the body
+                metadata = json.loads(f.readline())
+                body = f.read()
+                # Revalidations only update the modification time
+                mtime = os.fstat(f.fileno()).st_mtime
+        except (OSError, ValueError):
+            return None
+        if metadata.get('url') != url:
+            return None
+        return HTTPResource(body,
+                            content_type=metadata.get('content_type'),
+                            etag=metadata.get('etag'),
+                            last_modified=metadata.get('last_modified'),
+                            fetch_time=max(metadata.get('fetch_time', 0), mtime))
+
+    def _touch(self, url, resource):
+        """ Record the revalidation of the stored copy of url, by setting the
+            modification time of its file to the fetch_time of resource,
+            rather than writing it again """
+        if not self.directory:
+            return
+        try:
+            os.utime(self._filename(url), (resource.fetch_time, resource.fetch_time))
+        except FileNotFoundError:
+            self._write(url, resource)
+        except OSError as e:
+            log_hips.warning('cannot update %s: %s', self._filename(url), e)
+
+    def _write(self, url, resource):
+        if not self.directory:
+            return
+        metadata = {
+            'url': url,
+            'content_type': resource.content_type,
+            'etag': resource.etag,
+            'last_modified': resource.last_modified,
+            'fetch_time': resource.fetch_time,
+        }
+        filename = self._filename(url)
+        try:
+            ensure_directory(filename)
+            write_atomic(filename, json.dumps(metadata).encode('utf-8') + b'\n' + resource.body)
+        except OSError as e:
+            log_hips.warning('cannot store %s in %s: %s', url, filename, e)
@@ -0,0 +1,86 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+    """ Thread-safe in-memory LRU cache, bounded by the total size of its
+        values, as returned by sizeof (len() by default, e.g. for bytes).
+
+        If ttl is set, entries older than ttl seconds are not returned
+        anymore. Values larger than max_size are not cached.
+
+        Hits, misses and evictions are counted, see stats().
+    """
+
+    def __init__(self, max_size, ttl=None, sizeof=len):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return the value of key, or None if it is not cached """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, size, timestamp = entry
+                if self.ttl is None or time.monotonic() - timestamp < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                # Expired
+                del self._entries[key]
+                self._size -= size
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """ Insert or replace the value of key, evicting the least recently
+            used entries if needed """
+
+        size = self.sizeof(value)
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._size -= old_entry[1]
+            if size > self.max_size:
+                return
+            while self._size + size > self.max_size:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+            self._entries[key] = (value, size, time.monotonic())
+            self._size += size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """ Return a dictionary with the hits, misses, evictions, entries,
+            size and max_size values of the cache """
+
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'size': self._size,
+                'max_size': self.max_size,
+            }
@@ -0,0 +1,275 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+import logging
+import math
+import numpy as np
+
+from mapproxy_hips.util.hips import hp_subpixel_to_axis_coord_array
+from mapproxy_hips.util.resampling import RESAMPLING_NEAREST, _filter_radius
+
+try:
+    from numba import jit
+except:
+    class jit(object):
+        def __init__(self, nopython = True, nogil = True, cache = False):
+            pass
+
+        def __call__(self, f):
+            return f
+
+log_hips = logging.getLogger('mapproxy_hips')
+
+# Tables of the HEALPix C++ library (healpix_base.cc, neighbors()) giving,
+# for an offset of a position outside of a base pixel, the neighbouring base
+# pixel, and the transformation of the axis coordinates to apply in it.
+# Rows are indexed by 4 + (x offset) + 3 * (y offset), with offsets in
+# (-1, 0, 1) units of nside. -1 means that there is no neighbour.
+_NB_FACEARRAY = np.array([
+    [8, 9, 10, 11, -1, -1, -1, -1, 10, 11, 8, 9],   # S
+    [5, 6, 7, 4, 8, 9, 10, 11, 9, 10, 11, 8],       # SE
+    [-1, -1, -1, -1, 5, 6, 7, 4, -1, -1, -1, -1],   # E
+    [4, 5, 6, 7, 11, 8, 9, 10, 11, 8, 9, 10],       # SW
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11],         # center
+    [1, 2, 3, 0, 0, 1, 2, 3, 5, 6, 7, 4],           # NE
+    [-1, -1, -1, -1, 7, 4, 5, 6, -1, -1, -1, -1],   # W
+    [3, 0, 1, 2, 3, 0, 1, 2, 4, 5, 6, 7],           # NW
+    [2, 3, 0, 1, -1, -1, -1, -1, 0, 1, 2, 3],       # N
+], dtype=np.int64)
+
+# Indexed by the same rows, and by the base pixel row (north polar,
+# equatorial, south polar). Bit 0: flip x, bit 1: flip y, bit 2: swap x and y
+_NB_SWAPARRAY = np.array([
+    [0, 0, 3],
+    [0, 0, 6],
+    [0, 0, 0],
+    [0, 0, 5],
+    [0, 0, 0],
+    [5, 0, 0],
+    [0, 0, 0],
+    [6, 0, 0],
+    [3, 0, 0],
+], dtype=np.int64)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def hp_neighbour_axis_coord(nside, face, x, y):
+    """ Given axis coordinates (x, y) relative to base pixel face, with
+        -nside <= x, y < 2 * nside, return the (face, x, y) of the same
+        position, with 0 <= x, y < nside, or face = -1 if it falls where
+        there is no base pixel (corners where only 3 base pixels meet).
+    """
+    nbnum = 4
+    if x < 0:
+        x += nside
+        nbnum -= 1
+    elif x >= nside:
+        x -= nside
+        nbnum += 1
+    if y < 0:
+        y += nside
+        nbnum -= 3
+    elif y >= nside:
+        y -= nside
+        nbnum += 3
+    new_face = _NB_FACEARRAY[nbnum, face]
+    if new_face < 0:
+        return -1, 0, 0
+    bits = _NB_SWAPARRAY[nbnum, face >> 2]
+    if bits & 1:
+        x = nside - x - 1
+    if bits & 2:
+        y = nside - y - 1
+    if bits & 4:
+        x, y = y, x
+    return new_face, x, y
+
+
+class HIPSMosaic(object):
+    """ HIPS tiles of a single order assembled in dense images, one per base
+        pixel (a slot), with a halo around them taken from the neighbouring
+        tiles, so that interpolation does not stop at tile edges.
+
+        - mosaics: (num_pixels, channels) uint8 array with the images of all
+          slots, each one sized after its own tiles, one after the other.
+          See slot_image().
+        - slot_layout: (num_slots, 3) array with the index in mosaics of the
+          first pixel of the image of each slot, and its height and width.
+          Row r and column c of the image of a slot hold the HealPIX pixel of
+          axis coordinates
+          x = (tile_origin[slot, 0] << hips_shift) - halo + r,
+          y = (tile_origin[slot, 1] << hips_shift) - halo + c.
+          (the axis of the image are swapped compared to the HealPIX ones)
+        - slot_of_face: (12,) array with the slot of each base pixel, or -1
+        - tile_origin: (num_slots, 2) array with the axis coordinates of the
+          first tile of each slot
+        - tile_present: (num_slots, rows, cols) array with 1 for each tile
+          of each slot that could be loaded, padded with 0 to the number of
+          rows and columns of tiles of the largest slot
+    """
+
+    def __init__(self, mosaics, slot_layout, slot_of_face, tile_origin, tile_present, hips_shift, halo):
+        self.mosaics = mosaics
+        self.slot_layout = slot_layout
+        self.slot_of_face = slot_of_face
+        self.tile_origin = tile_origin
+        self.tile_present = tile_present
+        self.hips_shift = hips_shift
+        self.halo = halo
+
+    def slot_image(self, slot):
+        """ Return the (height, width, channels) image of a slot, as a view of mosaics """
+        return slot_image(self.mosaics, self.slot_layout, slot)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def slot_image(mosaics, slot_layout, slot):
+    """ Return the (height, width, channels) image of a slot of a HIPSMosaic,
+        as a view of mosaics """
+    offset = slot_layout[slot, 0]
+    height = slot_layout[slot, 1]
+    width = slot_layout[slot, 2]
+    return mosaics[offset:offset + height * width].reshape((height, width, mosaics.shape[1]))
+
+
+def mosaic_halo(resampling, src_to_tgt_scaling):
+    """ Return the width in pixels of the halo needed to interpolate with
+        resampling (a RESAMPLING_xxx constant) at a source-to-target scaling """
+    if resampling == RESAMPLING_NEAREST:
+        return 0
+    return int(math.ceil(_filter_radius(resampling) / min(src_to_tgt_scaling, 1.0))) + 1
+
+
+def build_mosaic(hips_tile_order, hips_tiles, tiles, hips_shift, halo):
+    """ Return the HIPSMosaic of the tiles of order hips_tile_order, whose
+        numbers are in hips_tiles, and (tile_size, tile_size, channels) arrays,
+        or None if not loaded, in tiles.
+
+        Tiles of unexpected dimensions are ignored.
+    """
+    tile_size = 1 << hips_shift
+    loaded = []
+    num_channels = 3
+    for hips_tile, tile in zip(hips_tiles, tiles):
+        if tile is None:
+            continue
+        if tile.ndim == 2:
+            tile = np.dstack((tile, tile, tile))
+        if tile.shape[0] != tile_size or tile.shape[1] != tile_size or tile.shape[2] not in (3, 4):
+            log_hips.warning('tile %d,%d has not expected shape', hips_tile_order, hips_tile)
+            continue
+        num_channels = max(num_channels, tile.shape[2])
+        loaded.append((hips_tile, tile))
+
+    faces = np.array([hips_tile >> (2 * hips_tile_order) for hips_tile, _ in loaded], dtype=np.int64)
+    tiles_x, tiles_y = hp_subpixel_to_axis_coord_array(
+        hips_tile_order, np.array([hips_tile for hips_tile, _ in loaded], dtype=np.int64) & ((1 << (2 * hips_tile_order)) - 1))
+
+    slot_of_face = np.full(12, -1, dtype=np.int64)
+    used_faces = np.unique(faces)
+    slot_of_face[used_faces] = np.arange(len(used_faces))
+    num_slots = max(len(used_faces), 1)
+
+    # Each slot covers the bounding box of its tiles
+    tile_origin = np.zeros((num_slots, 2), dtype=np.int64)
+    slot_layout = np.zeros((num_slots, 3), dtype=np.int64)
+    slot_rows = np.ones(num_slots, dtype=np.int64)
+    slot_cols = np.ones(num_slots, dtype=np.int64)
+    for slot, face in enumerate(used_faces):
+        mask = faces == face
+        tile_origin[slot] = (tiles_x[mask].min(), tiles_y[mask].min())
+        slot_rows[slot] = tiles_x[mask].max() - tiles_x[mask].min() + 1
+        slot_cols[slot] = tiles_y[mask].max() - tiles_y[mask].min() + 1
+    slot_layout[:, 1] = (slot_rows << hips_shift) + 2 * halo
+    slot_layout[:, 2] = (slot_cols << hips_shift) + 2 * halo
+    slot_sizes = slot_layout[:, 1] * slot_layout[:, 2]
+    slot_layout[1:, 0] = np.cumsum(slot_sizes)[:-1]
+
+    mosaics = np.zeros((int(slot_sizes.sum()), num_channels), dtype=np.uint8)
+    tile_present = np.zeros((num_slots, int(slot_rows.max()), int(slot_cols.max())), dtype=np.uint8)
+    for (_, tile), face, x, y in zip(loaded, faces, tiles_x, tiles_y):
+        slot = slot_of_face[face]
+        row = int(x - tile_origin[slot, 0])
+        col = int(y - tile_origin[slot, 1])
+        tile_present[slot, row, col] = 1
+        r = halo + (row << hips_shift)
+        c = halo + (col << hips_shift)
+        image = slot_image(mosaics, slot_layout, slot)
+        image[r:r + tile_size, c:c + tile_size, 0:tile.shape[2]] = tile
+        if tile.shape[2] < num_channels:
+            image[r:r + tile_size, c:c + tile_size, 3] = 255
+
+    if halo > 0 and len(loaded) > 0:
+        _fill_halo(mosaics, slot_layout, slot_of_face, tile_origin, tile_present,
+                   hips_tile_order + hips_shift, hips_shift, halo)
+
+    return HIPSMosaic(mosaics, slot_layout, slot_of_face, tile_origin, tile_present, hips_shift, halo)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _find_pixel(slot_of_face, tile_origin, tile_present, nside, hips_shift, halo,
+                face, x, y):
+    """ Return the (slot, row, col) of the pixel of axis coordinates (x, y)
+        of base pixel face, possibly outside of it, or slot = -1 if it is
+        not in a loaded tile """
+    if x < 0 or y < 0 or x >= nside or y >= nside:
+        if x < -nside or y < -nside or x >= 2 * nside or y >= 2 * nside:
+            return -1, 0, 0
+        face, x, y = hp_neighbour_axis_coord(nside, face, x, y)
+        if face < 0:
+            return -1, 0, 0
+    slot = slot_of_face[face]
+    if slot < 0:
+        return -1, 0, 0
+    tile_row = (x >> hips_shift) - tile_origin[slot, 0]
+    tile_col = (y >> hips_shift) - tile_origin[slot, 1]
+    if tile_row < 0 or tile_col < 0 or tile_row >= tile_present.shape[1] or \
+       tile_col >= tile_present.shape[2] or tile_present[slot, tile_row, tile_col] == 0:
+        return -1, 0, 0
+    return slot, x - (tile_origin[slot, 0] << hips_shift) + halo, y - (tile_origin[slot, 1] << hips_shift) + halo
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _fill_halo(mosaics, slot_layout, slot_of_face, tile_origin, tile_present, pixel_order, hips_shift, halo):
+    """ Fill the pixels of the mosaics that are not in a loaded tile, but
+        within halo pixels of one, from the neighbouring tiles, crossing base
+        pixel edges if needed, or by replicating the closest loaded pixel """
+    nside = 1 << pixel_order
+    tile_size = 1 << hips_shift
+    for face in range(12):
+        slot = slot_of_face[face]
+        if slot < 0:
+            continue
+        image = slot_image(mosaics, slot_layout, slot)
+        height = image.shape[0]
+        width = image.shape[1]
+        x0 = (tile_origin[slot, 0] << hips_shift) - halo
+        y0 = (tile_origin[slot, 1] << hips_shift) - halo
+        for tile_row in range(tile_present.shape[1]):
+            for tile_col in range(tile_present.shape[2]):
+                if tile_present[slot, tile_row, tile_col] == 0:
+                    continue
+                # Window of the tile extended by the halo, clipped to the mosaic
+                r0 = tile_row * tile_size
+                c0 = tile_col * tile_size
+                r1 = r0 + tile_size + 2 * halo
+                c1 = c0 + tile_size + 2 * halo
+                for r in range(r0, min(r1, height)):
+                    for c in range(c0, min(c1, width)):
+                        # Skip pixels of loaded tiles
+                        if r >= halo and c >= halo:
+                            tr = (r - halo) >> hips_shift
+                            tc = (c - halo) >> hips_shift
+                            if tr < tile_present.shape[1] and tc < tile_present.shape[2] and \
+                               tile_present[slot, tr, tc] != 0:
+                                continue
+                        src_slot, src_r, src_c = _find_pixel(
+                            slot_of_face, tile_origin, tile_present, nside, hips_shift, halo,
+                            face, x0 + r, y0 + c)
+                        if src_slot < 0:
+                            # Replicate the closest pixel of the tile
+                            src_slot = slot
+                            src_r = min(max(r, r0 + halo), r0 + halo + tile_size - 1)
+                            src_c = min(max(c, c0 + halo), c0 + halo + tile_size - 1)
+                        image[r, c] = slot_image(mosaics, slot_layout, src_slot)[src_r, src_c]
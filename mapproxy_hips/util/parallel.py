@@ -0,0 +1,65 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+# Thread pools shared by all users requesting the same number of threads
+_executors = {}
+_executors_lock = threading.Lock()
+
+# Number of strips per thread. More strips than threads balances the load
+# when some parts of the image are cheaper to process than others (e.g.
+# pixels outside of the source image).
+STRIPS_PER_THREAD = 4
+
+
+def _get_executor(num_threads):
+    with _executors_lock:
+        executor = _executors.get(num_threads)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=num_threads,
+                                          thread_name_prefix='mapproxy_hips_render')
+            _executors[num_threads] = executor
+        return executor
+
+
+def run_in_strips(func, num_items, num_threads):
+    """ Call func(start, end) on consecutive, non-overlapping, strips covering
+        range(num_items), using up to num_threads threads.
+
+        func is typically a wrapper around a numba kernel compiled with
+        nogil=True, that only writes output items in [start, end), so
+        that strips are processed concurrently and the result is identical
+        to the one of func(0, num_items).
+    """
+    if num_threads <= 1 or num_items <= 1:
+        func(0, num_items)
+        return
+
+    num_strips = min(num_items, num_threads * STRIPS_PER_THREAD)
+    bounds = [num_items * i // num_strips for i in range(num_strips + 1)]
+    executor = _get_executor(num_threads)
+    futures = [executor.submit(func, bounds[i], bounds[i + 1])
+               for i in range(num_strips) if bounds[i] < bounds[i + 1]]
+    # Propagate exceptions
+    for future in futures:
+        future.result()
+
+
+def map_in_threads(func, items, num_threads):
+    """ Return [func(item) for item in items], calling func concurrently from
+        up to num_threads threads.
+
+        func is typically I/O-bound (e.g. a download). The threads are
+        specific to the call, rather than taken from a pool shared by all
+        callers, so that concurrent callers each get up to num_threads
+        threads and do not wait for each other's items.
+    """
+    if num_threads <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(num_threads, len(items)),
+                            thread_name_prefix='mapproxy_hips_io') as executor:
+        return list(executor.map(func, items))
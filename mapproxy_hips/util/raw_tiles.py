@@ -0,0 +1,189 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from collections import OrderedDict
+import logging
+import mmap
+import numpy as np
+import os
+import threading
+
+log_hips = logging.getLogger('mapproxy.hips')
+
+# Number of tiles stored by a process between two checks of the size of the
+# directory of a RawTileStore
+DIRECTORY_CLEANUP_INTERVAL = 256
+
+
+class RawTileStore(object):
+    """ Store of decoded HIPS tiles, as raw uint8 arrays of shape
+        (tile_size, tile_size, num_channels).
+
+        Tiles are grouped in blocks of TILES_PER_FILE consecutive tiles of
+        the same order (in NESTED order), stored in sparse files
+        directory/NorderK/BlockB.raw made of a header of HEADER_SIZE bytes,
+        with one presence byte per tile, followed by the tiles.
+
+        Reads are done through a copy-on-write memory mapping of the files,
+        without locking nor copying, so that all processes share the tiles
+        through the page cache. The content of a tile is written before its
+        presence byte, so that readers never see partial tiles.
+
+        Each mapping holds a file descriptor, hence only the max_open_files
+        most recently used ones are kept. The directory grows with the number
+        of distinct tiles stored. If max_size_mb is set, the least recently
+        used blocks are removed from it by cleanup(), called every
+        DIRECTORY_CLEANUP_INTERVAL tiles stored by the process, when it
+        exceeds that size.
+    """
+
+    TILES_PER_FILE = 256
+    HEADER_SIZE = 4096
+
+    def __init__(self, directory, tile_size, num_channels, max_open_files=64, max_size_mb=0):
+        self.directory = directory
+        self.tile_shape = (tile_size, tile_size, num_channels)
+        self.tile_bytes = tile_size * tile_size * num_channels
+        self.file_size = self.HEADER_SIZE + self.TILES_PER_FILE * self.tile_bytes
+        self.max_open_files = max_open_files
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        # (mmap, array) of the blocks, indexed by (norder, block), in LRU order
+        self._memmaps = OrderedDict()
+        self._lock = threading.Lock()
+        self._num_stored = 0
+
+    def _filename(self, norder, block):
+        return os.path.join(self.directory, 'Norder%d' % norder, 'Block%d.raw' % block)
+
+    def _get_memmap(self, norder, block):
+        """ Return a memory mapping of the file of a block, as an array, or
+            None if it does not exist yet """
+        key = (norder, block)
+        with self._lock:
+            entry = self._memmaps.get(key)
+            if entry is not None:
+                self._memmaps.move_to_end(key)
+                return entry[1]
+        filename = self._filename(norder, block)
+        try:
+            with open(filename, 'rb') as f:
+                # The file is created empty and then extended to its final size
+                if os.fstat(f.fileno()).st_size != self.file_size:
+                    return None
+                # Copy-on-write, to get writable arrays (as expected by numba
+                # typed containers) without any risk of modifying the file.
+                # Pages that are not written to still reflect changes done by
+                # other processes.
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except FileNotFoundError:
+            return None
+        if self.max_size > 0:
+            # The modification time of the file is its last use for cleanup()
+            try:
+                os.utime(filename)
+            except OSError:
+                pass
+        entry = (mm, np.frombuffer(mm, dtype=np.uint8))
+        with self._lock:
+            entry = self._memmaps.setdefault(key, entry)
+            self._memmaps.move_to_end(key)
+            evicted = []
+            while len(self._memmaps) > self.max_open_files:
+                evicted.append(self._memmaps.popitem(last=False)[1][0])
+        for mm in evicted:
+            _close_mmap(mm)
+        return entry[1]
+
+    def _forget_memmap(self, norder, block):
+        """ Close the mapping of a block, whose file has been replaced """
+        with self._lock:
+            entry = self._memmaps.pop((norder, block), None)
+        if entry is not None:
+            mm = entry[0]
+            del entry
+            _close_mmap(mm)
+
+    def get(self, norder, npix):
+        """ Return the array of tile npix of order norder, or None if it is
+            not stored. The array is a view of the memory mapping. """
+        block, index = divmod(npix, self.TILES_PER_FILE)
+        m = self._get_memmap(norder, block)
+        if m is None or not m[index]:
+            return None
+        offset = self.HEADER_SIZE + index * self.tile_bytes
+        return m[offset:offset + self.tile_bytes].reshape(self.tile_shape)
+
+    def put(self, norder, npix, ar):
+        """ Store the array of tile npix of order norder. RGB arrays are
+            extended with an opaque alpha channel if the store has 4 channels.
+            Return False if the array does not have the shape of the store. """
+        if ar.ndim == 3 and ar.shape[2] == 3 and self.tile_shape[2] == 4:
+            ar = np.dstack((ar, np.full(ar.shape[0:2], 255, dtype=np.uint8)))
+        if ar.shape != self.tile_shape or ar.dtype != np.uint8:
+            return False
+
+        block, index = divmod(npix, self.TILES_PER_FILE)
+        filename = self._filename(norder, block)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o664)
+        try:
+            if os.fstat(fd).st_size != self.file_size:
+                # Sparse file: only written tiles use disk space
+                os.ftruncate(fd, self.file_size)
+                # A mapping of a file removed by cleanup() would not see
+                # the new one
+                self._forget_memmap(norder, block)
+            os.pwrite(fd, np.ascontiguousarray(ar).tobytes(), self.HEADER_SIZE + index * self.tile_bytes)
+            os.pwrite(fd, b'\x01', index)
+        finally:
+            os.close(fd)
+
+        if self.max_size > 0:
+            with self._lock:
+                self._num_stored += 1
+                cleanup = self._num_stored % DIRECTORY_CLEANUP_INTERVAL == 0
+            if cleanup:
+                self.cleanup()
+        return True
+
+    def cleanup(self):
+        """ Remove the least recently used block files of directory until the
+            disk space they use is below max_size_mb. Tiles of removed blocks
+            remain valid in the processes that map them. """
+
+        entries = []
+        total_size = 0
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('.raw'):
+                    continue
+                filename = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    # Removed by another process
+                    continue
+                # Sparse files: count the allocated blocks
+                entries.append((stat.st_mtime, filename, stat.st_blocks * 512))
+                total_size += stat.st_blocks * 512
+
+        entries.sort()
+        for _, filename, size in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+            total_size -= size
+
+
+def _close_mmap(mm):
+    """ Close the mmap of a block, and its file descriptor, unless arrays of
+        its tiles are still in use. They are then released with the last of
+        them. """
+    try:
+        mm.close()
+    except BufferError:
+        pass
@@ -2,6 +2,7 @@
 # Copyright (C) 2021 CNES
 
 import math
+import numpy as np
 
 try:
     from numba import jit
@@ -13,23 +14,41 @@ except:
 
     has_numba = False
     class jit(object):
-        def __init__(self, nopython = True, nogil = True):
+        def __init__(self, nopython = True, nogil = True, cache = False):
             pass
 
         def __call__(self, f):
             return f
 
 
+# Values of the resampling argument of the compiled kernels
+RESAMPLING_NEAREST = 0
+RESAMPLING_BILINEAR = 1
+RESAMPLING_BICUBIC = 2
+
+
+def resampling_mode(resampling_method):
+    """ Return the RESAMPLING_xxx constant corresponding to a resampling_method
+        configuration value ('nearest_neighbour', 'bilinear' or 'bicubic') """
+    if resampling_method == 'nearest_neighbour':
+        return RESAMPLING_NEAREST
+    if resampling_method == 'bilinear':
+        return RESAMPLING_BILINEAR
+    if resampling_method == 'bicubic':
+        return RESAMPLING_BICUBIC
+    raise ValueError(f'unsupported resampling_method = {resampling_method}')
+
+
 # Ported from GDAL's warper core GWKCubic(), GWKBilinear() and GWKResample() methods
 # of https://github.com/OSGeo/gdal/blob/master/gdal/alg/gdalwarpkernel.cpp
 
-@jit(nopython=True, nogil=True)
+@jit(nopython=True, nogil=True, cache=True)
 def bilinear_weight(x):
     absX = abs(x)
     return 1 - absX if absX <= 1.0 else 0.0
 
 
-@jit(nopython=True, nogil=True)
+@jit(nopython=True, nogil=True, cache=True)
 def cubic_weight(x):
     # http://en.wikipedia.org/wiki/Bicubic_interpolation#Bicubic_convolution_algorithm
     # W(x) formula with a = -0.5 (cubic hermite spline )
@@ -43,8 +62,17 @@ def cubic_weight(x):
     return 0.0
 
 
-@jit(nopython=True, nogil=True)
-def _convolution_resample(array, x, y, x_scale, y_scale, filter_radius, weight_function):
+@jit(nopython=True, nogil=True, cache=True)
+def _weight(resampling, x):
+    # Numba cannot cache functions taking a function as argument, hence
+    # the dispatch on the RESAMPLING_xxx constant
+    if resampling == RESAMPLING_BILINEAR:
+        return bilinear_weight(x)
+    return cubic_weight(x)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _convolution_resample(array, x, y, x_scale, y_scale, filter_radius, resampling):
 
     x_scale = x_scale if x_scale < 1 else 1
     y_scale = y_scale if y_scale < 1 else 1
@@ -75,7 +103,7 @@ def _convolution_resample(array, x, y, x_scale, y_scale, filter_radius, weight_f
         iMax = array.shape[1] - iX - 1
 
     # Precompute horizontal weights
-    tab_weightX = [weight_function((i - deltaX) * x_scale) for i in range(iMin, iMax+1)]
+    tab_weightX = [_weight(resampling, (i - deltaX) * x_scale) for i in range(iMin, iMax+1)]
 
     # Loop over pixels that affect our result
     acc = 0
@@ -87,7 +115,7 @@ def _convolution_resample(array, x, y, x_scale, y_scale, filter_radius, weight_f
             accLocal += subar[iX+i] * tab_weightX[i - iMin]
 
         # Take into account the Y weight.
-        weightY = weight_function((j - deltaY) * y_scale)
+        weightY = _weight(resampling, (j - deltaY) * y_scale)
         acc += accLocal * weightY
         accWeight += weightY
 
@@ -96,7 +124,7 @@ def _convolution_resample(array, x, y, x_scale, y_scale, filter_radius, weight_f
     return acc / accWeight
 
 
-@jit(nopython=True, nogil=True)
+@jit(nopython=True, nogil=True, cache=True)
 def bilinear_resample(array, x, y, x_scale, y_scale):
     """ Given a 2D array, return value of point at coordinates (x,y), where
         x and y are floating point, with a source-to-target scaling of
@@ -112,10 +140,10 @@ def bilinear_resample(array, x, y, x_scale, y_scale):
             y = (y_dst + 0.5) / y_scale - 0.5
     """
     filter_radius = 1
-    return _convolution_resample(array, x, y, x_scale, y_scale, filter_radius, bilinear_weight)
+    return _convolution_resample(array, x, y, x_scale, y_scale, filter_radius, RESAMPLING_BILINEAR)
 
 
-@jit(nopython=True, nogil=True)
+@jit(nopython=True, nogil=True, cache=True)
 def bicubic_resample(array, x, y, x_scale, y_scale):
     """ Given a 2D array, return value of point at coordinates (x,y), where
         x and y are floating point, with a source-to-target scaling of
@@ -131,4 +159,126 @@ def bicubic_resample(array, x, y, x_scale, y_scale):
             y = (y_dst + 0.5) / y_scale - 0.5
     """
     filter_radius = 2
-    return _convolution_resample(array, x, y, x_scale, y_scale, filter_radius, cubic_weight)
+    return _convolution_resample(array, x, y, x_scale, y_scale, filter_radius, RESAMPLING_BICUBIC)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def resample(resampling, array, x, y, x_scale, y_scale):
+    """ Dispatch to bilinear_resample() or bicubic_resample() depending on
+        resampling (RESAMPLING_BILINEAR or RESAMPLING_BICUBIC).
+
+        Passing an integer rather than the function itself lets kernels
+        calling it be compiled once and cached on disk.
+    """
+    if resampling == RESAMPLING_BILINEAR:
+        return bilinear_resample(array, x, y, x_scale, y_scale)
+    return bicubic_resample(array, x, y, x_scale, y_scale)
+
+
+# Whole-image, multi-channel, resampling engine.
+# Contrary to resample(), that processes a single channel at a single point,
+# the kernel weights of a point are computed once and shared by all channels,
+# and the work buffers are allocated once per image rather than once per call.
+# For the same accumulation type, results are bit-identical to the ones of
+# resample() applied to each channel.
+
+@jit(nopython=True, nogil=True, cache=True)
+def _filter_radius(resampling):
+    return 1 if resampling == RESAMPLING_BILINEAR else 2
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def resampling_buffers(resampling, x_scale, num_channels, acc_dtype_like):
+    """ Return the (tab_weightX, acc) work buffers needed by resample_channels(),
+        for a source-to-target scaling in the horizontal direction of x_scale.
+
+        The accumulation is done with the dtype of the acc_dtype_like array
+        (float32 or float64).
+    """
+    x_scale = x_scale if x_scale < 1 else 1
+    x_radius = int(math.ceil(_filter_radius(resampling) / x_scale))
+    tab_weightX = np.empty(2 * x_radius + 1, dtype=acc_dtype_like.dtype)
+    acc = np.empty(num_channels, dtype=acc_dtype_like.dtype)
+    return tab_weightX, acc
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def resample_channels(resampling, array, x, y, x_scale, y_scale, tab_weightX, acc, out):
+    """ Multi-channel version of resample(): given a (height, width, channels)
+        array, set out[k] to the value of channel k at coordinates (x,y).
+
+        tab_weightX and acc are the work buffers returned by resampling_buffers().
+        resampling must be RESAMPLING_BILINEAR or RESAMPLING_BICUBIC.
+    """
+    filter_radius = _filter_radius(resampling)
+
+    x_scale = x_scale if x_scale < 1 else 1
+    y_scale = y_scale if y_scale < 1 else 1
+
+    x_radius = int(math.ceil(filter_radius / x_scale))
+    y_radius = int(math.ceil(filter_radius / y_scale))
+
+    iX = int(x)
+    iY = int(y)
+    deltaX = x - iX
+    deltaY = y - iY
+
+    # Clip the filter window to the edges of the image
+    parity_offset = (filter_radius + 1) % 2
+    jMin = max(parity_offset - y_radius, -iY)
+    jMax = min(y_radius, array.shape[0] - iY - 1)
+    iMin = max(parity_offset - x_radius, -iX)
+    iMax = min(x_radius, array.shape[1] - iX - 1)
+
+    num_channels = array.shape[2]
+
+    # Precompute horizontal weights, shared by all channels and rows
+    sumWeightX = 0.0
+    for i in range(iMin, iMax+1):
+        weightX = _weight(resampling, (i - deltaX) * x_scale)
+        tab_weightX[i - iMin] = weightX
+        sumWeightX += tab_weightX[i - iMin]
+
+    # Same summation order as _convolution_resample()
+    for k in range(num_channels):
+        out[k] = 0
+    accWeight = 0.0
+    for j in range(jMin, jMax+1):
+        subar = array[iY+j]
+        weightX = tab_weightX[0]
+        for k in range(num_channels):
+            acc[k] = subar[iX+iMin, k] * weightX
+        for i in range(iMin+1, iMax+1):
+            weightX = tab_weightX[i - iMin]
+            for k in range(num_channels):
+                acc[k] += subar[iX+i, k] * weightX
+
+        # Take into account the Y weight.
+        weightY = _weight(resampling, (j - deltaY) * y_scale)
+        for k in range(num_channels):
+            out[k] += acc[k] * weightY
+        accWeight += weightY
+
+    accWeight *= sumWeightX
+
+    for k in range(num_channels):
+        out[k] /= accWeight
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def resample_points(resampling, array, xs, ys, x_scale, y_scale, out):
+    """ Given a (height, width, channels) array, set out[n, k] to the value of
+        channel k at coordinates (xs[n], ys[n]), with a source-to-target scaling
+        of (x_scale,y_scale), by applying bilinear or bicubic interpolation
+        depending on resampling (RESAMPLING_BILINEAR or RESAMPLING_BICUBIC).
+
+        The accumulation is done with the dtype of out: float64 gives the same
+        results as bilinear_resample() / bicubic_resample(), float32 is faster
+        but less accurate.
+
+        See bilinear_resample() for the valid range of xs and ys.
+    """
+    tab_weightX, acc = resampling_buffers(resampling, x_scale, array.shape[2], out)
+    for n in range(xs.shape[0]):
+        resample_channels(resampling, array, xs[n], ys[n], x_scale, y_scale,
+                          tab_weightX, acc, out[n])
@@ -0,0 +1,71 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2021-2022 Spatialys
+# Funded by Centre National d'Etudes Spatiales (CNES): https://cnes.fr
+
+from mapproxy.cache.file import FileCache
+from mapproxy.cache.mbtiles import MBTilesCache
+from mapproxy.cache.tile import Tile
+import os
+
+# Values of the type of HIPS tile cache backends
+CACHE_TYPES = ('file', 'mbtiles')
+
+
+class HIPSTileCacheBackend(object):
+    """ Storage backend of encoded HIPS tiles, reusing MapProxy caches.
+
+        - 'file': one file per tile (FileCache), in directory
+        - 'mbtiles': one SQLite database (MBTilesCache), directory/<ext>.mbtiles,
+          with zoom_level = norder, tile_column = npix and tile_row = 0.
+          Each thread uses its own connection, opened on first use.
+
+        Caches returned by create_cache() are read and written with the
+        Tile objects returned by tile(). Their store_tiles() method writes
+        tiles in a single transaction for SQLite-based caches.
+    """
+
+    def __init__(self, type='file', wal=False):
+        if type not in CACHE_TYPES:
+            raise ValueError(f'unsupported HIPS tile cache type = {type}')
+        self.type = type
+        self.wal = wal
+
+    def create_cache(self, directory, ext):
+        """ Return the MapProxy cache storing tiles of format ext (png or jpg)
+            in directory """
+
+        if self.type == 'mbtiles':
+            return MBTilesCache(os.path.join(directory, ext + '.mbtiles'), wal=self.wal)
+        return FileCache(directory, ext)
+
+    def tile(self, norder, npix):
+        """ Return the Tile used to store tile npix of order norder """
+
+        if self.type == 'mbtiles':
+            return Tile([npix, 0, norder])
+        return Tile([norder, npix, 0])
+
+    def open_tile(self, cache, norder, npix):
+        """ Return a binary file object with the stored content of a tile,
+            or None if it is not cached """
+
+        tile = self.tile(norder, npix)
+        if isinstance(cache, FileCache):
+            try:
+                return open(cache.tile_location(tile), 'rb')
+            except FileNotFoundError:
+                return None
+        if cache.load_tile(tile):
+            return tile.source_buffer()
+        return None
+
+    def stat_tile(self, cache, norder, npix):
+        """ Return the os.stat_result of the file of a tile, or None if it is
+            not cached or is not stored as a file """
+
+        if isinstance(cache, FileCache):
+            try:
+                return os.stat(cache.tile_location(self.tile(norder, npix)))
+            except FileNotFoundError:
+                pass
+        return None